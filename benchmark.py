@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import gdrive_upload_gui
+from fake_drive_server import FakeDriveServer
+
+# Mesure des performances de l'upload avec reprise contre le serveur local fake_drive_server.py
+# Pour chaque combinaison (taille de fichier, taille de chunk), un fichier aléatoire est uploadé
+#  et les mesures suivantes sont relevées :
+#   - débit moyen (Mo/s)
+#   - latence des requêtes PUT de chaque chunk (médiane, 90e et 99e centiles)
+#   - temps CPU consommé et mémoire résidente (RSS) maximale
+# Chaque upload est mené dans un processus séparé (--run-upload) : le temps CPU et la mémoire
+#  maximale mesurés sont ceux de cet upload seul, pas ceux des mesures précédentes.
+# Les conditions réseau (latence, bande passante, coupures, erreurs) sont celles du serveur local.
+# --disk-bandwidth simule un disque lent : la première lecture de chaque bloc du fichier coûte
+#  BLOCK_SIZE / disk_bandwidth secondes, qu'elle soit faite par l'envoi d'un chunk ou par la
+#  lecture anticipée ; --prefetch-depths compare plusieurs profondeurs de lecture anticipée.
+# --drop-cache vide le cache du système pour le fichier avant chaque mesure (disque réel).
+# --connection-modes compare le pool de connexions keep-alive ("pool") à une nouvelle connexion
+#  par requête ("per-request", appels requests.put() directs d'avant le pool) : la colonne
+#  connections donne le nombre de connexions (donc de handshakes) ouvertes pendant l'upload.
+#
+# Exemples :
+#   python3 benchmark.py
+#   python3 benchmark.py --file-sizes 64M,256M --chunk-sizes 1M,4M,16M --latency 0.02 --bandwidth 50e6
+#   python3 benchmark.py --file-sizes 16M --chunk-sizes 4M --limit 5e6
+#   python3 benchmark.py --file-sizes 64M --chunk-sizes 4M --bandwidth 40e6 --disk-bandwidth 40e6 --prefetch-depths 0,1,2
+#   python3 benchmark.py --file-sizes 64M --chunk-sizes 1M --latency 0.02 --connection-modes pool,per-request
+#   python3 benchmark.py --json > bench_output.txt
+
+# __________________________________________________________________
+# Client HTTP mesurant la latence de chaque requête PUT contenant des données
+class TimedUploadClient(gdrive_upload_gui.UploadClient):
+    def __init__(self, *args, **kwargs):
+        gdrive_upload_gui.UploadClient.__init__(self, *args, **kwargs)
+        self.latencies = []
+
+    def put(self, url, **kwargs):
+        _time_start = time.perf_counter()
+        try:
+            return gdrive_upload_gui.UploadClient.put(self, url, **kwargs)
+        finally:
+            if (kwargs.get("data") is not None):
+                self.latencies.append(time.perf_counter() - _time_start)
+
+# Client HTTP sans keep-alive : chaque requête passe par requests.request(), qui ouvre une
+#  nouvelle session, donc une nouvelle connexion, puis la ferme
+class PerRequestUploadClient(TimedUploadClient):
+    def __init__(self, *args, **kwargs):
+        TimedUploadClient.__init__(self, *args, **kwargs)
+        import requests
+        self.session.close()
+        self.session = requests
+
+    def close(self):
+        pass
+
+# __________________________________________________________________
+# Disque lent simulé : un bloc lu pour la première fois coûte BLOCK_SIZE / bandwidth secondes,
+#  les lectures suivantes sont servies par le cache. Les lectures sont faites l'une après l'autre
+#  (une seule tête de lecture), quel que soit le thread qui les demande.
+class SlowDisk:
+    BLOCK_SIZE = (1024 * 1024)
+
+    def __init__(self, bandwidth):
+        self.bandwidth = bandwidth
+        self._cached = set()
+        self._lock = threading.Lock()
+
+    def read(self, start_byte, size):
+        for _block in range(start_byte // self.BLOCK_SIZE, (start_byte + size + self.BLOCK_SIZE - 1) // self.BLOCK_SIZE):
+            with self._lock:
+                if (_block not in self._cached):
+                    time.sleep(self.BLOCK_SIZE / self.bandwidth)
+                    self._cached.add(_block)
+
+# Fichier dont les chunks envoyés sont lus sur le disque lent
+class SlowFileSource(gdrive_upload_gui.FileSource):
+    disk = None
+
+    def chunk(self, start_byte, size):
+        SlowFileSource.disk.read(start_byte, size)
+        return super().chunk(start_byte, size)
+
+# Lecture anticipée sur le disque lent
+class SlowChunkPrefetcher(gdrive_upload_gui.ChunkPrefetcher):
+    def _read(self, start_byte, size):
+        _time_start = time.monotonic()
+        SlowFileSource.disk.read(start_byte, size)
+        self.read_time = self.read_time + (time.monotonic() - _time_start)
+        super()._read(start_byte, size)
+
+# Retire le fichier du cache du système : la mesure suivante le relit sur le disque
+def dropCache(pathfilename):
+    with open(pathfilename, "rb") as f:
+        os.fsync(f.fileno())
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+# Convertit une taille ("256K", "4M", "1G", "1000") en octets
+def parseSize(text):
+    _units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = text.strip().upper()
+    if (text[-1:] in _units):
+        return int(float(text[:-1]) * _units[text[-1]])
+    return int(text)
+
+def percentile(values, percent):
+    if (not values):
+        return 0.0
+    _sorted = sorted(values)
+    return _sorted[min(len(_sorted) - 1, int(round(percent / 100.0 * (len(_sorted) - 1))))]
+
+# Mémoire résidente maximale du processus courant, en octets
+def maxRss():
+    _rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return _rss if (sys.platform == "darwin") else _rss * 1024
+
+def createRandomFile(directory, size):
+    _pathfilename = os.path.join(directory, "bench_" + str(size) + ".bin")
+    if (not os.path.exists(_pathfilename)):
+        with open(_pathfilename, "wb") as f:
+            _remaining = size
+            while (_remaining > 0):
+                _block = min(_remaining, 1024 * 1024 * 8)
+                f.write(os.urandom(_block))
+                _remaining = _remaining - _block
+    return _pathfilename
+
+# __________________________________________________________________
+# Uploade un fichier avec une taille de chunk et une profondeur de lecture anticipée fixes
+# Exécuté dans le processus fils lancé par measureUpload
+# disk_bandwidth : débit du disque lent simulé (None : disque réel)
+# connection_mode : "pool" (connexions keep-alive) ou "per-request" (une connexion par requête)
+# Renvoie les mesures
+def runUpload(base_url, pathfilename, chunk_size, prefetch_depth, disk_bandwidth=None, drop_cache=False, connection_mode="pool"):
+    _client = (PerRequestUploadClient if (connection_mode == "per-request") else TimedUploadClient)(base_url=base_url)
+    gdrive_upload_gui.setUploadClient(_client)
+    gdrive_upload_gui.PREFETCH_DEPTH = prefetch_depth
+    if (disk_bandwidth is not None):
+        SlowFileSource.disk = SlowDisk(disk_bandwidth)
+        gdrive_upload_gui.FileSource = SlowFileSource
+        gdrive_upload_gui.ChunkPrefetcher = SlowChunkPrefetcher
+    if (drop_cache):
+        dropCache(pathfilename)
+    _size = os.stat(pathfilename).st_size
+    _cpu_start = time.process_time()
+    _time_start = time.perf_counter()
+    with open(os.devnull, "w") as _devnull, contextlib.redirect_stdout(_devnull):
+        _upload_id = gdrive_upload_gui.initiateNewResumableUpload(pathfilename, os.path.basename(pathfilename), "bench")
+        gdrive_upload_gui.getUploadJournal().begin(pathfilename, os.path.basename(pathfilename), _upload_id)
+        gdrive_upload_gui.resumeExistingUpload(pathfilename, os.path.basename(pathfilename), _upload_id, chunk_size=chunk_size)
+    _elapsed = time.perf_counter() - _time_start
+    _cpu = time.process_time() - _cpu_start
+    return {
+        "file_size": _size,
+        "chunk_size": chunk_size,
+        "prefetch_depth": prefetch_depth,
+        "connection_mode": connection_mode,
+        "seconds": round(_elapsed, 4),
+        "mb_per_s": round(_size / _elapsed / 1e6, 2),
+        "chunks": len(_client.latencies),
+        "latency_p50_ms": round(percentile(_client.latencies, 50) * 1000, 2),
+        "latency_p90_ms": round(percentile(_client.latencies, 90) * 1000, 2),
+        "latency_p99_ms": round(percentile(_client.latencies, 99) * 1000, 2),
+        "cpu_seconds": round(_cpu, 3),
+        "max_rss_mb": round(maxRss() / 1e6, 1),
+    }
+
+# Mène un upload (runUpload) dans un nouveau processus et renvoie ses mesures,
+#  complétées par les connexions et les erreurs vues par le serveur pendant l'upload
+# settings : constantes de gdrive_upload_gui à fixer dans le processus fils
+def measureUpload(server, settings, pathfilename, chunk_size, prefetch_depth, disk_bandwidth=None, drop_cache=False,
+                  connection_mode="pool"):
+    _stats_before = dict(server.stats)
+    _request = {"settings": settings, "base_url": server.base_url, "pathfilename": pathfilename, "chunk_size": chunk_size,
+                "prefetch_depth": prefetch_depth, "disk_bandwidth": disk_bandwidth, "drop_cache": drop_cache,
+                "connection_mode": connection_mode}
+    _process = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-upload", json.dumps(_request)],
+                              stdout=subprocess.PIPE, check=True)
+    _result = json.loads(_process.stdout)
+    _result["connections"] = server.stats["connections"] - _stats_before["connections"]
+    _result["retries"] = (server.stats["drops"] - _stats_before["drops"]) + (server.stats["errors"] - _stats_before["errors"])
+    return _result
+
+# Point d'entrée du processus fils : request est la mesure demandée par measureUpload (JSON)
+def runUploadProcess(request):
+    _request = json.loads(request)
+    for _name, _value in _request["settings"].items():
+        setattr(gdrive_upload_gui, _name, _value)
+    _result = runUpload(_request["base_url"], _request["pathfilename"], _request["chunk_size"], _request["prefetch_depth"],
+                        _request["disk_bandwidth"], _request["drop_cache"], _request["connection_mode"])
+    gdrive_upload_gui.getUploadJournal().close()
+    print(json.dumps(_result))
+
+def printTable(results):
+    _columns = ["file_size", "chunk_size", "prefetch_depth", "connection_mode", "seconds", "mb_per_s", "chunks", "latency_p50_ms", "latency_p90_ms",
+                "latency_p99_ms", "cpu_seconds", "max_rss_mb", "connections", "retries"]
+    print("  ".join("%14s" % _column for _column in _columns))
+    for _result in results:
+        print("  ".join("%14s" % _result[_column] for _column in _columns))
+
+# ================================================================
+def main():
+    _parser = argparse.ArgumentParser(description="Mesure des performances de l'upload contre un serveur local")
+    _parser.add_argument("--file-sizes", default="16M,64M", help="tailles de fichier, séparées par des virgules")
+    _parser.add_argument("--chunk-sizes", default="256K,1M,4M,16M", help="tailles de chunk, séparées par des virgules")
+    _parser.add_argument("--latency", type=float, default=0.0, help="délai ajouté à chaque requête (s)")
+    _parser.add_argument("--bandwidth", type=float, default=None, help="débit maximal du serveur (octets/s)")
+    _parser.add_argument("--drop-rate", type=float, default=0.0, help="probabilité de coupure de connexion")
+    _parser.add_argument("--error-rate", type=float, default=0.0, help="probabilité de réponse 503")
+    _parser.add_argument("--no-prefetch", action="store_true", help="désactive la lecture anticipée (--prefetch-depths 0)")
+    _parser.add_argument("--prefetch-depths", default=str(gdrive_upload_gui.PREFETCH_DEPTH),
+                         help="profondeurs de lecture anticipée comparées, séparées par des virgules")
+    _parser.add_argument("--disk-bandwidth", type=float, default=None, help="débit du disque lent simulé (octets/s)")
+    _parser.add_argument("--drop-cache", action="store_true", help="vide le cache du système avant chaque mesure")
+    _parser.add_argument("--limit", type=float, default=None, help="débit maximal du client (octets/s, BANDWIDTH_LIMIT)")
+    _parser.add_argument("--connection-modes", default="pool",
+                         help="modes de connexion comparés, séparés par des virgules : pool (keep-alive), per-request")
+    _parser.add_argument("--json", action="store_true", help="écrit les résultats en JSON (une ligne par mesure)")
+    _parser.add_argument("--run-upload", default=None, help=argparse.SUPPRESS)     # processus fils d'une mesure
+    _args = _parser.parse_args()
+    if (_args.run_upload is not None):
+        return runUploadProcess(_args.run_upload)
+
+    _prefetch_depths = [0] if (_args.no_prefetch) else [int(_text) for _text in _args.prefetch_depths.split(",")]
+    _connection_modes = _args.connection_modes.split(",")
+    for _mode in _connection_modes:
+        if (_mode not in ("pool", "per-request")):
+            _parser.error("mode de connexion inconnu : " + _mode)
+    _results = []
+    with tempfile.TemporaryDirectory() as _directory:
+        _settings = {"verbose": False, "RETRY_BASE_DELAY": 0.01, "BANDWIDTH_LIMIT": _args.limit,
+                     "JOURNAL_PATHFILENAME": os.path.join(_directory, "journal.sqlite")}
+        with FakeDriveServer(latency=_args.latency, bandwidth=_args.bandwidth, drop_rate=_args.drop_rate,
+                             error_rate=_args.error_rate, seed=0) as _server:
+            for _file_size in [parseSize(_text) for _text in _args.file_sizes.split(",")]:
+                _pathfilename = createRandomFile(_directory, _file_size)
+                for _chunk_size in [parseSize(_text) for _text in _args.chunk_sizes.split(",")]:
+                    for _prefetch_depth in _prefetch_depths:
+                        for _connection_mode in _connection_modes:
+                            _result = measureUpload(_server, _settings, _pathfilename, _chunk_size, _prefetch_depth,
+                                                    _args.disk_bandwidth, _args.drop_cache, _connection_mode)
+                            _results.append(_result)
+                            if (_args.json):
+                                print(json.dumps(_result))
+                                sys.stdout.flush()
+    if (not _args.json):
+        printTable(_results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+
+import hashlib
+import http.server
+import json
+import random
+import re
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+from functools import partial
+
+# Serveur local imitant le protocole d'upload avec reprise de Google Drive
+#   https://developers.google.com/drive/api/v3/resumable-upload
+# Il permet de tester et de mesurer gdrive_upload_gui.py sans accès à internet.
+#
+# Protocole imité :
+#   - POST /upload/drive/v3/files?uploadType=multipart : upload en une requête (multipart/related),
+#       renvoie 200 et les métadonnées du fichier
+#   - POST /upload/drive/v3/files?uploadType=resumable : ouvre une session,
+#       renvoie 200 avec l'entête X-GUploader-UploadID
+#   - PATCH /upload/drive/v3/files/<id>?uploadType=multipart|resumable : nouvelle révision d'un fichier
+#       existant (même identifiant), 404 si le fichier n'existe pas
+#   - PUT ...&upload_id=<id> avec Content-Range "bytes a-b/N" (ou "bytes a-b/*") : reçoit un chunk,
+#       renvoie 308 avec l'entête Range des octets reçus, ou 200 et les métadonnées du fichier
+#       (JSON avec md5Checksum) lorsque tous les octets sont reçus
+#   - PUT ...&upload_id=<id> avec Content-Range "bytes */N" (ou "bytes */*") : état de la session
+#   - chunk autre que le dernier dont la taille n'est pas un multiple de 256 Ko : 400, comme Drive
+#   - session inconnue ou expirée : 404
+#   - GET /drive/v3/files : liste des fichiers uploadés (paramètres pageSize et pageToken)
+#   - POST /drive/v3/files/<id>/copy : copie d'un fichier, sans transfert de données
+#   - POST /drive/v3/files : création d'un fichier sans contenu (raccourci par exemple)
+#
+# Défauts injectables :
+#   - latency : délai (en secondes) ajouté à chaque requête
+#   - bandwidth : débit maximal (en octets/s) de réception des données
+#   - drop_rate : probabilité de couper la connexion au milieu de la réception d'un chunk
+#       (la partie déjà reçue, arrondie à 256 Ko, est conservée comme le ferait Drive)
+#   - error_rate : probabilité de répondre 503 (avec Retry-After si retry_after est précisé)
+#   - faults : liste de défauts à appliquer dans l'ordre aux prochains PUT et uploads multipart :
+#       "drop", "lost_reply" (requête traitée, puis connexion coupée avant la réponse) ou un code HTTP
+#
+# Exemple :
+#   > Lancer le serveur sur le port 8080 avec 50 ms de latence et 10 Mo/s de débit
+#       python3 fake_drive_server.py --port 8080 --latency 0.05 --bandwidth 10e6
+#   > Puis dans gdrive_upload_gui.py
+#       setUploadClient(UploadClient(base_url="http://127.0.0.1:8080"))
+
+CHUNK_GRANULARITY = (256 * 1024)
+READ_BLOCK_SIZE = (64 * 1024)   # taille des blocs lus sur la socket (régulation du débit)
+
+# __________________________________________________________________
+# Session d'upload côté serveur
+# Les octets reçus ne sont pas conservés (seulement leur nombre et leur empreinte MD5),
+#  pour que la mémoire du serveur ne fausse pas les mesures du client
+class FakeUploadSession:
+    def __init__(self, upload_id, name, mime_type, size, file_id=None, parents=None):
+        self.upload_id = upload_id
+        self.file_id = file_id          # fichier dont la session envoie une nouvelle révision
+        self.name = name
+        self.parents = ["root"] if (parents is None) else parents
+        self.mime_type = mime_type
+        self.size = size                # taille annoncée, None si inconnue
+        self.received = 0               # nombre d'octets reçus
+        self.complete = False
+        self._md5 = hashlib.md5()
+
+    def append(self, data):
+        self._md5.update(data)
+        self.received = self.received + len(data)
+
+    def metadata(self):
+        return {
+            "kind": "drive#file",
+            "id": ("fake-" + self.upload_id) if (self.file_id is None) else self.file_id,
+            "name": self.name,
+            "parents": self.parents,
+            "mimeType": self.mime_type,
+            "size": str(self.received),
+            "md5Checksum": self._md5.hexdigest(),
+        }
+
+# __________________________________________________________________
+# Traitement des requêtes HTTP
+class FakeDriveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # connexions keep-alive
+    lost_reply = False              # la réponse à la requête courante est perdue (défaut "lost_reply")
+
+    def __init__(self, server_state, *args, **kwargs):
+        self.state = server_state
+        http.server.BaseHTTPRequestHandler.__init__(self, *args, **kwargs)
+
+    def setup(self):
+        http.server.BaseHTTPRequestHandler.setup(self)
+        with self.state.lock:
+            self.state.stats["connections"] += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, headers=None, body=b""):
+        if (self.lost_reply):
+            return self.closeConnection()
+        self.send_response(code)
+        for _name, _value in (headers or {}).items():
+            self.send_header(_name, _value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def replyJson(self, code, obj, headers=None):
+        _headers = {"Content-Type": "application/json; charset=UTF-8"}
+        _headers.update(headers or {})
+        self.reply(code, _headers, json.dumps(obj).encode("utf-8"))
+
+    # Lit le corps de la requête en respectant la bande passante configurée
+    # limit : nombre d'octets à lire avant d'abandonner (simulation de coupure)
+    def readBody(self, limit=None):
+        _length = int(self.headers.get("Content-Length", 0))
+        _to_read = _length if (limit is None) else min(limit, _length)
+        _data = bytearray()
+        _time_start = time.monotonic()
+        while (len(_data) < _to_read):
+            _block = self.rfile.read(min(READ_BLOCK_SIZE, _to_read - len(_data)))
+            if (not _block):
+                break
+            _data.extend(_block)
+            if (self.state.bandwidth):
+                _late = len(_data) / self.state.bandwidth - (time.monotonic() - _time_start)
+                if (_late > 0):
+                    time.sleep(_late)
+        return _data
+
+    def query(self):
+        return urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+
+    def do_POST(self):
+        if (self.state.latency):
+            time.sleep(self.state.latency)
+        with self.state.lock:
+            self.state.stats["requests"] += 1
+        _query = self.query()
+        _fault = self.state.nextFault() if (_query.get("uploadType") in (["multipart"], ["resumable"])) else None
+        if (_fault == "drop"):
+            return self.dropConnection(None)
+        _body = self.readBody()
+        if (_fault == "lost_reply"):
+            self.lost_reply = True
+        elif (_fault is not None):
+            return self.replyJson(_fault, {"error": {"code": _fault, "message": "Erreur simulée"}})
+        _path = urllib.parse.urlparse(self.path).path
+        if (_path.startswith("/drive/v3/")):
+            return self.apiPost(_path, _body)
+        self.upload(_query, _body)
+
+    # Nouvelle révision d'un fichier existant
+    def do_PATCH(self):
+        if (self.state.latency):
+            time.sleep(self.state.latency)
+        with self.state.lock:
+            self.state.stats["requests"] += 1
+        _body = self.readBody()
+        _match = re.match(r"/upload/drive/v3/files/([^/]+)$", urllib.parse.urlparse(self.path).path)
+        if (_match is None):
+            return self.replyJson(404, {"error": {"code": 404, "message": "Ressource inconnue"}})
+        if (_match.group(1) not in self.state.files):
+            return self.replyJson(404, {"error": {"code": 404, "message": "Fichier inconnu"}})
+        self.upload(self.query(), _body, _match.group(1))
+
+    # Upload multipart, ou ouverture d'une session d'upload avec reprise
+    # file_id : fichier dont une nouvelle révision est envoyée (None : nouveau fichier)
+    def upload(self, query, body, file_id=None):
+        if (query.get("uploadType") == ["multipart"]):
+            return self.multipartUpload(body, file_id)
+        if (query.get("uploadType") != ["resumable"]):
+            return self.replyJson(400, {"error": {"code": 400, "message": "uploadType non supporté"}})
+        try:
+            _metadata = json.loads(body.decode("utf-8") or "{}")
+        except ValueError:
+            return self.replyJson(400, {"error": {"code": 400, "message": "Métadonnées invalides"}})
+        _parents = self.checkParents(_metadata, file_id)
+        if (_parents is None):
+            return
+        _size = self.headers.get("X-Upload-Content-Length")
+        _session = self.state.newSession(_metadata.get("name", self.currentName(file_id)),
+                                         self.headers.get("X-Upload-Content-Type", "application/octet-stream"),
+                                         None if (_size is None) else int(_size), file_id, _parents)
+        _location = self.state.base_url + "/upload/drive/v3/files?uploadType=resumable&upload_id=" + _session.upload_id
+        self.reply(200, {"X-GUploader-UploadID": _session.upload_id, "Location": _location})
+
+    def do_GET(self):
+        if (self.state.latency):
+            time.sleep(self.state.latency)
+        with self.state.lock:
+            self.state.stats["requests"] += 1
+        if (urllib.parse.urlparse(self.path).path != "/drive/v3/files"):
+            return self.replyJson(404, {"error": {"code": 404, "message": "Ressource inconnue"}})
+        _query = self.query()
+        _page_size = int(_query.get("pageSize", ["100"])[0])
+        _start = int(_query.get("pageToken", ["0"])[0])
+        _folder = re.search(r"'([^']+)' in parents", _query.get("q", [""])[0])
+        with self.state.lock:
+            _files = [_file for _file in self.state.files.values()
+                      if ( (_folder is None) or (_folder.group(1) in _file.get("parents", ["root"])) )]
+        _page = {"files": _files[_start:_start + _page_size]}
+        if (_start + _page_size < len(_files)):
+            _page["nextPageToken"] = str(_start + _page_size)
+        self.replyJson(200, _page)
+
+    # Requêtes de l'API Drive sans contenu : copie d'un fichier, création d'un fichier vide
+    def apiPost(self, path, body):
+        try:
+            _metadata = json.loads(body.decode("utf-8") or "{}")
+        except ValueError:
+            return self.replyJson(400, {"error": {"code": 400, "message": "Métadonnées invalides"}})
+        _match = re.match(r"/drive/v3/files/([^/]+)/copy$", path)
+        if (_match is not None):
+            _source = self.state.files.get(_match.group(1))
+            if (_source is None):
+                return self.replyJson(404, {"error": {"code": 404, "message": "Fichier inconnu"}})
+            _file = dict(_source)
+            del _file["id"]
+            _file.update(_metadata)
+        elif (path == "/drive/v3/files"):
+            _file = dict(_metadata, kind="drive#file")
+            _file.setdefault("parents", ["root"])
+        else:
+            return self.replyJson(404, {"error": {"code": 404, "message": "Ressource inconnue"}})
+        self.replyJson(200, self.state.addFile(_file))
+
+    def do_PUT(self):
+        if (self.state.latency):
+            time.sleep(self.state.latency)
+        with self.state.lock:
+            self.state.stats["requests"] += 1
+        _upload_id = self.query().get("upload_id", [""])[0]
+        _session = self.state.sessions.get(_upload_id)
+        if (_session is None):
+            self.readBody()
+            return self.replyJson(404, {"error": {"code": 404, "message": "Session inconnue"}})
+        _fault = self.state.nextFault()
+        if (_fault == "drop"):
+            return self.dropConnection(_session)
+        if (_fault == "lost_reply"):
+            self.lost_reply = True
+        elif (_fault is not None):
+            self.readBody()
+            _headers = {}
+            if (self.state.retry_after is not None):
+                _headers["Retry-After"] = str(self.state.retry_after)
+            return self.replyJson(_fault, {"error": {"code": _fault, "message": "Erreur simulée"}}, _headers)
+
+        _content_range = self.headers.get("Content-Range", "")
+        _data = self.readBody()
+        with self.state.lock:
+            self.state.stats["bytes"] += len(_data)
+        _match = re.match(r"bytes (\d+)-(\d+)/(\d+|\*)$", _content_range)
+        _status = re.match(r"bytes \*/(\d+|\*)$", _content_range)
+        if (_match is not None):
+            _start = int(_match.group(1))
+            if (_match.group(3) != "*"):
+                _session.size = int(_match.group(3))
+            _final = ( (_session.size is not None) and (_start + len(_data) >= _session.size) )
+            if ( (not _final) and (len(_data) % CHUNK_GRANULARITY != 0) ):
+                return self.replyJson(400, {"error": {"code": 400, "message": "La taille d'un chunk (hors dernier) "
+                                                      "doit être un multiple de " + str(CHUNK_GRANULARITY) + " octets"}})
+            if (_start <= _session.received < _start + len(_data)):
+                _session.append(_data[_session.received - _start:])
+        elif (_status is not None):
+            if (_status.group(1) != "*"):
+                _session.size = int(_status.group(1))
+        else:
+            return self.replyJson(400, {"error": {"code": 400, "message": "Content-Range invalide"}})
+        if ( (_session.size is not None) and (_session.received >= _session.size) and (not _session.complete) ):
+            _session.complete = True
+            self.state.addFile(_session.metadata())
+        if (_session.complete):
+            return self.replyJson(200, _session.metadata())
+        self.replyIncomplete(_session)
+
+    # Upload en une requête : corps multipart/related (métadonnées JSON puis contenu)
+    def multipartUpload(self, body, file_id=None):
+        _match = re.search(r"boundary=\"?([^\";]+)", self.headers.get("Content-Type", ""))
+        if (_match is None):
+            return self.replyJson(400, {"error": {"code": 400, "message": "boundary absent"}})
+        _parts = []
+        for _part in bytes(body).split(b"--" + _match.group(1).encode("utf-8"))[1:-1]:
+            _headers, _separator, _content = _part.partition(b"\r\n\r\n")
+            if (_content.endswith(b"\r\n")):
+                _content = _content[:-2]
+            _type = re.search(rb"Content-Type: *([^\r\n;]+)", _headers, re.IGNORECASE)
+            _parts.append(((_type.group(1).decode("utf-8") if _type else "application/octet-stream"), _content))
+        if (len(_parts) != 2):
+            return self.replyJson(400, {"error": {"code": 400, "message": "Corps multipart invalide"}})
+        try:
+            _metadata = json.loads(_parts[0][1].decode("utf-8"))
+        except ValueError:
+            return self.replyJson(400, {"error": {"code": 400, "message": "Métadonnées invalides"}})
+        _parents = self.checkParents(_metadata, file_id)
+        if (_parents is None):
+            return
+        _session = self.state.newSession(_metadata.get("name", self.currentName(file_id)), _parts[1][0],
+                                         len(_parts[1][1]), file_id, _parents)
+        _session.append(_parts[1][1])
+        _session.complete = True
+        self.state.addFile(_session.metadata())
+        self.replyJson(200, _session.metadata())
+
+    # Dossiers parents du fichier uploadé : ceux des métadonnées pour un nouveau fichier ("root" par
+    #  défaut), ceux du fichier existant pour une nouvelle révision, dont les métadonnées ne peuvent
+    #  pas contenir "parents" (réponse 403 comme Drive, et None est renvoyé)
+    def checkParents(self, metadata, file_id):
+        if (file_id is None):
+            return metadata.get("parents", ["root"])
+        if ("parents" in metadata):
+            self.replyJson(403, {"error": {"code": 403, "message": "Le champ parents n'est pas modifiable directement"}})
+            return None
+        return self.state.files[file_id].get("parents", ["root"])
+
+    # Nom actuel du fichier dont une nouvelle révision est envoyée ("" pour un nouveau fichier)
+    def currentName(self, file_id):
+        return "" if (file_id is None) else self.state.files[file_id].get("name", "")
+
+    def replyIncomplete(self, session):
+        _headers = {}
+        if (session.received > 0):
+            _headers["Range"] = "bytes=0-" + str(session.received - 1)
+        self.reply(308, _headers)
+
+    # Coupe la connexion au milieu du chunk, en conservant les octets reçus (arrondis à 256 Ko)
+    # session : None pour une requête qui n'appartient pas à une session d'upload avec reprise
+    def dropConnection(self, session):
+        _match = re.match(r"bytes (\d+)-(\d+)/", self.headers.get("Content-Range", ""))
+        _length = int(self.headers.get("Content-Length", 0))
+        _data = self.readBody(limit=_length // 2)
+        if ( (session is not None) and (_match is not None) and (int(_match.group(1)) == session.received) ):
+            session.append(_data[:len(_data) // CHUNK_GRANULARITY * CHUNK_GRANULARITY])
+        self.closeConnection()
+
+    def closeConnection(self):
+        with self.state.lock:
+            self.state.stats["drops"] += 1
+        self.close_connection = True
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+# __________________________________________________________________
+# Serveur imitant l'API d'upload de Drive
+# S'utilise comme gestionnaire de contexte :
+#   with FakeDriveServer(latency=0.01) as server:
+#       setUploadClient(UploadClient(base_url=server.base_url))
+class FakeDriveServer:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, bandwidth=None, drop_rate=0.0,
+                 error_rate=0.0, retry_after=None, seed=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.drop_rate = drop_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.faults = []
+        self.sessions = {}
+        self.files = {}                 # fichiers uploadés, par identifiant
+        self.stats = {"connections": 0, "requests": 0, "bytes": 0, "drops": 0, "errors": 0}
+        self.lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._next_id = 0
+        self._httpd = _ThreadingHTTPServer((host, port), partial(FakeDriveHandler, self))
+        self.base_url = "http://" + host + ":" + str(self._httpd.server_address[1])
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def newSession(self, name, mime_type, size, file_id=None, parents=None):
+        with self.lock:
+            self._next_id = self._next_id + 1
+            _upload_id = "FAKE" + str(self._next_id)
+            self.sessions[_upload_id] = FakeUploadSession(_upload_id, name, mime_type, size, file_id, parents)
+        return self.sessions[_upload_id]
+
+    # Enregistre un fichier (un nouvel identifiant lui est attribué s'il n'en a pas)
+    def addFile(self, metadata):
+        with self.lock:
+            if ("id" not in metadata):
+                self._next_id = self._next_id + 1
+                metadata["id"] = "fake-FILE" + str(self._next_id)
+            self.files[metadata["id"]] = metadata
+        return metadata
+
+    # Fait expirer une session : les requêtes suivantes reçoivent 404
+    def expire(self, upload_id):
+        with self.lock:
+            self.sessions.pop(upload_id, None)
+
+    # Défaut à appliquer à la requête courante : None, "drop", "lost_reply" ou un code HTTP
+    def nextFault(self):
+        with self.lock:
+            if (self.faults):
+                _fault = self.faults.pop(0)
+            elif (self._random.random() < self.drop_rate):
+                _fault = "drop"
+            elif (self._random.random() < self.error_rate):
+                _fault = 503
+            else:
+                _fault = None
+            if (isinstance(_fault, int)):
+                self.stats["errors"] += 1
+        return _fault
+
+# ================================================================
+def main():
+    import argparse
+    _parser = argparse.ArgumentParser(description="Serveur local imitant l'upload avec reprise de Google Drive")
+    _parser.add_argument("--host", default="127.0.0.1")
+    _parser.add_argument("--port", type=int, default=8080)
+    _parser.add_argument("--latency", type=float, default=0.0, help="délai ajouté à chaque requête (s)")
+    _parser.add_argument("--bandwidth", type=float, default=None, help="débit maximal de réception (octets/s)")
+    _parser.add_argument("--drop-rate", type=float, default=0.0, help="probabilité de coupure de connexion")
+    _parser.add_argument("--error-rate", type=float, default=0.0, help="probabilité de réponse 503")
+    _parser.add_argument("--retry-after", type=float, default=None, help="entête Retry-After des réponses 503 (s)")
+    _args = _parser.parse_args()
+    _server = FakeDriveServer(_args.host, _args.port, _args.latency, _args.bandwidth, _args.drop_rate,
+                              _args.error_rate, _args.retry_after)
+    print("Serveur d'upload local : " + _server.base_url)
+    try:
+        _server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,28 @@
 #!/usr/bin/env python3
 
 import json
-import requests
 import io
 import os
+import sys
+import mmap
 import configparser
 import datetime
 import time
-from oauth2client import file, client, tools
-import tkinter
-from tkinter import filedialog
+import threading
+import queue
+import sqlite3
+import random
+import hashlib
+import uuid
+import zlib
+import errno
+import struct
+import ctypes
+import collections
+import contextlib
 from functools import partial
+# requests, oauth2client, tkinter, concurrent.futures et email.utils ne sont importés qu'à
+#  leur première utilisation : la ligne de commande (cli) démarre vite et fonctionne sans affichage
 
 # Ce script permet d'uploader un fichier vers Google Drive en utilisant l'API.
 # L'intérêt de ce script réside dans le fait qu'il permet de reprendre un upload
@@ -49,25 +61,81 @@ from functools import partial
 #   
 
 # Lorsqu'un nouvel upload est initié, les informations nécessaire pour reprendre le téléchargement sont mémorisées
-#  automatiqment dans un fichier texte ".ini" dont le nom contient la date et l'heure.
-# Pour une reprise du téléchargement interrompu, utiliser le point d'entrée qui récupère les information depuis un fichier
-#  de configuration et poursui le téléchargement : resumeFromConfigFile(<nom fichier config>)
+#  automatiqment dans un journal SQLite (JOURNAL_PATHFILENAME), mis à jour après chaque chunk avec le nombre
+#  d'octets acquittés par le serveur.
+# Pour une reprise des téléchargements interrompus, utiliser le point d'entrée qui reprend toutes les sessions
+#  inachevées du journal : resumeUnfinishedUploads()
+# Les anciens fichiers de configuration ".ini" peuvent toujours être repris : resumeFromConfigFile(<nom fichier config>)
 # 
 # 
 # Exemples : 
 #  > Exemple n°1 : Commencer un nouveau transfert vers le drive
 #       newResumableUpload(PAHTFILENAME, FILENAME, TOKEN_ID)
 
-#  > Exemple n°2 : Reprendre un téléchargement interrompu à partir des données mémorisées dans un fichier de configuration
-#       resumeFromConfigFile('upload_config_2018_09_01_16h54m44s.ini')
+#  > Exemple n°2 : Reprendre tous les téléchargements interrompus mémorisés dans le journal
+#       resumeUnfinishedUploads()
 
 #  > Exemple n°3 : Vérifier si un téléchargement s'est terminé jusqu'au bout ou s'il est inachevé
 #       _status, _start, _end = checkUploadComplete(UPLOAD_ID)
 
+#  > Exemple n°4 : Sans interface graphique (ex : depuis cron), voir cli()
+#       python3 gdrive_upload_gui.py new <fichier>
+#       python3 gdrive_upload_gui.py resume
+#       python3 gdrive_upload_gui.py status --check
+
 # L'interface utilisateur n'est réalisée que pour fournir les données nécessaire à l'exécution
 # Tous les retours et messages sont réalisés dans la console
 
 CHUNK_SIZE = (1024 * 1024 * 4) # Size of each packet of the file sent in the resumable multiple chunks mode
+CHUNK_GRANULARITY = (256 * 1024)        # Drive impose des chunks multiples de 256 Ko (sauf le dernier)
+CHUNK_SIZE_MIN = CHUNK_GRANULARITY      # Bornes de la taille des chunks en mode adaptatif
+CHUNK_SIZE_MAX = (1024 * 1024 * 128)
+CHUNK_TARGET_DURATION = 4.0             # Durée visée (en secondes) pour l'envoi d'un chunk en mode adaptatif
+ADAPTIVE_CHUNK_SIZE = True              # False : la taille des chunks reste fixée à CHUNK_SIZE
+PREFETCH_DEPTH = 1                      # Nombre de chunks lus à l'avance pendant l'envoi du chunk courant (0 : désactivé)
+PREFETCH_MAX_BYTES = (1024 * 1024 * 256)    # Volume maximal lu à l'avance
+DEDUP_ENABLED = False       # Vérifie avant l'upload si Drive contient déjà un fichier de même contenu (MD5)
+DEDUP_ACTION = "copy"       # Si c'est le cas : "skip" (rien), "copy" (copie côté Drive) ou "shortcut" (raccourci)
+DEDUP_FOLDER_ID = "root"    # Dossier Drive dans lequel les fichiers sont recherchés, et créés si DEDUP_ENABLED
+HASH_CACHE_PATHFILENAME = "hash_cache.sqlite"   # Cache des empreintes MD5 des fichiers locaux
+HASH_CACHE_MAX_ENTRIES = 100000                 # Nombre maximal d'empreintes conservées (les moins récemment utilisées sont supprimées)
+SIMPLE_UPLOAD_THRESHOLD = (1024 * 1024 * 5)     # En dessous de cette taille, le fichier est envoyé en une seule requête
+VERIFY_MD5 = True                       # Compare l'empreinte MD5 du fichier local avec celle calculée par Drive
+SPARSE_IMAGE_MODE = False               # Envoie les images disque ".img" compressées (gzip), sans lire les trous du fichier
+SPARSE_BLOCK_SIZE = (1024 * 1024 * 16)  # Taille des blocs de l'image compressés séparément (points de reprise)
+SPARSE_COMPRESSION_LEVEL = 1            # Niveau de compression gzip des blocs de données
+
+API_BASE_URL = "https://www.googleapis.com"     # Adresse du serveur de l'API (modifiable pour les tests, voir fake_drive_server.py)
+HTTP_POOL_SIZE = 4          # Nombre de connexions conservées ouvertes (keep-alive) vers le serveur
+HTTP_TIMEOUT = (10, 300)    # Timeouts (connexion, lecture) en secondes de chaque requête HTTP
+OAUTH_SCOPES = 'https://www.googleapis.com/auth/drive'
+OAUTH_TOKEN_PATHFILENAME = 'token.json'            # Identifiants mémorisés (access token + refresh token)
+OAUTH_SECRETS_PATHFILENAME = 'credentials.json'    # Identifiants de l'application, pour l'autorisation dans le navigateur
+TOKEN_REFRESH_MARGIN = 300  # Le token est renouvelé s'il expire dans moins de TOKEN_REFRESH_MARGIN secondes
+OAUTH_LOCAL_WEBSERVER = True    # Autorisation dans un navigateur local ; sinon l'URL est affichée et le code saisi
+                                #  dans la console (serveurs sans navigateur, ligne de commande)
+
+RETRY_MAX_ATTEMPTS = 8      # Nombre maximal d'échecs consécutifs tolérés sur une requête avant abandon
+RETRY_BUDGET = 50           # Nombre total de nouvelles tentatives autorisées pour un upload
+RETRY_BASE_DELAY = 1.0      # Délai (en secondes) avant la 1ère nouvelle tentative, doublé à chaque échec
+RETRY_MAX_DELAY = 64.0      # Délai maximal (en secondes) entre deux tentatives
+
+BANDWIDTH_LIMIT = None      # Débit maximal (octets/s) partagé par tous les uploads du processus (None : illimité)
+BANDWIDTH_SESSION_CAP = None    # Débit maximal (octets/s) de chaque session d'upload (None : illimité)
+BANDWIDTH_PROFILES = []     # Débits par plage horaire (heure locale), prioritaires sur BANDWIDTH_LIMIT
+                            #  ex : [("08:00", "19:00", 2e6), ("19:00", "08:00", None)]
+                            #  un débit de 0 suspend les envois pendant la plage (ex : ("8:00", "19:00", 0))
+BANDWIDTH_SLICE = (64 * 1024)   # Taille des blocs envoyés entre deux prélèvements de débit
+UPLOAD_WORKERS = 4          # Nombre d'uploads menés en parallèle par une file d'upload (UploadQueue)
+
+JOURNAL_PATHFILENAME = "upload_journal.sqlite"   # Journal des sessions d'upload (reprise après arrêt)
+RESUME_ON_STARTUP = True    # Reprend automatiquement les uploads inachevés du journal au lancement de l'interface
+SYNC_MANIFEST_PATHFILENAME = "sync_manifest.sqlite"     # Index des fichiers déjà uploadés par syncDirectory()
+
+METRICS_JSONL_PATHFILENAME = None  # Si précisé, les mesures de chaque chunk y sont ajoutées (une ligne JSON par évènement)
+METRICS_MAX_SESSIONS = 1000 # Nombre de sessions dont les totaux restent disponibles (getUploadMetrics)
+VERBOSE_CHUNKS = False      # Affiche dans la console une ligne par chunk envoyé
+GUI_POLL_PERIOD = 200       # Période (en ms) de lecture des évènements de l'upload en cours par l'interface
 
 verbose = True
 
@@ -81,6 +149,7 @@ def cb_getTokenId(root):
     root.text_token_id.set(_token_id)
 
 def cb_selectPathfileName(root):
+    import tkinter.filedialog
     root.pathfilename =  tkinter.filedialog.askopenfilename(initialdir = "/home",title = "Select file",filetypes = (("all files","*.*"), ("all files","*.*")))
     root.text_pathfilename.set(root.pathfilename)
     root.text_filename.set(os.path.basename(root.pathfilename))
@@ -88,9 +157,19 @@ def cb_selectPathfileName(root):
 def cb_startNewUpload(root):
     if (root.text_token_id.get() == ""):
         cb_getTokenId(root)
-    newResumableUpload(root.text_pathfilename.get(), root.text_filename.get(), root.text_token_id.get())
+    startUploadThread(root, uploadFile, root.text_pathfilename.get(), root.text_filename.get(), root.text_token_id.get())
+
+def cb_syncDirectory(root):
+    import tkinter.filedialog
+    _directory = tkinter.filedialog.askdirectory(initialdir = "/home",title = "Select directory")
+    if (not _directory):
+        return
+    if (root.text_token_id.get() == ""):
+        cb_getTokenId(root)
+    startUploadThread(root, syncDirectory, _directory, root.text_token_id.get())
 
 def cb_loadConfigFile(root):
+    import tkinter.filedialog
     _configPathfilename =  tkinter.filedialog.askopenfilename(initialdir = "/home",title = "Select file",filetypes = (("all files","*.ini"), ("all files","*.ini")))
     _pathfilename, _filename, _upload_id = readConfigFile(_configPathfilename)
     root.text_pathfilename.set(_pathfilename)
@@ -98,11 +177,96 @@ def cb_loadConfigFile(root):
     root.text_upload_id.set(_upload_id)
 
 def cb_resumeUpload(root):
-    resumeExistingUpload(root.text_pathfilename.get(), root.text_filename.get(), root.text_upload_id.get())
+    startUploadThread(root, resumeExistingUpload, root.text_pathfilename.get(), root.text_filename.get(), root.text_upload_id.get())
+
+def cb_resumeAllUploads(root):
+    startUploadThread(root, resumeUnfinishedUploads)
+
+def cb_selectUnfinishedUpload(root, event=None):
+    _entry = root.unfinished_uploads[root.combobox_unfinished.current()]
+    root.text_pathfilename.set(_entry["pathfilename"])
+    root.text_filename.set(_entry["filename"])
+    root.text_upload_id.set(_entry["upload_id"])
+
+def cb_pauseUpload(root):
+    if (root.upload_control is None):
+        return
+    if (root.upload_control.isPaused()):
+        root.upload_control.resume()
+        root.text_pause.set("Pause")
+    else:
+        root.upload_control.pause()
+        root.text_pause.set("Continue")
+
+def cb_cancelUpload(root):
+    if (root.upload_control is not None):
+        root.upload_control.cancel()
+        root.text_status.set("Annulation à la fin du chunk en cours...")
+
+# __________________________________________________________________
+# Exécution de l'upload en tâche de fond
+# L'upload est exécuté dans un thread séparé pour ne pas bloquer l'interface.
+#  Ce thread publie son avancement dans la file root.upload_events, que
+#  l'interface lit périodiquement (pollUploadEvents) depuis sa boucle principale.
+def startUploadThread(root, upload_function, *args):
+    if ( (root.upload_thread is not None) and root.upload_thread.is_alive() ):
+        log ("Un upload est déjà en cours")
+        return
+    root.upload_control = UploadControl()
+    root.upload_progress = None
+    root.upload_rate = 0.0
+    root.text_pause.set("Pause")
+    root.text_status.set("Upload en cours...")
+
+    def _progress(bytes_done, size):
+        root.upload_events.put(("progress", bytes_done, size))
+
+    def _run():
+        try:
+            upload_function(*args, progress_callback=_progress, control=root.upload_control)
+            root.upload_events.put(("done", "Transfert terminé"))
+        except UploadCancelled:
+            root.upload_events.put(("done", "Transfert annulé (il pourra être repris)"))
+        except Exception as e:
+            root.upload_events.put(("done", "Erreur : " + str(e)))
+
+    root.upload_thread = threading.Thread(target=_run, daemon=True)
+    root.upload_thread.start()
+
+# Lit les évènements publiés par le thread d'upload et met à jour l'interface
+def pollUploadEvents(root):
+    while True:
+        try:
+            _event = root.upload_events.get_nowait()
+        except queue.Empty:
+            break
+        if (_event[0] == "progress"):
+            updateUploadProgress(root, _event[1], _event[2])
+        elif (_event[0] == "done"):
+            root.text_status.set(_event[1])
+            root.upload_control = None
+    root.after(GUI_POLL_PERIOD, pollUploadEvents, root)
+
+# Met à jour la barre de progression, le débit (moyenne glissante) et le temps restant
+def updateUploadProgress(root, bytes_done, size):
+    _now = time.monotonic()
+    if (root.upload_progress is not None):
+        _last_time, _last_bytes = root.upload_progress
+        if ( (_now > _last_time) and (bytes_done >= _last_bytes) ):
+            _rate = (bytes_done - _last_bytes) / (_now - _last_time)
+            root.upload_rate = _rate if (root.upload_rate == 0.0) else (0.7 * root.upload_rate + 0.3 * _rate)
+    root.upload_progress = (_now, bytes_done)
+    root.progressbar["value"] = (float(bytes_done) / size * 100) if (size > 0) else 100.0
+    _text = "%.1f %%   %.2f Mo/s" % (root.progressbar["value"], root.upload_rate / 1e6)
+    if (root.upload_rate > 0):
+        _text = _text + "   reste " + str(datetime.timedelta(seconds=int((size - bytes_done) / root.upload_rate)))
+    root.text_status.set(_text)
 
 # __________________________________________________________________
 # Création de l'interface utilisateur
 def createGui(root):
+    import tkinter
+    from tkinter import ttk
     root.text_token_id = tkinter.StringVar(root)
     root.label_token_id = tkinter.Label(root, text='Token ID')
     root.entry_token_id = tkinter.Entry(root, textvariable=root.text_token_id)
@@ -121,9 +285,30 @@ def createGui(root):
     root.label_upload_id = tkinter.Label(root, text='Upload_id')
     root.entry_upload_id = tkinter.Entry(root, textvariable=root.text_upload_id)
 
+    root.unfinished_uploads = getUploadJournal().unfinished()
+    root.label_unfinished = tkinter.Label(root, text='Unfinished')
+    root.combobox_unfinished = ttk.Combobox(root, state='readonly',
+        values=[_entry["filename"] + " (" + str(_entry["committed"]) + "/" + str(_entry["size"]) + ")" for _entry in root.unfinished_uploads])
+    root.combobox_unfinished.bind('<<ComboboxSelected>>', partial(cb_selectUnfinishedUpload, root))
+    root.button_resumeAllUploads = tkinter.Button(root, text='Resume All', command=partial(cb_resumeAllUploads, root))
+
     root.button_loadConfigFile = tkinter.Button(root, text='Load Config File', command=partial(cb_loadConfigFile, root))
     root.button_startNewUpload = tkinter.Button(root, text='Start New Upload', command=partial(cb_startNewUpload, root))
     root.button_resumeUpload = tkinter.Button(root, text='Resume Upload', command=partial(cb_resumeUpload, root))
+    root.button_syncDirectory = tkinter.Button(root, text='Sync Directory', command=partial(cb_syncDirectory, root))
+
+    root.progressbar = ttk.Progressbar(root, orient='horizontal', mode='determinate', maximum=100)
+    root.text_status = tkinter.StringVar(root)
+    root.label_status = tkinter.Label(root, textvariable=root.text_status)
+    root.text_pause = tkinter.StringVar(root, value='Pause')
+    root.button_pauseUpload = tkinter.Button(root, textvariable=root.text_pause, command=partial(cb_pauseUpload, root))
+    root.button_cancelUpload = tkinter.Button(root, text='Cancel', command=partial(cb_cancelUpload, root))
+
+    root.upload_events = queue.Queue()
+    root.upload_thread = None
+    root.upload_control = None
+    root.upload_progress = None
+    root.upload_rate = 0.0
 
     _row = 0
     root.label_token_id.grid(row=_row, column=0)
@@ -143,21 +328,47 @@ def createGui(root):
     root.label_upload_id.grid(row=_row, column=0)
     root.entry_upload_id.grid(row=_row, column=1)
 
+    _row = _row + 1
+    root.label_unfinished.grid(row=_row, column=0)
+    root.combobox_unfinished.grid(row=_row, column=1)
+    root.button_resumeAllUploads.grid(row=_row, column=2)
+
     _row = _row + 1
     root.button_loadConfigFile.grid(row=_row, column=2)
 
     _row = _row + 1
     root.button_startNewUpload.grid(row=_row, column=0)
+    root.button_syncDirectory.grid(row=_row, column=1)
     root.button_resumeUpload.grid(row=_row, column=2)
 
+    _row = _row + 1
+    root.progressbar.grid(row=_row, column=0, columnspan=3, sticky='ew')
+
+    _row = _row + 1
+    root.label_status.grid(row=_row, column=0, columnspan=3)
+
+    _row = _row + 1
+    root.button_pauseUpload.grid(row=_row, column=0)
+    root.button_cancelUpload.grid(row=_row, column=2)
+
+    root.after(GUI_POLL_PERIOD, pollUploadEvents, root)
+
 # =================================================================
 # main
 # =================================================================
 
 def main():
+    # Liste les uploads inachevés, qui sont repris au lancement (RESUME_ON_STARTUP) ou depuis l'interface
+    _unfinished = getUploadJournal().unfinished()
+    for _entry in _unfinished:
+        log ("Upload inachevé : " + _entry["pathfilename"] + " (" + str(_entry["committed"]) + "/" + str(_entry["size"]) + " octets)")
+
     # Crée l'interface utilisateur
+    import tkinter
     root = tkinter.Tk()
     createGui(root)
+    if ( RESUME_ON_STARTUP and _unfinished ):
+        startUploadThread(root, resumeUnfinishedUploads)   # reprise après un arrêt brutal
     root.mainloop()
 
     # readConfigFile('upload_config_2018_09_01_10h05m00s.txt')
@@ -186,37 +397,562 @@ def main():
 
     #readConfigFile('upload_config_2018_09_01_10h05m00s.txt')
 
+# =================================================================
+# Ligne de commande
+# =================================================================
+# __________________________________________________________________
+# Point d'entrée sans interface graphique (serveurs, cron)
+#   python3 gdrive_upload_gui.py new <fichier> [--name <nom sur Drive>]
+#   python3 gdrive_upload_gui.py new - --name <nom sur Drive>      (entrée standard, ex : tar c rep | zstd | ...)
+#   python3 gdrive_upload_gui.py resume [<upload_id> | --config <fichier .ini>]
+#   python3 gdrive_upload_gui.py status [<upload_id>] [--check] [--json]
+#   python3 gdrive_upload_gui.py batch <fichier> [<fichier> ...] [--workers N]
+#   python3 gdrive_upload_gui.py sync <répertoire> [--workers N]
+# Options communes, avant ou après la commande : --journal, --token, --limit, --quiet
+# La sortie standard ne contient que le résultat de la commande (ex : métadonnées JSON) ;
+#  les messages de log sont écrits sur la sortie d'erreur, et le token n'est jamais affiché.
+# Sans argument, le script lance l'interface graphique (main).
+# Renvoie le code de sortie du processus : 0 si tout s'est bien passé, 1 sinon
+def cli(argv=None):
+    global verbose, JOURNAL_PATHFILENAME, BANDWIDTH_LIMIT, OAUTH_LOCAL_WEBSERVER
+    import argparse
+    _parser = argparse.ArgumentParser(prog="gdrive_upload_gui.py", description="Upload de fichiers vers Google Drive avec reprise")
+    _addCliCommonOptions(_parser)
+    # Les options communes sont aussi acceptées après la commande ; absentes, elles ne
+    #  remplacent pas celles données avant (argparse.SUPPRESS)
+    _common = argparse.ArgumentParser(add_help=False, argument_default=argparse.SUPPRESS)
+    _addCliCommonOptions(_common)
+    _commands = _parser.add_subparsers(dest="command", required=True)
+    _add = partial(_commands.add_parser, parents=[_common])
+    _command = _add("new", help="uploade un fichier, ou l'entrée standard (-)")
+    _command.add_argument("pathfilename", help="fichier à uploader, - pour l'entrée standard")
+    _command.add_argument("--name", help="nom du fichier sur Drive (nom local par défaut, obligatoire avec -)")
+    _command = _add("resume", help="reprend un upload, ou tous les uploads inachevés du journal")
+    _command.add_argument("upload_id", nargs="?")
+    _command.add_argument("--config", help="ancien fichier de configuration .ini")
+    _command = _add("status", help="affiche l'état des uploads du journal")
+    _command.add_argument("upload_id", nargs="?")
+    _command.add_argument("--check", action="store_true", help="interroge Drive sur l'état de chaque session inachevée")
+    _command.add_argument("--all", action="store_true", help="affiche aussi les uploads terminés")
+    _command.add_argument("--json", action="store_true", help="une ligne JSON par session")
+    _command = _add("batch", help="uploade plusieurs fichiers en parallèle")
+    _command.add_argument("pathfilenames", nargs="+")
+    _command.add_argument("--workers", type=int, default=UPLOAD_WORKERS)
+    _command = _add("sync", help="uploade les fichiers nouveaux ou modifiés d'un répertoire")
+    _command.add_argument("directory")
+    _command.add_argument("--workers", type=int, default=UPLOAD_WORKERS)
+    _args = _parser.parse_args(argv)
+
+    if (_args.quiet):
+        verbose = False
+    if (_args.journal is not None):
+        JOURNAL_PATHFILENAME = _args.journal
+    if (_args.limit is not None):
+        BANDWIDTH_LIMIT = _args.limit
+    OAUTH_LOCAL_WEBSERVER = False    # pas de navigateur sur un serveur
+    try:
+        return _cliCommands[_args.command](_args)
+    except (UploadError, UploadCancelled, FileChangedError, OSError) as e:
+        print("Erreur : " + str(e), file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        print("Interrompu : l'upload pourra être repris (resume)", file=sys.stderr)
+        return 1
+
+# Options acceptées avant comme après la commande
+def _addCliCommonOptions(parser):
+    parser.add_argument("--journal", help="journal des sessions d'upload (" + JOURNAL_PATHFILENAME + " par défaut)")
+    parser.add_argument("--token", help="token id (sinon obtenu depuis " + OAUTH_TOKEN_PATHFILENAME + ")")
+    parser.add_argument("--limit", type=float, help="débit maximal en octets/s")
+    parser.add_argument("--quiet", action="store_true", help="n'affiche pas les messages de log (verbose = False)")
+
+def _cliTokenId(args):
+    return args.token if (args.token is not None) else createTokenId()
+
+# L'entrée standard est envoyée comme un flux (voir newStreamingUpload) : elle ne peut pas être reprise
+def _cliNew(args):
+    if (args.pathfilename == "-"):
+        if (args.name is None):
+            print("Erreur : --name est obligatoire pour uploader l'entrée standard", file=sys.stderr)
+            return 1
+        _metadata = {}
+        newStreamingUpload(sys.stdin.buffer, args.name, _cliTokenId(args), metadata=_metadata)
+    else:
+        _filename = os.path.basename(args.pathfilename) if (args.name is None) else args.name
+        _metadata = uploadFile(args.pathfilename, _filename, _cliTokenId(args))
+    print(json.dumps(_metadata))
+    return 0
+
+def _cliResume(args):
+    if (args.config is not None):
+        resumeFromConfigFile(args.config)
+        return 0
+    if (args.upload_id is None):
+        _resumed = resumeUnfinishedUploads()
+        _unfinished = getUploadJournal().unfinished()
+        print(str(len(_resumed)) + " upload(s) repris, " + str(len(_unfinished)) + " inachevé(s)")
+        return 0 if (not _unfinished) else 1
+    _entry = getUploadJournal().get(args.upload_id)
+    if (_entry is None):
+        print("Upload inconnu du journal : " + args.upload_id, file=sys.stderr)
+        return 1
+    resumeExistingUpload(_entry["pathfilename"], _entry["filename"], args.upload_id)
+    return 0
+
+# Lit le journal sans importer requests : seul --check interroge Drive
+def _cliStatus(args):
+    _journal = getUploadJournal()
+    if (args.upload_id is not None):
+        _entries = [_entry for _entry in [_journal.get(args.upload_id)] if (_entry is not None)]
+    elif (args.all):
+        _entries = _journal.sessions()
+    else:
+        _entries = _journal.unfinished()
+    for _entry in _entries:
+        _entry["file_changed"] = _journal.fileChanged(_entry)
+        if ( args.check and (not _entry["complete"]) ):
+            try:
+                _status, _start, _end = checkUploadComplete(_entry["upload_id"])
+                _entry["server"] = "complete" if _status else ("received " + str(0 if (_end == 0) else (_end + 1)))
+            except SessionExpiredError:
+                _entry["server"] = "expired"
+            except TransientUploadError as e:
+                _entry["server"] = "error: " + str(e)
+        if (args.json):
+            print(json.dumps(_entry))
+        else:
+            _state = "terminé" if _entry["complete"] else ("modifié" if _entry["file_changed"] else "inachevé")
+            print(_entry["upload_id"] + "  " + _state + "  " + str(_entry["committed"]) + "/" + str(_entry["size"])
+                  + "  " + _entry["pathfilename"] + (("  [Drive : " + _entry["server"] + "]") if ("server" in _entry) else ""))
+    if ( (args.upload_id is not None) and (not _entries) ):
+        print("Upload inconnu du journal : " + args.upload_id, file=sys.stderr)
+        return 1
+    return 0
+
+def _cliBatch(args):
+    _jobs = batchUpload([(_pathfilename, os.path.basename(_pathfilename)) for _pathfilename in args.pathfilenames],
+                        _cliTokenId(args), args.workers)
+    for _job in _jobs:
+        print(_job.status + "  " + _job.pathfilename)
+    return 0 if all(_job.status == "done" for _job in _jobs) else 1
+
+def _cliSync(args):
+    _report = syncDirectory(args.directory, _cliTokenId(args), args.workers)
+    print(json.dumps(_report))
+    return 0 if (_report.get("files_failed", 0) == 0) else 1
+
+_cliCommands = {"new": _cliNew, "resume": _cliResume, "status": _cliStatus, "batch": _cliBatch, "sync": _cliSync}
+
 # =================================================================
 # Main API 
 # =================================================================
 
+# __________________________________________________________________
+# Uploade un fichier en choisissant la méthode selon sa taille :
+#  - en dessous de SIMPLE_UPLOAD_THRESHOLD, une seule requête (initiateSimpleUpload)
+#  - au-delà, un upload avec reprise (newResumableUpload)
+# Si DEDUP_ENABLED, le transfert est évité lorsque Drive contient déjà le même contenu
+# Renvoie les métadonnées du fichier sur Drive
+def uploadFile(pathfilename, filename, token_id, progress_callback=None, control=None):
+    _size = getFileSize(pathfilename)
+    if (control is not None):
+        control.checkpoint()
+    _metadata = findDuplicateUpload(pathfilename, filename, token_id) if DEDUP_ENABLED else None
+    if (_metadata is not None):
+        if (progress_callback is not None):
+            progress_callback(_size, _size)
+        return _metadata
+    if ( SPARSE_IMAGE_MODE and isDiskImage(pathfilename) ):
+        _metadata = newSparseImageUpload(pathfilename, filename, token_id, progress_callback, control)
+    elif (_size < SIMPLE_UPLOAD_THRESHOLD):
+        _metadata = initiateSimpleUpload(pathfilename, filename, token_id)
+        if (progress_callback is not None):
+            progress_callback(_size, _size)
+    else:
+        _metadata = newResumableUpload(pathfilename, filename, token_id, progress_callback, control)
+    if (DEDUP_ENABLED):
+        getDriveContentIndex(token_id).add(_metadata)
+    return _metadata
+
 # __________________________________________________________________
 # Lance un nouveau téléchargement avec possibilité de reprise
-def newResumableUpload(pathfilename, filename, token_id):
-    _upload_id = initiateNewResumableUpload(pathfilename, filename, token_id)
-    saveConfigToFile(pathfilename, filename, _upload_id)
-    resumeExistingUpload(pathfilename, filename, _upload_id)
+# Renvoie les métadonnées du fichier sur Drive
+def newResumableUpload(pathfilename, filename, token_id, progress_callback=None, control=None, file_id=None):
+    _upload_id = initiateNewResumableUpload(pathfilename, filename, token_id, file_id)
+    getUploadJournal().begin(pathfilename, filename, _upload_id)
+    return resumeExistingUpload(pathfilename, filename, _upload_id, progress_callback=progress_callback, control=control)
 
 # __________________________________________________________________
 # Reprend un téléchargement interrompu
-def resumeExistingUpload(pathfilename, filename, upload_id):
-    _status, _start, _end = checkUploadComplete(upload_id)
-    if ( (_start == 0) and (_end == 0) ):   # cas où aucun octet n'a été transféré
-        _start_byte = 0
-    else :     
-        _start_byte = _end + 1
-    while (_status == False) :
-        _status, _start, _end = resumeUpload(pathfilename, filename, upload_id, _start_byte, CHUNK_SIZE)
-        print (_status)
-        _file_size = getFileSize(pathfilename)
-        _percent = float(_end)/float(_file_size) * 100
-        print("Le octets déja transférés sont : " + str(_start) + "-" + str(_end))
-        print("Transfert réalisé à " + str(_percent) + "%")
+# chunk_size : si précisé, fige la taille des chunks (sinon taille adaptative si ADAPTIVE_CHUNK_SIZE)
+# progress_callback : fonction optionnelle appelée après chaque chunk avec (octets transférés, taille totale)
+# control : UploadControl optionnel permettant de suspendre ou d'annuler l'upload entre deux chunks
+# Si VERIFY_MD5, l'empreinte MD5 du fichier est calculée au fil de l'envoi puis comparée à celle
+#  renvoyée par Drive : une différence lève ChecksumMismatchError.
+# retry : RetryPolicy optionnelle appliquée aux erreurs temporaires
+# Si le journal indique qu'aucun chunk n'était en cours d'envoi lors de l'arrêt, l'octet de reprise
+#  est lu dans le journal, sans interroger le serveur.
+# Après une erreur temporaire, la plage d'octets reçue par le serveur est relue (checkUploadComplete)
+#  et l'envoi reprend à partir de là. Une session expirée lève SessionExpiredError.
+# Renvoie les métadonnées du fichier renvoyées par Drive à la fin de l'upload (vide si elles ne sont pas connues)
+def resumeExistingUpload(pathfilename, filename, upload_id, chunk_size=None, progress_callback=None, control=None, retry=None):
+    _retry = RetryPolicy() if (retry is None) else retry
+    _journal = getUploadJournal()
+    _entry = _journal.get(upload_id)
+    if ( (_entry is not None) and (_entry["encoding"] is not None) ):   # image disque envoyée compressée
+        return resumeSparseImageUpload(pathfilename, filename, upload_id, chunk_size, progress_callback, control, _retry)
+    if (_entry is None):    # session inconnue du journal (ex : reprise depuis un ancien fichier .ini)
+        _journal.begin(pathfilename, filename, upload_id)
+    elif (_journal.fileChanged(_entry)):
+        raise FileChangedError(pathfilename + " a été modifié depuis le début de l'upload " + upload_id)
+    elif (_entry["complete"]):
+        log ("Le journal indique que l'upload " + upload_id + " est déjà terminé")
+        return {}
+    if ( (_entry is not None) and (not _entry["in_flight"]) ):
+        _status = False
+        _start_byte = _entry["committed"]
+    else:
+        _status, _start, _end = _retry.run(checkUploadComplete, upload_id)
         if ( (_start == 0) and (_end == 0) ):   # cas où aucun octet n'a été transféré
             _start_byte = 0
         else :     
             _start_byte = _end + 1
-    print ("Transfert terminé")
+    if (chunk_size is not None):
+        _sizer = ChunkSizer(initial=chunk_size, fixed=True)
+    else:
+        _sizer = ChunkSizer(fixed=not ADAPTIVE_CHUNK_SIZE)
+    _metadata = {}
+    _hasher = _journal.getHasher(upload_id) if VERIFY_MD5 else None
+    with FileSource(pathfilename) as _source, \
+         ChunkPrefetcher(_source, on_read=None if (_hasher is None) else partial(_hasher.onRead, _source)) as _prefetcher:
+        _metrics = startUploadMetrics(upload_id, filename, _source.size, _start_byte)
+        while (_status == False) :
+            if (control is not None):
+                control.checkpoint()
+            _expected = min(_sizer.size, _source.size - _start_byte)
+            _prefetcher.schedule(_start_byte + _expected, _sizer.size)
+            _journal.update(upload_id, _start_byte, in_flight=True)
+            _retries = _retry.retries
+            _read_time = _prefetcher.read_time
+            _time_start = time.monotonic()
+            try:
+                _status, _start, _end = resumeUpload(pathfilename, filename, upload_id, _start_byte, _sizer.size, _source, _metadata)
+                _latency = time.monotonic() - _time_start
+                _success = _status or (_end >= _start_byte + _expected - 1)
+                _retry.reset()
+            except TransientUploadError as e:
+                _latency = time.monotonic() - _time_start
+                _retry.backoff(e)
+                _status, _start, _end = _retry.run(checkUploadComplete, upload_id, _metadata)   # octets réellement reçus
+                if (_status):
+                    _end = _source.size - 1
+                _success = False
+            _duration = time.monotonic() - _time_start
+            _sizer.record(_expected, _duration, _success)
+            _chunk_start = _start_byte
+            if (_status):
+                _start_byte = _source.size
+            elif ( (_start == 0) and (_end == 0) ):   # cas où aucun octet n'a été transféré
+                _start_byte = 0
+            else :     
+                _start_byte = _end + 1
+            _metrics.record(_chunk_start, _expected, _start_byte - _chunk_start, _latency, _duration,
+                            _prefetcher.read_time - _read_time, _retry.retries - _retries)
+            _source.discard(_chunk_start, _start_byte)     # octets acquittés : pages retirées de la mémoire
+            if (not _status):
+                if ( (_hasher is not None) and (_prefetcher.depth == 0) ):
+                    _hasher.follow(_source, _chunk_start, _start_byte)
+                _journal.update(upload_id, _start_byte, in_flight=False)
+            if (progress_callback is not None):
+                progress_callback(_start_byte, _source.size)
+        _md5 = None
+        if (_hasher is not None):
+            _hasher.advance(_source, _source.size)
+            _md5 = _hasher.hexdigest()
+    _journal.complete(upload_id, _md5)
+    _metrics.finish()
+    log ("Transfert terminé")
+    if ( (_md5 is not None) and ("md5Checksum" in _metadata) ):
+        if (_metadata["md5Checksum"] != _md5):
+            raise ChecksumMismatchError("Empreinte MD5 différente : locale " + _md5 + ", Drive " + _metadata["md5Checksum"])
+        log ("Empreinte MD5 vérifiée : " + _md5)
+    return _metadata
+
+# __________________________________________________________________
+# Uploade un flux de taille inconnue (ex : sys.stdin.buffer, sortie de "tar | zstd")
+# stream : objet fichier (méthode read) ou itérable de bytes
+# Les chunks sont envoyés avec la plage "bytes a-b/*" ; la taille totale n'est
+#  annoncée qu'avec le dernier chunk, une fois la fin du flux atteinte.
+# Seules les données pas encore acquittées par le serveur sont conservées en mémoire
+#  (un peu plus d'un chunk), ce qui permet de les renvoyer après une erreur temporaire.
+#  Un flux ne peut en revanche pas être repris après l'arrêt du processus.
+# progress_callback : appelée avec (octets transférés, None) puisque la taille totale est inconnue
+# metadata : dictionnaire optionnel, complété à la fin de l'upload par les métadonnées du fichier renvoyées par Drive
+# Renvoie l'identifiant de la session d'upload
+def newStreamingUpload(stream, filename, token_id, mime_type=None, chunk_size=None,
+                       progress_callback=None, control=None, retry=None, metadata=None):
+    _retry = RetryPolicy() if (retry is None) else retry
+    _chunk_size = max(CHUNK_GRANULARITY, roundChunkSize(CHUNK_SIZE if (chunk_size is None) else chunk_size))
+    _mime_type = filenameToMimeType(filename) if (mime_type is None) else mime_type
+    _upload_id = initiateResumableSession(filename, token_id, _mime_type, retry=_retry)
+    _reader = StreamReader(stream)
+    _buffer = bytearray()   # données pas encore acquittées
+    _offset = 0             # position de _buffer[0] dans le flux
+    _eof = False
+    _md5 = hashlib.md5()
+    _metadata = {} if (metadata is None) else metadata
+    _metrics = startUploadMetrics(_upload_id, filename, None)
+    _status = False
+    while (_status == False):
+        if (control is not None):
+            control.checkpoint()
+        # Lit un octet de plus qu'un chunk pour savoir si le chunk est le dernier
+        while ( (not _eof) and (len(_buffer) <= _chunk_size) ):
+            _data = _reader.read(_chunk_size + 1 - len(_buffer))
+            if (not _data):
+                _eof = True
+            else:
+                _buffer.extend(_data)
+        _total = (_offset + len(_buffer)) if _eof else None
+        _size = len(_buffer) if _eof else _chunk_size
+        _retries = _retry.retries
+        _time_start = time.monotonic()
+        try:
+            with memoryview(_buffer)[:_size] as _view:
+                _status, _start, _end = putChunk(_upload_id, _view, _offset, _total, _mime_type, _metadata)
+            _latency = time.monotonic() - _time_start
+            _retry.reset()
+        except TransientUploadError as e:
+            _latency = time.monotonic() - _time_start
+            _retry.backoff(e)
+            _status, _start, _end = _retry.run(checkUploadComplete, _upload_id, _metadata)
+        if (_status):
+            _committed = _offset + len(_buffer)
+        elif ( (_start == 0) and (_end == 0) ):   # cas où aucun octet n'a été transféré
+            _committed = 0
+        else:
+            _committed = _end + 1
+        _md5.update(_buffer[:_committed - _offset])
+        del _buffer[:_committed - _offset]
+        _metrics.record(_offset, _size, _committed - _offset, _latency, time.monotonic() - _time_start,
+                        0.0, _retry.retries - _retries)
+        _offset = _committed
+        if (progress_callback is not None):
+            progress_callback(_offset, None)
+    _metrics.finish(_offset)
+    log ("Transfert terminé : " + str(_offset) + " octets")
+    if ( VERIFY_MD5 and ("md5Checksum" in _metadata) ):
+        if (_metadata["md5Checksum"] != _md5.hexdigest()):
+            raise ChecksumMismatchError("Empreinte MD5 différente : locale " + _md5.hexdigest() + ", Drive " + _metadata["md5Checksum"])
+        log ("Empreinte MD5 vérifiée : " + _md5.hexdigest())
+    return _upload_id
+
+# __________________________________________________________________
+# Uploade une image disque (".img") compressée au format gzip (voir GzipImageEncoder)
+# Le fichier est nommé filename + ".gz" sur Drive. Les blocs vides (trous du fichier ou
+#  blocs de zéros) ne sont pas compressés mais remplacés par un bloc compressé une fois pour toutes.
+# Renvoie les métadonnées du fichier sur Drive
+def newSparseImageUpload(pathfilename, filename, token_id, progress_callback=None, control=None, file_id=None):
+    _filename = filename if filename.endswith(".gz") else (filename + ".gz")
+    _upload_id = initiateResumableSession(_filename, token_id, "application/gzip", file_id=file_id)
+    getUploadJournal().begin(pathfilename, _filename, _upload_id, encoding=GzipImageEncoder(pathfilename).encoding)
+    return resumeSparseImageUpload(pathfilename, _filename, _upload_id, progress_callback=progress_callback, control=control)
+
+# __________________________________________________________________
+# Reprend l'upload compressé d'une image disque
+# La taille compressée n'est pas connue à l'avance : les chunks sont envoyés avec la plage
+#  "bytes a-b/*", comme pour newStreamingUpload(). Chaque bloc de SPARSE_BLOCK_SIZE octets de
+#  l'image donne un membre gzip indépendant, et la compression est déterministe : le journal
+#  mémorise le dernier début de bloc entièrement acquitté (octet de l'image et octet compressé),
+#  à partir duquel la compression est refaite pour reprendre à l'octet compressé reçu par Drive.
+# L'empreinte MD5 (celle du fichier compressé) n'est vérifiée que si l'envoi a commencé dans ce processus.
+# Renvoie les métadonnées du fichier renvoyées par Drive à la fin de l'upload (vide si elles ne sont pas connues)
+def resumeSparseImageUpload(pathfilename, filename, upload_id, chunk_size=None, progress_callback=None, control=None, retry=None):
+    _retry = RetryPolicy() if (retry is None) else retry
+    _journal = getUploadJournal()
+    _entry = _journal.get(upload_id)
+    _encoder = GzipImageEncoder(pathfilename)
+    if (_entry is None):
+        raise UploadError("L'upload " + upload_id + " est inconnu du journal : la compression ne peut pas être reprise")
+    if (_journal.fileChanged(_entry)):
+        raise FileChangedError(pathfilename + " a été modifié depuis le début de l'upload " + upload_id)
+    if (_entry["complete"]):
+        log ("Le journal indique que l'upload " + upload_id + " est déjà terminé")
+        return {}
+    if (_entry["encoding"] != _encoder.encoding):
+        raise UploadError("Compression différente de celle du début de l'upload " + upload_id + " (" + _entry["encoding"] + ")")
+    _chunk_size = max(CHUNK_GRANULARITY, roundChunkSize(CHUNK_SIZE if (chunk_size is None) else chunk_size))
+    _metadata = {}
+    _status, _start, _end = _retry.run(checkUploadComplete, upload_id, _metadata)
+    if (_status):
+        _journal.complete(upload_id)
+        return _metadata
+    _received = 0 if ( (_start == 0) and (_end == 0) ) else (_end + 1)
+    _checkpoint = (_entry["committed"], _entry["checkpoint"])   # (octet de l'image, octet compressé)
+    if (_received < _checkpoint[1]):
+        raise UploadError("Drive a reçu moins d'octets (" + str(_received) + ") que le point de reprise du journal")
+    _members = _encoder.members(_checkpoint[0])
+    _boundaries = collections.deque()   # débuts de bloc dans le flux compressé : (octet de l'image, octet compressé)
+    _buffer = bytearray()   # données compressées pas encore acquittées
+    _offset = _checkpoint[1]    # position de _buffer[0] dans le flux compressé
+    _eof = False
+    _md5 = hashlib.md5() if ( VERIFY_MD5 and (_received == 0) ) else None
+    _metrics = startUploadMetrics(upload_id, filename, None, _received)
+    while (_status == False):
+        if (control is not None):
+            control.checkpoint()
+        while ( (not _eof) and (len(_buffer) <= _chunk_size) ):
+            _member = next(_members, None)
+            if (_member is None):
+                _eof = True
+                break
+            _buffer.extend(_member[1])
+            _boundaries.append((_member[0], _offset + len(_buffer)))
+            if (_offset < _received):   # octets déjà reçus par Drive avant la reprise
+                _skip = min(_received - _offset, len(_buffer))
+                del _buffer[:_skip]
+                _offset = _offset + _skip
+        _total = (_offset + len(_buffer)) if _eof else None
+        _size = len(_buffer) if _eof else _chunk_size
+        _retries = _retry.retries
+        _time_start = time.monotonic()
+        try:
+            with memoryview(_buffer)[:_size] as _view:
+                _status, _start, _end = putChunk(upload_id, _view, _offset, _total, "application/gzip", _metadata)
+            _latency = time.monotonic() - _time_start
+            _retry.reset()
+        except TransientUploadError as e:
+            _latency = time.monotonic() - _time_start
+            _retry.backoff(e)
+            _status, _start, _end = _retry.run(checkUploadComplete, upload_id, _metadata)
+        if (_status):
+            _committed = _offset + len(_buffer)
+        elif ( (_start == 0) and (_end == 0) ):   # cas où aucun octet n'a été transféré
+            _committed = 0
+        else:
+            _committed = _end + 1
+        if (_md5 is not None):
+            _md5.update(_buffer[:_committed - _offset])
+        del _buffer[:_committed - _offset]
+        _metrics.record(_offset, _size, _committed - _offset, _latency, time.monotonic() - _time_start,
+                        0.0, _retry.retries - _retries)
+        _offset = _committed
+        while ( _boundaries and (_boundaries[0][1] <= _committed) ):
+            _checkpoint = _boundaries.popleft()
+        if (not _status):
+            _journal.checkpoint(upload_id, _checkpoint[0], _checkpoint[1])
+        if (progress_callback is not None):
+            progress_callback(_entry["size"] if _status else _checkpoint[0], _entry["size"])
+    _journal.complete(upload_id, None if (_md5 is None) else _md5.hexdigest())
+    _metrics.finish(_offset)
+    log ("Transfert terminé : " + str(_entry["size"]) + " octets compressés en " + str(_offset) + " octets")
+    if ( (_md5 is not None) and ("md5Checksum" in _metadata) ):
+        if (_metadata["md5Checksum"] != _md5.hexdigest()):
+            raise ChecksumMismatchError("Empreinte MD5 différente : locale " + _md5.hexdigest() + ", Drive " + _metadata["md5Checksum"])
+        log ("Empreinte MD5 vérifiée : " + _md5.hexdigest())
+    return _metadata
+
+# __________________________________________________________________
+# Reprend toutes les sessions inachevées mémorisées dans le journal
+# Les fichiers modifiés depuis le début de leur session sont ignorés
+# L'échec d'une session (erreur de Drive, empreinte différente, fichier illisible...) est signalé
+#  dans le log et n'empêche pas la reprise des suivantes ; seule l'annulation (control) les arrête.
+# Renvoie la liste des upload_id repris jusqu'au bout
+def resumeUnfinishedUploads(progress_callback=None, control=None):
+    _journal = getUploadJournal()
+    _resumed = []
+    for _entry in _journal.unfinished():
+        if (_journal.fileChanged(_entry)):
+            log (_entry["pathfilename"] + " a été modifié depuis le début de l'upload : reprise impossible")
+            continue
+        log ("Reprise de l'upload de " + _entry["pathfilename"])
+        try:
+            resumeExistingUpload(_entry["pathfilename"], _entry["filename"], _entry["upload_id"],
+                                 progress_callback=progress_callback, control=control)
+        except SessionExpiredError:
+            log ("La session de " + _entry["pathfilename"] + " a expiré : elle est retirée du journal")
+            _journal.forget(_entry["upload_id"])
+            continue
+        except (UploadError, FileChangedError, OSError) as e:
+            log ("Echec de la reprise de " + _entry["pathfilename"] + " : " + str(e))
+            continue
+        _resumed.append(_entry["upload_id"])
+    return _resumed
+
+# __________________________________________________________________
+# Pilotage d'un upload en cours depuis un autre thread (ex : l'interface)
+# La pause et l'annulation prennent effet entre deux chunks. Un upload annulé
+#  reste une session valide qui peut être reprise plus tard.
+class UploadCancelled(Exception):
+    pass
+
+class UploadControl:
+    def __init__(self):
+        self._running = threading.Event()
+        self._running.set()
+        self._cancelled = False
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def cancel(self):
+        self._cancelled = True
+        self._running.set()     # débloque un upload en pause pour qu'il s'arrête
+
+    def isPaused(self):
+        return not self._running.is_set()
+
+    # Appelé par l'upload entre deux chunks : bloque tant que l'upload est en pause,
+    #  lève UploadCancelled s'il a été annulé
+    def checkpoint(self):
+        self._running.wait()
+        if (self._cancelled):
+            raise UploadCancelled()
+
+# __________________________________________________________________
+# Calcule la taille des chunks au fil de l'upload
+# En mode adaptatif, la taille est recalculée après chaque chunk à partir du débit
+#  mesuré, pour que l'envoi d'un chunk dure environ CHUNK_TARGET_DURATION secondes.
+#  Cette durée visée est réduite lorsque les échecs sont fréquents, et la taille
+#  est divisée par 2 à chaque échec. La taille reste toujours un multiple de
+#  CHUNK_GRANULARITY, comprise entre min_size et max_size.
+# fixed=True : la taille reste figée à la valeur initiale
+class ChunkSizer:
+    def __init__(self, initial=None, min_size=None, max_size=None, fixed=False, target_duration=None):
+        # valeurs par défaut lues à l'appel, pour tenir compte d'une modification des constantes
+        initial = CHUNK_SIZE if (initial is None) else initial
+        min_size = CHUNK_SIZE_MIN if (min_size is None) else min_size
+        max_size = CHUNK_SIZE_MAX if (max_size is None) else max_size
+        target_duration = CHUNK_TARGET_DURATION if (target_duration is None) else target_duration
+        self.min_size = max(CHUNK_GRANULARITY, roundChunkSize(min_size))
+        self.max_size = max(self.min_size, roundChunkSize(max_size))
+        self.fixed = fixed
+        self.target_duration = target_duration
+        self.failure_rate = 0.0     # moyenne glissante du taux d'échec
+        if (fixed):
+            self.size = max(CHUNK_GRANULARITY, roundChunkSize(initial))
+        else:
+            self.size = self._bound(initial)
+
+    def _bound(self, size):
+        return min(self.max_size, max(self.min_size, roundChunkSize(size)))
+
+    # Enregistre le résultat de l'envoi d'un chunk de nbytes octets en duration secondes
+    def record(self, nbytes, duration, success):
+        self.failure_rate = 0.8 * self.failure_rate + (0.0 if success else 0.2)
+        if (self.fixed):
+            return
+        if (not success):
+            self.size = self._bound(self.size // 2)
+            return
+        if ( (duration <= 0) or (nbytes <= 0) ):
+            return
+        _throughput = nbytes / duration
+        _target = _throughput * self.target_duration * (1.0 - self.failure_rate)
+        self.size = self._bound(min(_target, self.size * 2))   # croissance limitée à x2 par chunk
 
 # __________________________________________________________________
 # Reprend un téléchargement interrompu à partir des informations contenues 
@@ -226,42 +962,1171 @@ def resumeFromConfigFile(cfg_pathfilename):
     _pathfilename, _filename, _upload_id = readConfigFile(cfg_pathfilename)
     resumeExistingUpload(_pathfilename, _filename, _upload_id)
 
+# =================================================================
+# Client HTTP
+# =================================================================
+# __________________________________________________________________
+# Client HTTP partagé par toutes les requêtes d'upload
+# Il conserve un pool de connexions keep-alive : les chunks successifs d'un même
+#  upload réutilisent la même connexion TCP/TLS au lieu de refaire un handshake
+#  à chaque requête.
+# base_url : adresse du serveur de l'API (API_BASE_URL par défaut)
+class UploadClient:
+    def __init__(self, pool_size=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT, base_url=None, credentials=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.base_url = API_BASE_URL if (base_url is None) else base_url.rstrip("/")
+        self.credentials = credentials   # CredentialProvider, par défaut celui de createTokenId s'il existe
+        import requests
+        self.session = requests.Session()
+        _adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", _adapter)
+        self.session.mount("http://", _adapter)
+
+    # Renvoie l'URL complète d'un chemin de l'API (ex : "/upload/drive/v3/files")
+    def url(self, path):
+        return self.base_url + path
+
+    # Les coupures de connexion et les timeouts sont signalés par TransientUploadError
+    #  (processed indique si le serveur a pu recevoir et traiter la requête malgré l'erreur)
+    # Avec un CredentialProvider, l'entête Authorization est renseigné avec un token valide à chaque
+    #  requête, et une requête refusée (401) est renvoyée une fois après renouvellement du token
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        _credentials = self.credentials if (self.credentials is not None) else _credential_provider
+        if (_credentials is not None):
+            kwargs["headers"] = dict(kwargs.get("headers") or {})
+            kwargs["headers"]["Authorization"] = "Bearer " + _credentials.accessToken()
+        r = self._send(method, url, kwargs)
+        _data = kwargs.get("data")
+        if ( (r.status_code == 401) and (_credentials is not None) and ( (_data is None) or hasattr(_data, "__len__") ) ):
+            log ("Token refusé, renouvellement")
+            kwargs["headers"]["Authorization"] = "Bearer " + _credentials.accessToken(force_refresh=True)
+            r = self._send(method, url, kwargs)
+        return r
+
+    def _send(self, method, url, kwargs):
+        import requests
+        import urllib3
+        try:
+            return self.session.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            # échec de l'établissement de la connexion : rien n'a été envoyé au serveur
+            _connect_failed = ( isinstance(e, requests.exceptions.ConnectTimeout) or
+                                isinstance(getattr(e.args[0] if e.args else None, "reason", None),
+                                           urllib3.exceptions.ConnectTimeoutError) )
+            raise TransientUploadError("Erreur de connexion : " + str(e), processed=not _connect_failed)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+_upload_client = None
+_upload_client_lock = threading.Lock()
+_upload_client_local = threading.local()    # client propre au thread courant (voir usingUploadClient)
+
+# Renvoie le client HTTP du thread courant, ou à défaut le client par défaut (créé au premier appel)
+def getUploadClient():
+    global _upload_client
+    _client = getattr(_upload_client_local, "client", None)
+    if (_client is not None):
+        return _client
+    with _upload_client_lock:
+        if (_upload_client is None):
+            _upload_client = UploadClient()
+        return _upload_client
+
+# Remplace le client HTTP par défaut (ex : pour changer la taille du pool ou les timeouts)
+def setUploadClient(client):
+    global _upload_client
+    with _upload_client_lock:
+        if (_upload_client is not None) and (_upload_client is not client):
+            _upload_client.close()
+        _upload_client = client
+
+# Fait utiliser client par les requêtes du thread courant le temps du bloc with,
+#  sans toucher au client par défaut (ex : workers d'une UploadQueue)
+@contextlib.contextmanager
+def usingUploadClient(client):
+    _previous = getattr(_upload_client_local, "client", None)
+    _upload_client_local.client = client
+    try:
+        yield client
+    finally:
+        _upload_client_local.client = _previous
+
+# =================================================================
+# Limitation du débit
+# =================================================================
+# __________________________________________________________________
+# Limiteur de débit partagé par toutes les sessions d'upload du processus (token bucket)
+# Le débit global (rate, ou la plage horaire courante de profiles) est réparti équitablement
+#  entre les sessions en cours d'envoi d'un corps de requête : une session limitée par
+#  session_cap en dessous de sa part laisse le reste aux autres.
+# Le corps des requêtes est envoyé par blocs de BANDWIDTH_SLICE octets, chacun prélevé dans
+#  le seau de sa session : le débit reste régulier à l'intérieur d'un chunk.
+# Les paramètres à None suivent BANDWIDTH_LIMIT, BANDWIDTH_SESSION_CAP et BANDWIDTH_PROFILES.
+# Un débit (ou un débit de session) de 0 suspend les envois : le débit est relu toutes les
+#  PAUSE_PERIOD secondes jusqu'au changement de plage horaire ou de configuration.
+class BandwidthLimiter:
+    BURST_DURATION = 0.25   # volume pouvant être envoyé d'un coup, en secondes de débit
+    PAUSE_PERIOD = 5.0      # intervalle (en secondes) entre deux relectures du débit pendant une suspension
+
+    def __init__(self, rate=None, session_cap=None, profiles=None):
+        self.rate = rate
+        self.session_cap = session_cap
+        self.profiles = profiles
+        self._sessions = {}     # clé -> [jetons, date de remplissage, débit maximal propre, en cours d'envoi]
+        self._lock = threading.Lock()
+
+    # Débit global actuel (octets/s), None si illimité
+    def currentRate(self, now=None):
+        _profiles = BANDWIDTH_PROFILES if (self.profiles is None) else self.profiles
+        _now = datetime.datetime.now() if (now is None) else now
+        _minutes = _now.hour * 60 + _now.minute
+        for _start, _end, _rate in _profiles:
+            _start = self._minutes(_start)
+            _end = self._minutes(_end)
+            if ( ((_start <= _end) and (_start <= _minutes < _end)) or
+                 ((_start > _end) and ((_minutes >= _start) or (_minutes < _end))) ):   # plage qui passe minuit
+                return _rate
+        return BANDWIDTH_LIMIT if (self.rate is None) else self.rate
+
+    # Heure "H:MM" ou "HH:MM" en minutes depuis minuit
+    @staticmethod
+    def _minutes(hour):
+        _hours, _minutes = hour.split(":")
+        return int(_hours) * 60 + int(_minutes)
+
+    # Fixe le débit maximal d'une session (None : BANDWIDTH_SESSION_CAP)
+    def setSessionCap(self, key, rate):
+        with self._lock:
+            self._session(key, time.monotonic())[2] = rate
+
+    # Renvoie le corps data (bytes, memoryview ou itérable de blocs) envoyé au débit de la session key
+    # Si les envois sont suspendus (débit de 0), attend leur reprise avant que la requête ne parte
+    def throttle(self, key, data):
+        while (self.paused(key)):
+            time.sleep(self.PAUSE_PERIOD)
+        if ( (self.currentRate() is None) and (self._cap(key) is None) ):
+            return data
+        return ThrottledBody(self, key, data)
+
+    # Indique si les envois de la session key sont suspendus (débit global ou de session de 0)
+    def paused(self, key):
+        with self._lock:
+            return ( (self.currentRate() == 0) or (self._cap(key) == 0) )
+
+    def _cap(self, key):
+        _session = self._sessions.get(key)
+        if ( (_session is not None) and (_session[2] is not None) ):
+            return _session[2]
+        return BANDWIDTH_SESSION_CAP if (self.session_cap is None) else self.session_cap
+
+    def _session(self, key, now):
+        if (key not in self._sessions):
+            self._sessions[key] = [0.0, now, None, False]
+        return self._sessions[key]
+
+    # Répartit le débit global entre les sessions actives (partage max-min)
+    def _rates(self, now):
+        _active = sorted([_key for _key, _session in self._sessions.items() if _session[3]],
+                         key=lambda _key: float("inf") if (self._cap(_key) is None) else self._cap(_key))
+        _remaining = self.currentRate()
+        _rates = {}
+        for _index, _key in enumerate(_active):
+            _cap = self._cap(_key)
+            if (_remaining is None):
+                _rates[_key] = _cap
+            else:
+                _share = _remaining / (len(_active) - _index)
+                _rates[_key] = _share if (_cap is None) else min(_cap, _share)
+                _remaining = _remaining - _rates[_key]
+        return _rates
+
+    # Attend que la session key puisse envoyer size octets
+    def acquire(self, key, size):
+        while True:
+            with self._lock:
+                _now = time.monotonic()
+                _session = self._session(key, _now)
+                _session[3] = True
+                _elapsed = _now - _session[1]
+                _session[1] = _now
+                _rate = self._rates(_now).get(key)
+                if (_rate is None):
+                    return
+                if (_rate <= 0):    # envois suspendus (plage horaire ou session à 0)
+                    _session[0] = 0.0
+                    _wait = self.PAUSE_PERIOD
+                else:
+                    _burst = max(size, _rate * self.BURST_DURATION)
+                    _session[0] = min(_burst, _session[0] + _elapsed * _rate)
+                    if (_session[0] >= size):
+                        _session[0] = _session[0] - size
+                        return
+                    _wait = (size - _session[0]) / _rate
+            time.sleep(_wait)
+
+    # Fin de l'envoi d'un corps de requête : la part de la session revient aux autres
+    def release(self, key):
+        with self._lock:
+            _session = self._sessions.get(key)
+            if (_session is None):
+                return
+            if (_session[2] is None):
+                del self._sessions[key]
+            else:
+                _session[3] = False
+
+# Corps de requête envoyé par blocs de BANDWIDTH_SLICE octets au rythme du limiteur
+# La longueur est connue (Content-Length), et le corps peut être renvoyé (nouvel itérateur)
+class ThrottledBody:
+    def __init__(self, limiter, key, data):
+        self.limiter = limiter
+        self.key = key
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        _pieces = [self.data] if isinstance(self.data, (bytes, bytearray, memoryview)) else self.data
+        try:
+            for _piece in _pieces:
+                with memoryview(_piece) as _view:
+                    for _offset in range(0, len(_view), BANDWIDTH_SLICE):
+                        _slice = _view[_offset:_offset + BANDWIDTH_SLICE]
+                        self.limiter.acquire(self.key, len(_slice))
+                        yield _slice
+                        _slice.release()
+        finally:
+            self.limiter.release(self.key)
+
+_bandwidth_limiter = None
+_bandwidth_limiter_lock = threading.Lock()
+
+# Renvoie le limiteur de débit partagé (créé au premier appel)
+def getBandwidthLimiter():
+    global _bandwidth_limiter
+    with _bandwidth_limiter_lock:
+        if (_bandwidth_limiter is None):
+            _bandwidth_limiter = BandwidthLimiter()
+        return _bandwidth_limiter
+
+# =================================================================
+# Erreurs et nouvelles tentatives
+# =================================================================
+# __________________________________________________________________
+# Erreurs renvoyées par le serveur d'upload
+#  - SessionExpiredError : la session (upload_id) n'existe plus (404/410), il faut recommencer un nouvel upload
+#  - TransientUploadError : erreur temporaire (5xx, 429, coupure de connexion), la requête peut être retentée
+#     processed est vrai si la requête a pu être traitée par le serveur sans que la réponse soit reçue
+#     (coupure ou timeout après l'envoi) : une requête qui n'est pas idempotente ne doit pas être
+#     renvoyée telle quelle
+#  - ChecksumMismatchError : le fichier reçu par Drive diffère du fichier local
+#  - UploadError : autre erreur, définitive
+class UploadError(Exception):
+    def __init__(self, message, status_code=None):
+        Exception.__init__(self, message)
+        self.status_code = status_code
+
+class SessionExpiredError(UploadError):
+    pass
+
+class ChecksumMismatchError(UploadError):
+    pass
+
+class TransientUploadError(UploadError):
+    def __init__(self, message, status_code=None, retry_after=None, processed=False):
+        UploadError.__init__(self, message, status_code)
+        self.retry_after = retry_after     # délai (en secondes) demandé par le serveur
+        self.processed = processed
+
+# Lève l'erreur correspondant au code de retour d'une requête d'upload
+#  (200/201 : upload terminé, 308 : upload incomplet)
+def raiseForUploadStatus(r):
+    if (r.status_code in (200, 201, 308)):
+        return
+    _message = "Code de retour inattendu : " + str(r.status_code)
+    if (r.status_code in (404, 410)):
+        raise SessionExpiredError("La session d'upload a expiré (" + str(r.status_code) + ")", r.status_code)
+    if ( (r.status_code == 429) or (r.status_code >= 500) ):
+        raise TransientUploadError(_message, r.status_code, parseRetryAfter(r.headers.get("Retry-After")))
+    raise UploadError(_message, r.status_code)
+
+# Lève l'erreur correspondant au code de retour d'une requête de l'API Drive (hors upload)
+def raiseForApiStatus(r):
+    if ( (r.status_code >= 200) and (r.status_code <= 299) ):
+        return
+    _message = "Code de retour inattendu : " + str(r.status_code)
+    if ( (r.status_code == 429) or (r.status_code >= 500) ):
+        raise TransientUploadError(_message, r.status_code, parseRetryAfter(r.headers.get("Retry-After")))
+    raise UploadError(_message, r.status_code)
+
+# Convertit l'entête Retry-After (nombre de secondes ou date HTTP) en secondes
+def parseRetryAfter(value):
+    if (value is None):
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    import email.utils
+    try:
+        _date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (_date - datetime.datetime.now(_date.tzinfo)).total_seconds())
+
+# __________________________________________________________________
+# Politique de nouvelles tentatives d'un upload
+# Le délai entre deux tentatives croît exponentiellement avec le nombre d'échecs
+#  consécutifs, tiré aléatoirement entre 0 et ce maximum (jitter) pour ne pas
+#  synchroniser les clients, sauf si le serveur impose un délai (Retry-After).
+# L'upload est abandonné après max_attempts échecs consécutifs, ou lorsque le
+#  budget total de nouvelles tentatives est épuisé.
+class RetryPolicy:
+    def __init__(self, max_attempts=None, budget=None, base_delay=None, max_delay=None):
+        self.max_attempts = RETRY_MAX_ATTEMPTS if (max_attempts is None) else max_attempts
+        self.budget = RETRY_BUDGET if (budget is None) else budget
+        self.base_delay = RETRY_BASE_DELAY if (base_delay is None) else base_delay
+        self.max_delay = RETRY_MAX_DELAY if (max_delay is None) else max_delay
+        self.attempts = 0       # échecs consécutifs
+        self.retries = 0        # nouvelles tentatives depuis le début de l'upload
+
+    # A appeler après une requête réussie
+    def reset(self):
+        self.attempts = 0
+
+    # Attend avant la prochaine tentative, ou relève l'erreur si plus aucune tentative n'est permise
+    def backoff(self, error):
+        self.attempts = self.attempts + 1
+        if ( (self.attempts > self.max_attempts) or (self.retries >= self.budget) ):
+            raise error
+        self.retries = self.retries + 1
+        if (error.retry_after is not None):
+            _delay = error.retry_after
+        else:
+            _delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (self.attempts - 1))))
+        log ("Erreur temporaire (" + str(error) + "), nouvelle tentative dans " + "%.1f" % _delay + " s")
+        time.sleep(_delay)
+
+    # Exécute function(*args) en la retentant après chaque erreur temporaire
+    def run(self, function, *args):
+        while True:
+            try:
+                return function(*args)
+            except TransientUploadError as e:
+                self.backoff(e)
+
+# =================================================================
+# Mesures de l'upload
+# =================================================================
+# __________________________________________________________________
+# Mesures d'une session d'upload
+# record() est appelé après chaque chunk avec :
+#  - start_byte, sent : position et taille du chunk envoyé
+#  - committed : nombre d'octets acquittés par le serveur grâce à ce chunk
+#  - latency : durée de la requête PUT
+#  - duration : durée totale du chunk, attentes et nouvelles tentatives comprises
+#  - read_time : temps passé à lire le fichier par la lecture anticipée pendant ce chunk (0 sans lecture anticipée)
+#  - retries : nombre de nouvelles tentatives
+# Chaque chunk, puis la fin de la session, sont transmis aux hooks (voir addMetricsHook)
+class UploadMetrics:
+    def __init__(self, upload_id, filename, size, start_byte=0):
+        self.upload_id = upload_id
+        self.filename = filename
+        self.size = size                # None si la taille est inconnue (flux)
+        self.start_byte = start_byte    # octet de reprise
+        self.chunks = 0
+        self.bytes = 0                  # octets acquittés pendant cette session
+        self.bytes_sent = 0
+        self.retries = 0
+        self.request_seconds = 0.0
+        self.read_seconds = 0.0
+        self.complete = False
+        self.time_start = time.time()
+        self.time_end = None
+        self._lock = threading.Lock()
+
+    def record(self, start_byte, sent, committed, latency, duration, read_time=0.0, retries=0):
+        with self._lock:
+            self.chunks = self.chunks + 1
+            self.bytes = self.bytes + committed
+            self.bytes_sent = self.bytes_sent + sent
+            self.retries = self.retries + retries
+            self.request_seconds = self.request_seconds + latency
+            self.read_seconds = self.read_seconds + read_time
+        emitMetrics("chunk", {
+            "time": time.time(),
+            "upload_id": self.upload_id,
+            "filename": self.filename,
+            "start_byte": start_byte,
+            "bytes": sent,
+            "committed": committed,
+            "latency": latency,
+            "duration": duration,
+            "read_time": read_time,
+            "retries": retries,
+            "throughput": (committed / duration) if (duration > 0) else 0.0,
+            "progress": start_byte + committed,
+            "size": self.size,
+        })
+
+    # size : taille finale, pour un flux dont la taille n'était pas connue
+    def finish(self, size=None):
+        with self._lock:
+            self.complete = True
+            self.time_end = time.time()
+            if (size is not None):
+                self.size = size
+        emitMetrics("session", self.totals())
+
+    def totals(self):
+        with self._lock:
+            _elapsed = (time.time() if (self.time_end is None) else self.time_end) - self.time_start
+            return {
+                "time": time.time(),
+                "upload_id": self.upload_id,
+                "filename": self.filename,
+                "size": self.size,
+                "start_byte": self.start_byte,
+                "chunks": self.chunks,
+                "bytes": self.bytes,
+                "bytes_sent": self.bytes_sent,
+                "retries": self.retries,
+                "request_seconds": self.request_seconds,
+                "read_seconds": self.read_seconds,
+                "elapsed": _elapsed,
+                "throughput": (self.bytes / _elapsed) if (_elapsed > 0) else 0.0,
+                "complete": self.complete,
+            }
+
+_upload_metrics = {}
+_metrics_hooks = []
+_metrics_lock = threading.Lock()
+
+# Crée les mesures d'une session d'upload ; les METRICS_MAX_SESSIONS dernières restent disponibles
+def startUploadMetrics(upload_id, filename, size, start_byte=0):
+    _metrics = UploadMetrics(upload_id, filename, size, start_byte)
+    with _metrics_lock:
+        _upload_metrics.pop(upload_id, None)
+        _upload_metrics[upload_id] = _metrics
+        while (len(_upload_metrics) > METRICS_MAX_SESSIONS):
+            del _upload_metrics[next(iter(_upload_metrics))]
+    return _metrics
+
+# Renvoie les totaux des dernières sessions d'upload, de la plus ancienne à la plus récente
+def getUploadMetrics():
+    with _metrics_lock:
+        _sessions = list(_upload_metrics.values())
+    return [_metrics.totals() for _metrics in _sessions]
+
+# __________________________________________________________________
+# Hooks : fonctions appelées avec (évènement, mesures) après chaque chunk ("chunk")
+#  et à la fin de chaque session ("session"), depuis le thread de l'upload
+def addMetricsHook(hook):
+    with _metrics_lock:
+        _metrics_hooks.append(hook)
+
+def removeMetricsHook(hook):
+    with _metrics_lock:
+        if (hook in _metrics_hooks):
+            _metrics_hooks.remove(hook)
+
+_metrics_writer = None
+
+def emitMetrics(event, data):
+    global _metrics_writer
+    with _metrics_lock:
+        _hooks = list(_metrics_hooks)
+        if ( (METRICS_JSONL_PATHFILENAME is not None) and
+             ( (_metrics_writer is None) or (_metrics_writer.pathfilename != METRICS_JSONL_PATHFILENAME) ) ):
+            _metrics_writer = JsonLinesMetricsWriter(METRICS_JSONL_PATHFILENAME)
+    if (VERBOSE_CHUNKS):
+        _hooks.append(printMetrics)
+    if (METRICS_JSONL_PATHFILENAME is not None):
+        _hooks.append(_metrics_writer)
+    for _hook in _hooks:
+        try:
+            _hook(event, data)
+        except Exception as e:   # une erreur d'un hook ne doit pas interrompre l'upload
+            log ("Erreur du hook de mesures " + repr(_hook) + " : " + str(e))
+
+# Hook d'affichage dans la console, sur la sortie d'erreur (activé par VERBOSE_CHUNKS)
+def printMetrics(event, data):
+    if (event == "chunk"):
+        _progress = ("%.1f%%" % (100.0 * data["progress"] / data["size"])) if data["size"] else (str(data["progress"]) + " octets")
+        print("Chunk " + str(data["start_byte"]) + "+" + str(data["bytes"]) + " : " + _progress
+              + ", requête " + "%.3f" % data["latency"] + " s, lecture " + "%.3f" % data["read_time"] + " s, "
+              + "%.2f" % (data["throughput"] / 1e6) + " Mo/s, " + str(data["retries"]) + " nouvelle(s) tentative(s)", file=sys.stderr)
+    else:
+        print("Session " + data["upload_id"] + " : " + str(data["bytes"]) + " octets en " + "%.1f" % data["elapsed"]
+              + " s (" + "%.2f" % (data["throughput"] / 1e6) + " Mo/s), " + str(data["retries"]) + " nouvelle(s) tentative(s)", file=sys.stderr)
+
+# Hook écrivant chaque évènement dans un fichier, une ligne JSON par évènement
+class JsonLinesMetricsWriter:
+    def __init__(self, pathfilename):
+        self.pathfilename = pathfilename
+        self._lock = threading.Lock()
+
+    def __call__(self, event, data):
+        _line = json.dumps(dict(data, event=event)) + "\n"
+        with self._lock:
+            with open(self.pathfilename, "a") as f:
+                f.write(_line)
+
+# __________________________________________________________________
+# Renvoie les totaux des dernières sessions au format texte de Prometheus
+#  (ex : pour le "textfile collector" de node_exporter)
+def prometheusMetrics():
+    _metrics = [
+        ("gdrive_upload_bytes_total", "counter", "Octets acquittés par Drive", "bytes"),
+        ("gdrive_upload_sent_bytes_total", "counter", "Octets envoyés, renvois compris", "bytes_sent"),
+        ("gdrive_upload_chunks_total", "counter", "Chunks envoyés", "chunks"),
+        ("gdrive_upload_retries_total", "counter", "Nouvelles tentatives après une erreur temporaire", "retries"),
+        ("gdrive_upload_request_seconds_total", "counter", "Durée cumulée des requêtes d'envoi", "request_seconds"),
+        ("gdrive_upload_read_seconds_total", "counter", "Durée cumulée de lecture du fichier", "read_seconds"),
+        ("gdrive_upload_throughput_bytes_per_second", "gauge", "Débit moyen de la session", "throughput"),
+        ("gdrive_upload_complete", "gauge", "1 si la session est terminée", "complete"),
+    ]
+    _sessions = getUploadMetrics()
+    _lines = []
+    for _name, _type, _help, _key in _metrics:
+        _lines.append("# HELP " + _name + " " + _help)
+        _lines.append("# TYPE " + _name + " " + _type)
+        for _session in _sessions:
+            _labels = 'upload_id="' + prometheusLabel(_session["upload_id"]) + '",filename="' + prometheusLabel(_session["filename"]) + '"'
+            _lines.append(_name + "{" + _labels + "} " + repr(float(_session[_key])))
+    return "\n".join(_lines) + "\n"
+
+def prometheusLabel(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# =================================================================
+# Upload de plusieurs fichiers en parallèle
+# =================================================================
+# __________________________________________________________________
+# Un fichier à uploader dans une file d'upload, avec son état de reprise
+class UploadJob:
+    def __init__(self, pathfilename, filename, size=None):
+        self.pathfilename = pathfilename
+        self.filename = filename
+        self.upload_id = ""
+        self.size = getFileSize(pathfilename) if (size is None) else size
+        self.bytes_done = 0
+        self.status = "pending"     # pending / running / done / failed / cancelled
+        self.error = None
+        self.md5 = None             # empreinte MD5 du fichier uploadé
+        self.file_id = None         # fichier Drive dont une nouvelle révision est envoyée (None : nouveau fichier),
+                                    #  puis identifiant du fichier uploadé
+        self.relpath = None         # chemin relatif dans le répertoire synchronisé (voir syncDirectory)
+        self.mtime_ns = None        # date de modification du fichier lors du parcours du répertoire
+        self.time_start = None
+        self.time_end = None
+
+# __________________________________________________________________
+# File d'upload : mène plusieurs sessions d'upload avec reprise en parallèle
+#  sur un pool de threads. Chaque fichier obtient sa propre session (upload_id),
+#  mémorisée dans le journal comme pour newResumableUpload().
+# Les petits fichiers (< SIMPLE_UPLOAD_THRESHOLD) sont envoyés en une seule requête,
+#  sur les connexions keep-alive partagées par les workers.
+# progress_callback : fonction optionnelle appelée avec report() après chaque chunk
+# job_callback : fonction optionnelle appelée avec le job à la fin de chaque upload
+# control : UploadControl optionnel permettant de suspendre ou d'annuler les uploads
+# client : UploadClient utilisé par les workers, qui doit disposer d'au moins une connexion
+#  par worker. Par défaut, le client par défaut s'il en a assez, sinon un client propre à la
+#  file (même serveur, timeout et identifiants), fermé à la fin de run() ; le client par
+#  défaut, qui peut servir à d'autres uploads en cours, n'est jamais remplacé.
+# Les totaux sont tenus à jour au fil de l'eau, pour que report() reste rapide
+#  même avec un très grand nombre de fichiers.
+class UploadQueue:
+    def __init__(self, token_id, workers=UPLOAD_WORKERS, progress_callback=None, job_callback=None, control=None, client=None):
+        self.token_id = token_id
+        self.workers = workers
+        self.progress_callback = progress_callback
+        self.job_callback = job_callback
+        self.control = control
+        self.client = client
+        self.jobs = []
+        self.time_start = None
+        self._bytes_done = 0
+        self._bytes_total = 0
+        self._files_done = 0
+        self._files_failed = 0
+        self._lock = threading.Lock()
+
+    def add(self, pathfilename, filename=None, size=None):
+        if (filename is None):
+            filename = os.path.basename(pathfilename)
+        _job = UploadJob(pathfilename, filename, size)
+        with self._lock:
+            self.jobs.append(_job)
+            self._bytes_total = self._bytes_total + _job.size
+        return _job
+
+    # Lance tous les uploads en attente et rend la main quand ils sont tous terminés
+    def run(self):
+        _client = self.client
+        _own_client = None
+        if (_client is None):
+            _client = getUploadClient()
+            if (_client.pool_size < self.workers):     # une connexion keep-alive par worker
+                _own_client = UploadClient(pool_size=self.workers, timeout=_client.timeout,
+                                           base_url=_client.base_url, credentials=_client.credentials)
+                _client = _own_client
+        self.time_start = time.monotonic()
+        _pending = [_job for _job in self.jobs if (_job.status == "pending")]
+        import concurrent.futures
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as _executor:
+                for _future in [_executor.submit(self._runJob, _job, _client) for _job in _pending]:
+                    _future.result()
+        finally:
+            if (_own_client is not None):
+                _own_client.close()
+        _report = self.report()
+        log ("Upload terminé : " + str(_report["files_done"]) + "/" + str(_report["files"]) + " fichier(s), "
+             + str(_report["files_failed"]) + " en échec, " + "%.2f" % (_report["throughput"] / 1e6) + " Mo/s")
+        return self.jobs
+
+    # Les requêtes du job passent par client (voir usingUploadClient)
+    def _runJob(self, job, client):
+        with usingUploadClient(client):
+            job.status = "running"
+            job.time_start = time.monotonic()
+            try:
+                if (self.control is not None):
+                    self.control.checkpoint()
+                _duplicate = None
+                if ( DEDUP_ENABLED and (job.file_id is None) ):    # une nouvelle révision n'est pas dédupliquée
+                    _duplicate = findDuplicateUpload(job.pathfilename, job.filename, self.token_id)
+                if (_duplicate is not None):   # contenu déjà présent sur Drive
+                    _metadata = _duplicate
+                    job.md5 = _duplicate.get("md5Checksum")
+                    self._onProgress(job, job.size, job.size)
+                elif ( SPARSE_IMAGE_MODE and isDiskImage(job.pathfilename) ):
+                    _metadata = newSparseImageUpload(job.pathfilename, job.filename, self.token_id,
+                                                     partial(self._onProgress, job), self.control, job.file_id)
+                    job.md5 = _metadata.get("md5Checksum")
+                elif (job.size < SIMPLE_UPLOAD_THRESHOLD):   # petit fichier : une seule requête
+                    _metadata = initiateSimpleUpload(job.pathfilename, job.filename, self.token_id, file_id=job.file_id)
+                    job.md5 = _metadata.get("md5Checksum")
+                    self._onProgress(job, job.size, job.size)
+                else:
+                    job.upload_id = initiateNewResumableUpload(job.pathfilename, job.filename, self.token_id, job.file_id)
+                    getUploadJournal().begin(job.pathfilename, job.filename, job.upload_id)
+                    _metadata = resumeExistingUpload(job.pathfilename, job.filename, job.upload_id,
+                                                     progress_callback=partial(self._onProgress, job), control=self.control)
+                    job.md5 = getUploadJournal().get(job.upload_id)["md5"]
+                if ( DEDUP_ENABLED and (_duplicate is None) ):
+                    getDriveContentIndex(self.token_id).add(_metadata)
+                job.file_id = _metadata.get("id", job.file_id)
+                job.status = "done"
+            except UploadCancelled:
+                job.status = "cancelled"
+            except Exception as e:
+                job.status = "failed"
+                job.error = e
+                log ("Echec de l'upload de " + job.pathfilename + " : " + str(e))
+            job.time_end = time.monotonic()
+            with self._lock:
+                if (job.status == "done"):
+                    self._files_done = self._files_done + 1
+                elif (job.status == "failed"):
+                    self._files_failed = self._files_failed + 1
+            if (self.job_callback is not None):
+                self.job_callback(job)
+
+    def _onProgress(self, job, bytes_done, size):
+        with self._lock:
+            self._bytes_done = self._bytes_done + bytes_done - job.bytes_done
+            job.bytes_done = bytes_done
+            _report = self.report()
+        if (self.progress_callback is not None):
+            self.progress_callback(_report)
+
+    # Etat d'avancement global de la file
+    def report(self):
+        _elapsed = (time.monotonic() - self.time_start) if (self.time_start is not None) else 0.0
+        return {
+            "files": len(self.jobs),
+            "files_done": self._files_done,
+            "files_failed": self._files_failed,
+            "bytes_done": self._bytes_done,
+            "bytes_total": self._bytes_total,
+            "percent": (float(self._bytes_done) / self._bytes_total * 100) if (self._bytes_total > 0) else 100.0,
+            "elapsed": _elapsed,
+            "throughput": (self._bytes_done / _elapsed) if (_elapsed > 0) else 0.0,   # octets/s
+        }
+
+# __________________________________________________________________
+# Uploade une liste de fichiers [(pathfilename, filename), ...] avec workers uploads en parallèle
+def batchUpload(files, token_id, workers=UPLOAD_WORKERS, progress_callback=None):
+    _queue = UploadQueue(token_id, workers, progress_callback)
+    for _pathfilename, _filename in files:
+        _queue.add(_pathfilename, _filename)
+    return _queue.run()
+
+# =================================================================
+# Synchronisation d'un répertoire
+# =================================================================
+# __________________________________________________________________
+# Index des fichiers déjà uploadés depuis un répertoire
+# Chaque fichier est identifié par le répertoire synchronisé (root) et son chemin relatif,
+#  avec sa taille, sa date de modification (en ns) et son empreinte MD5 au moment de l'upload,
+#  ainsi que l'identifiant du fichier Drive correspondant (file_id).
+class SyncManifest:
+    def __init__(self, pathfilename=None):
+        self.pathfilename = SYNC_MANIFEST_PATHFILENAME if (pathfilename is None) else pathfilename
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.pathfilename, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS files (
+            root TEXT NOT NULL,
+            relpath TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            md5 TEXT,
+            uploaded REAL NOT NULL,
+            file_id TEXT,
+            PRIMARY KEY (root, relpath)) WITHOUT ROWID""")
+        _columns = [_row[1] for _row in self._db.execute("PRAGMA table_info(files)")]
+        if ("file_id" not in _columns):     # index créé par une version précédente
+            self._db.execute("ALTER TABLE files ADD COLUMN file_id TEXT")
+
+    # Renvoie l'index d'un répertoire : {chemin relatif: (taille, date de modification, md5, file_id)}
+    def load(self, root):
+        with self._lock:
+            _rows = self._db.execute("SELECT relpath, size, mtime_ns, md5, file_id FROM files WHERE root=?", (root,))
+            return {_row[0]: (_row[1], _row[2], _row[3], _row[4]) for _row in _rows}
+
+    # entries : liste de (chemin relatif, taille, date de modification, md5, file_id), écrits en une transaction
+    def update(self, root, entries):
+        _now = time.time()
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO files (root, relpath, size, mtime_ns, md5, uploaded, file_id) "
+                                 "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 [(root, _relpath, _size, _mtime_ns, _md5, _now, _file_id)
+                                  for _relpath, _size, _mtime_ns, _md5, _file_id in entries])
+
+    def remove(self, root, relpaths):
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM files WHERE root=? AND relpath=?", [(root, _relpath) for _relpath in relpaths])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+# __________________________________________________________________
+# Parcourt récursivement un répertoire
+# Renvoie (chemin relatif, chemin complet, taille, date de modification en ns) pour chaque fichier
+# Les liens symboliques vers des répertoires ne sont pas suivis
+def scanDirectory(root):
+    _directories = [root]
+    while (_directories):
+        _directory = _directories.pop()
+        try:
+            _entries = list(os.scandir(_directory))
+        except OSError as e:
+            log ("Lecture impossible de " + _directory + " : " + str(e))
+            continue
+        for _entry in _entries:
+            if (_entry.is_dir(follow_symlinks=False)):
+                _directories.append(_entry.path)
+            elif (_entry.is_file()):
+                _stat = _entry.stat()
+                yield os.path.relpath(_entry.path, root), _entry.path, _stat.st_size, _stat.st_mtime_ns
+
+# __________________________________________________________________
+# Synchronise un répertoire vers Drive : seuls les fichiers nouveaux ou modifiés depuis la
+#  dernière synchronisation sont uploadés (en parallèle, voir UploadQueue).
+# Un fichier dont la taille et la date de modification n'ont pas changé est ignoré sans
+#  être lu. Si seule la date a changé, son empreinte MD5 est comparée à celle de l'index.
+# Sur Drive, le fichier porte son chemin relatif comme nom (ex : "2018/backup.tar").
+# Un fichier modifié est envoyé comme nouvelle révision du fichier Drive mémorisé dans l'index :
+#  un nouveau fichier n'est créé que pour un chemin relatif qui n'a jamais été synchronisé
+#  (ou dont le fichier Drive a été supprimé).
+# progress_callback : appelée avec (octets transférés, total à transférer)
+# Renvoie un résumé de la synchronisation
+def syncDirectory(directory, token_id, workers=None, progress_callback=None, control=None, manifest=None):
+    _root = os.path.abspath(directory)
+    _manifest = SyncManifest() if (manifest is None) else manifest
+    _known = _manifest.load(_root)
+
+    # Chaque upload terminé est écrit aussitôt dans l'index : après un arrêt du processus,
+    #  la synchronisation suivante ne renvoie aucun fichier déjà uploadé
+    def _onJobDone(job):
+        if (job.status == "done"):
+            _manifest.update(_root, [(job.relpath, job.size, job.mtime_ns, job.md5, job.file_id)])
+
+    _queue = UploadQueue(token_id, UPLOAD_WORKERS if (workers is None) else workers,
+                         progress_callback=None if (progress_callback is None) else
+                             (lambda report: progress_callback(report["bytes_done"], report["bytes_total"])),
+                         job_callback=_onJobDone, control=control)
+    _seen = set()
+    _touched = []       # fichiers dont seule la date de modification a changé
+    _unchanged = 0
+    for _relpath, _pathfilename, _size, _mtime_ns in scanDirectory(_root):
+        _seen.add(_relpath)
+        _entry = _known.get(_relpath)
+        if ( (_entry is not None) and (_entry[0] == _size) ):
+            if (_entry[1] == _mtime_ns):
+                _unchanged = _unchanged + 1
+                continue
+            if ( (_entry[2] is not None) and (computeFileMd5(_pathfilename) == _entry[2]) ):
+                _touched.append((_relpath, _size, _mtime_ns, _entry[2], _entry[3]))
+                continue
+        _job = _queue.add(_pathfilename, _relpath.replace(os.sep, "/"), _size)
+        _job.file_id = None if (_entry is None) else _entry[3]
+        _job.relpath = _relpath
+        _job.mtime_ns = _mtime_ns
+    _removed = [_relpath for _relpath in _known if (_relpath not in _seen)]
+    _manifest.update(_root, _touched)
+    _manifest.remove(_root, _removed)
+    log ("Synchronisation de " + _root + " : " + str(len(_queue.jobs)) + " fichier(s) à uploader, "
+         + str(_unchanged + len(_touched)) + " inchangé(s)")
+    _queue.run()
+    _report = _queue.report()
+    _report["unchanged"] = _unchanged + len(_touched)
+    _report["removed"] = len(_removed)
+    if (manifest is None):
+        _manifest.close()
+    return _report
+
+# =================================================================
+# Déduplication : fichiers déjà présents sur Drive
+# =================================================================
+# __________________________________________________________________
+# Cache des empreintes MD5 des fichiers locaux
+# Un fichier est identifié par (chemin, taille, date de modification) : tant qu'il n'est
+#  pas modifié, son empreinte est lue dans le cache sans relire le fichier.
+# Au-delà de max_entries empreintes, les moins récemment utilisées sont supprimées.
+class HashCache:
+    def __init__(self, pathfilename=None, max_entries=None):
+        self.pathfilename = HASH_CACHE_PATHFILENAME if (pathfilename is None) else pathfilename
+        self.max_entries = HASH_CACHE_MAX_ENTRIES if (max_entries is None) else max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.pathfilename, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS hashes (
+            pathfilename TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            md5 TEXT NOT NULL,
+            last_used REAL NOT NULL)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes (last_used)")
+        self._count = self._db.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+
+    # Renvoie l'empreinte MD5 du fichier, calculée seulement si elle n'est pas dans le cache
+    def md5(self, pathfilename):
+        _pathfilename = os.path.abspath(pathfilename)
+        _stat = os.stat(_pathfilename)
+        with self._lock:
+            _row = self._db.execute("SELECT md5 FROM hashes WHERE pathfilename=? AND size=? AND mtime_ns=?",
+                                    (_pathfilename, _stat.st_size, _stat.st_mtime_ns)).fetchone()
+            if (_row is not None):
+                self._db.execute("UPDATE hashes SET last_used=? WHERE pathfilename=?", (time.time(), _pathfilename))
+                return _row[0]
+        _md5 = computeFileMd5(_pathfilename)
+        self.put(_pathfilename, _stat.st_size, _stat.st_mtime_ns, _md5)
+        return _md5
+
+    def put(self, pathfilename, size, mtime_ns, md5):
+        with self._lock:
+            _known = self._db.execute("SELECT 1 FROM hashes WHERE pathfilename=?", (pathfilename,)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO hashes (pathfilename, size, mtime_ns, md5, last_used) VALUES (?, ?, ?, ?, ?)",
+                             (pathfilename, size, mtime_ns, md5, time.time()))
+            if (_known is None):
+                self._count = self._count + 1
+            if (self._count > self.max_entries):
+                self._db.execute("DELETE FROM hashes WHERE pathfilename IN "
+                                 "(SELECT pathfilename FROM hashes ORDER BY last_used LIMIT ?)",
+                                 (self._count - self.max_entries,))
+                self._count = self.max_entries
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+_hash_cache = None
+_hash_cache_lock = threading.Lock()
+
+# Renvoie le cache d'empreintes par défaut (ouvert au premier appel)
+def getHashCache():
+    global _hash_cache
+    with _hash_cache_lock:
+        if (_hash_cache is None):
+            _hash_cache = HashCache()
+        return _hash_cache
+
+# __________________________________________________________________
+# Index par empreinte MD5 des fichiers d'un dossier Drive
+# L'API Drive ne permet pas de rechercher un fichier par md5Checksum (ce champ n'est pas
+#  utilisable dans le paramètre "q" de files.list) : le contenu du dossier est listé une
+#  fois, puis l'index est complété avec les fichiers uploadés ensuite.
+class DriveContentIndex:
+    def __init__(self, token_id, folder_id=None):
+        self.token_id = token_id
+        self.folder_id = DEDUP_FOLDER_ID if (folder_id is None) else folder_id
+        self._by_md5 = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if (self._by_md5 is None):
+            self._by_md5 = {}
+            for _file in listDriveFiles(self.token_id, self.folder_id):
+                self.add(_file)
+
+    # Renvoie les métadonnées d'un fichier du dossier ayant l'empreinte md5, ou None
+    def find(self, md5):
+        with self._lock:
+            self._load()
+            return self._by_md5.get(md5)
+
+    def add(self, metadata):
+        if ( (metadata is None) or ("md5Checksum" not in metadata) or ("id" not in metadata) ):
+            return
+        if (self._by_md5 is not None):
+            self._by_md5.setdefault(metadata["md5Checksum"], metadata)
+
+_drive_content_indexes = {}
+_drive_content_indexes_lock = threading.Lock()
+
+# Renvoie l'index du dossier Drive DEDUP_FOLDER_ID (listé au premier appel)
+def getDriveContentIndex(token_id):
+    with _drive_content_indexes_lock:
+        if (DEDUP_FOLDER_ID not in _drive_content_indexes):
+            _drive_content_indexes[DEDUP_FOLDER_ID] = DriveContentIndex(token_id, DEDUP_FOLDER_ID)
+        _index = _drive_content_indexes[DEDUP_FOLDER_ID]
+        _index.token_id = token_id
+        return _index
+
+# __________________________________________________________________
+# Cherche sur Drive un fichier de même contenu que pathfilename
+# S'il existe, selon DEDUP_ACTION, rien n'est fait ("skip"), le fichier est copié côté Drive
+#  sous le nom filename ("copy") ou un raccourci est créé ("shortcut"), sans transfert de données.
+# Renvoie les métadonnées du fichier existant (ou de sa copie / son raccourci), None s'il n'existe pas
+def findDuplicateUpload(pathfilename, filename, token_id):
+    _md5 = getHashCache().md5(pathfilename)
+    _existing = getDriveContentIndex(token_id).find(_md5)
+    if (_existing is None):
+        return None
+    log (pathfilename + " est déjà présent sur Drive : " + _existing.get("name", "") + " (" + _existing["id"] + ")")
+    if ( (DEDUP_ACTION == "skip") or (_existing.get("name") == filename) ):
+        return _existing
+    if (DEDUP_ACTION == "shortcut"):
+        return createDriveShortcut(token_id, _existing["id"], filename)
+    _copy = copyDriveFile(token_id, _existing["id"], filename)
+    _copy.setdefault("md5Checksum", _md5)
+    return _copy
+
+# __________________________________________________________________
+# Requête vers l'API Drive (hors upload), retentée après une erreur temporaire
+# Renvoie la réponse JSON
+def driveApiRequest(method, path, token_id, params=None, body=None, retry=None):
+    _retry = RetryPolicy() if (retry is None) else retry
+    _client = getUploadClient()
+    headers = {"Authorization": "Bearer " + token_id}
+
+    def _send():
+        r = _client.request(method, _client.url(path), headers=headers, params=params, json=body)
+        log (r.status_code)
+        raiseForApiStatus(r)
+        return r.json()
+
+    return _retry.run(_send)
+
+# Liste les fichiers (hors corbeille) d'un dossier Drive, page par page
+def listDriveFiles(token_id, folder_id):
+    _params = {
+        "q": "'" + folder_id + "' in parents and trashed = false",
+        "fields": "nextPageToken, files(id, name, md5Checksum, size)",
+        "pageSize": 1000,
+    }
+    while True:
+        _page = driveApiRequest("GET", "/drive/v3/files", token_id, params=_params)
+        for _file in _page.get("files", []):
+            yield _file
+        if (not _page.get("nextPageToken")):
+            break
+        _params["pageToken"] = _page["nextPageToken"]
+
+# Cherche dans un dossier Drive un fichier nommé filename d'empreinte md5
+# Renvoie ses métadonnées, None s'il n'existe pas
+def findDriveFile(token_id, filename, md5, folder_id="root"):
+    _name = filename.replace("\\", "\\\\").replace("'", "\\'")
+    _params = {
+        "q": "name = '" + _name + "' and '" + folder_id + "' in parents and trashed = false",
+        "fields": "files(id, name, md5Checksum)",
+    }
+    for _file in driveApiRequest("GET", "/drive/v3/files", token_id, params=_params).get("files", []):
+        if ( (_file.get("name") == filename) and (_file.get("md5Checksum") == md5) ):
+            return _file
+    return None
+
+# Dossier Drive dans lequel les nouveaux fichiers sont créés
+# Avec la déduplication, c'est le dossier indexé (DEDUP_FOLDER_ID) : un fichier uploadé, copié
+#  ou raccourci, ajouté à l'index, s'y trouve bien, et sera retrouvé lors d'un prochain listage.
+def uploadFolderId():
+    return DEDUP_FOLDER_ID if DEDUP_ENABLED else "root"
+
+# Métadonnées de création d'un fichier Drive nommé filename, dans uploadFolderId()
+# Une nouvelle révision (PATCH) ne doit envoyer que son nom : Drive refuse le champ "parents"
+def newFileMetadata(filename, **metadata):
+    return dict(metadata, name=filename, parents=[uploadFolderId()])
+
+# Copie un fichier côté Drive (aucune donnée n'est transférée)
+def copyDriveFile(token_id, file_id, filename):
+    return driveApiRequest("POST", "/drive/v3/files/" + file_id + "/copy", token_id,
+                           params={"fields": "id,name,md5Checksum"}, body=newFileMetadata(filename))
+
+# Crée un raccourci vers un fichier Drive
+def createDriveShortcut(token_id, file_id, filename):
+    return driveApiRequest("POST", "/drive/v3/files", token_id, params={"fields": "id,name"},
+                           body=newFileMetadata(filename, mimeType="application/vnd.google-apps.shortcut",
+                                                shortcutDetails={"targetId": file_id}))
+
 # =================================================================
 # API  Helper
 # =================================================================
 # __________________________________________________________________
 # Lance le téléchargement d'un fichier en une fois
-# Valable pour les fichiers de taille < 5Mb
-def initiateSimpleUpload(pathfilename, filename, token_id):
+# Valable pour les fichiers de taille < 5Mb (limite de Drive pour une requête "multipart")
+# Le corps de la requête (métadonnées + contenu du fichier) est envoyé au fil de la lecture
+#  du fichier, sans être construit en mémoire. La requête est retentée après une erreur temporaire.
+# Chaque requête crée un nouveau fichier : si la précédente a pu être traitée sans que la réponse
+#  soit reçue (coupure, timeout), le fichier est d'abord recherché sur Drive par son nom et son
+#  empreinte MD5 (findDriveFile) et n'est renvoyé que s'il n'y est pas, pour ne pas le dupliquer.
+#  Un fichier de même nom et de même contenu déjà présent avant l'upload est alors repris tel quel.
+# file_id : si précisé, le contenu est envoyé comme nouvelle révision de ce fichier Drive
+#  (PATCH, sans risque de doublon), ou dans un nouveau fichier si celui-ci n'existe plus
+# Renvoie les métadonnées du fichier créé (ou mis à jour) sur Drive
+def initiateSimpleUpload(pathfilename, filename, token_id, retry=None, file_id=None):
     """
+    POST https://www.googleapis.com/upload/drive/v3/files?uploadType=multipart HTTP/1.1
+    Authorization: Bearer [YOUR_AUTH_TOKEN]
+    Content-Type: multipart/related; boundary=foo_bar_baz
+    Content-Length: [NUMBER_OF_BYTES_IN_ENTIRE_REQUEST_BODY]
+
+    --foo_bar_baz
+    Content-Type: application/json; charset=UTF-8
+
+    {"name": "myObject"}
+    --foo_bar_baz
+    Content-Type: image/jpeg
+
+    [JPEG_DATA]
+    --foo_bar_baz--
     """
-    file_size = getFileSize(pathfilename)
-    # TODO : check if size is more than 5Mb (simple request is limited to 5Mb)
-    headers = {
-        "Authorization": "Bearer " + token_id,
-    }
-    para = {
-        "name": filename,
-    }
-    files = {
-        'data': ('metadata', json.dumps(para), 'application/json; charset=UTF-8'),
-        'file': readIntoFile(pathfilename, 0, file_size)
-    }
-    r = requests.post(
-        "https://www.googleapis.com/upload/drive/v3/files?uploadType=multipart",
-        headers=headers,
-        files=files
-    )
-    log (r.status_code)
-    log (r.headers)
-    if ( (r.status_code >=200) and (r.status_code <=299) ):
-        print ("Transfert du fichier réalisé avec succès")
+    _retry = RetryPolicy() if (retry is None) else retry
+    with FileSource(pathfilename) as _source:
+        if (_source.size > SIMPLE_UPLOAD_THRESHOLD):
+            raise UploadError(pathfilename + " dépasse la taille maximale d'un upload simple ("
+                              + str(SIMPLE_UPLOAD_THRESHOLD) + " octets)")
+        _client = getUploadClient()
+        with _source.chunk(0, _source.size) as _view:
+            _md5 = hashlib.md5(_view).hexdigest()
+        _processed = False      # la requête précédente a pu créer le fichier
+        _file_id = file_id
+
+        def _post():
+            nonlocal _processed, _file_id
+            _body = MultipartRelatedBody(newFileMetadata(filename) if (_file_id is None) else {"name": filename},
+                                         _source, filenameToMimeType(pathfilename))
+            headers = {
+                "Authorization": "Bearer " + token_id,
+                "Content-Type": "multipart/related; boundary=" + _body.boundary,
+            }
+            if ( _processed and (_file_id is None) ):
+                _existing = findDriveFile(token_id, filename, _md5, uploadFolderId())
+                if (_existing is not None):
+                    log ("Fichier déjà créé par la requête précédente : " + _existing["id"])
+                    return _existing
+            try:
+                if (_file_id is None):
+                    r = _client.post(
+                        _client.url("/upload/drive/v3/files?uploadType=multipart&fields=id,name,md5Checksum"),
+                        headers=headers,
+                        data=getBandwidthLimiter().throttle(_body.boundary, _body)
+                    )
+                else:
+                    r = _client.patch(
+                        _client.url("/upload/drive/v3/files/" + _file_id + "?uploadType=multipart&fields=id,name,md5Checksum"),
+                        headers=headers,
+                        data=getBandwidthLimiter().throttle(_body.boundary, _body)
+                    )
+            except TransientUploadError as e:
+                _processed = e.processed
+                raise
+            log (r.status_code)
+            log (r.headers)
+            _processed = False
+            if ( (_file_id is not None) and (r.status_code == 404) ):
+                log ("Le fichier " + _file_id + " n'existe plus sur Drive, création d'un nouveau fichier")
+                _file_id = None
+                return _post()
+            raiseForUploadStatus(r)
+            _metadata = {}
+            readUploadMetadata(r, _metadata)
+            return _metadata
+
+        _metadata = _retry.run(_post)
+    log ("Transfert du fichier réalisé avec succès")
+    if ( VERIFY_MD5 and ("md5Checksum" in _metadata) and (_metadata["md5Checksum"] != _md5) ):
+        raise ChecksumMismatchError("Empreinte MD5 différente : locale " + _md5 + ", Drive " + _metadata["md5Checksum"])
+    return _metadata
 
+# __________________________________________________________________
+# Corps d'une requête "multipart/related" : métadonnées JSON puis contenu du fichier
+# Le contenu est produit par morceaux (vues sur le fichier projeté en mémoire) au moment
+#  de l'envoi ; la longueur totale est connue à l'avance (entête Content-Length).
+# Le corps peut être parcouru plusieurs fois (nouvelle tentative de la requête).
+class MultipartRelatedBody:
+    PART_SIZE = (1024 * 1024)
+
+    def __init__(self, metadata, source, mime_type):
+        self.boundary = "gdrive_upload_" + uuid.uuid4().hex
+        self.source = source
+        self._head = ("--" + self.boundary + "\r\n"
+                      + "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+                      + json.dumps(metadata) + "\r\n"
+                      + "--" + self.boundary + "\r\n"
+                      + "Content-Type: " + mime_type + "\r\n\r\n").encode("utf-8")
+        self._tail = ("\r\n--" + self.boundary + "--\r\n").encode("utf-8")
+
+    def __len__(self):
+        return len(self._head) + self.source.size + len(self._tail)
+
+    def __iter__(self):
+        yield self._head
+        _offset = 0
+        while (_offset < self.source.size):
+            with self.source.chunk(_offset, self.PART_SIZE) as _view:
+                yield _view
+            _offset = _offset + self.PART_SIZE
+        yield self._tail
 
 # __________________________________________________________________
 # Initie une communication multi-transfert pour récupérer l'ID du transfert à 
 # ré-utiliser pour poursuivre le transfert en cas d'arrêt
-def initiateNewResumableUpload(pathfilename, filename, token_id):
+# file_id : si précisé, le fichier est envoyé comme nouvelle révision de ce fichier Drive
+def initiateNewResumableUpload(pathfilename, filename, token_id, file_id=None, retry=None):
     """
     POST https://www.googleapis.com/upload/drive/v3/files?uploadType=resumable HTTP/1.1
     Authorization: Bearer [YOUR_AUTH_TOKEN]
@@ -274,115 +2139,293 @@ def initiateNewResumableUpload(pathfilename, filename, token_id):
     "name": "myObject"
     }    
     """
-    file_size = getFileSize(pathfilename)
+    upload_id = initiateResumableSession(filename, token_id, filenameToMimeType(pathfilename), getFileSize(pathfilename), file_id, retry)
+    log ("Session d'upload ouverte (reprise possible en cas d'interruption, voir le journal " + JOURNAL_PATHFILENAME + ")")
+    log ("   X-GUploader-UploadID=" + upload_id)
+    log ("   Nom du fichier à télécharger=" + pathfilename)
+    return upload_id
+
+# ______________________________________________________________________________________
+# Ouvre une session d'upload avec reprise et renvoie son identifiant
+# size : taille totale des données à uploader, None si elle n'est pas connue à l'avance
+# file_id : si précisé, la session envoie une nouvelle révision de ce fichier Drive (PATCH)
+#  au lieu de créer un fichier ; si le fichier n'existe plus, un nouveau fichier est créé.
+#  Les chunks sont ensuite envoyés de la même façon, la session étant désignée par son upload_id.
+# retry : RetryPolicy optionnelle appliquée aux erreurs temporaires. Une session ouverte par
+#  une requête dont la réponse a été perdue est simplement abandonnée par Drive.
+# Les autres codes de retour sont signalés par une exception (voir raiseForApiStatus)
+def initiateResumableSession(filename, token_id, mime_type, size=None, file_id=None, retry=None):
     headers = {
         "Authorization": "Bearer " + token_id,
         "Content-Type": "application/json; charset=UTF-8",
-        "X-Upload-Content-Type": filenameToMimeType(pathfilename),
-        "X-Upload-Content-Length": str(getFileSize(pathfilename))
+        "X-Upload-Content-Type": mime_type
     }
-    para = {
-        "name": filename
-    }
-    r = requests.post(
-        "https://www.googleapis.com/upload/drive/v3/files?uploadType=resumable",
-        headers=headers,
-        data=json.dumps(para)
-    )
-    log (r.status_code)
-    log (r.headers)
-    if (r.status_code == 200):
-        upload_id = r.headers['X-GUploader-UploadID']
-        print("Conserver les indications suivantes pour une reprise du transfert en cas d'interruption")
-        print ("   X-GUploader-UploadID=" + upload_id)
-        print ("   Nom du fichier à télécharger=" + pathfilename)
-        print ("   Authentification Token ID=" + token_id)
-        return upload_id
-    return ""
+    if (size is not None):
+        headers["X-Upload-Content-Length"] = str(size)
+    para = newFileMetadata(filename) if (file_id is None) else {"name": filename}
+    _retry = RetryPolicy() if (retry is None) else retry
+    _client = getUploadClient()
+
+    def _initiate():
+        if (file_id is None):
+            r = _client.post(
+                _client.url("/upload/drive/v3/files?uploadType=resumable&fields=id,name,md5Checksum"),
+                headers=headers,
+                data=json.dumps(para)
+            )
+        else:
+            r = _client.patch(
+                _client.url("/upload/drive/v3/files/" + file_id + "?uploadType=resumable&fields=id,name,md5Checksum"),
+                headers=headers,
+                data=json.dumps(para)
+            )
+        log (r.status_code)
+        log (r.headers)
+        if ( (file_id is None) or (r.status_code != 404) ):
+            raiseForApiStatus(r)
+        return r
+
+    r = _retry.run(_initiate)
+    if (r.status_code == 404):
+        log ("Le fichier " + file_id + " n'existe plus sur Drive, création d'un nouveau fichier")
+        return initiateResumableSession(filename, token_id, mime_type, size, retry=_retry)
+    return r.headers['X-GUploader-UploadID']
 
 # ______________________________________________________________________________________
-def resumeUpload(pathfilename, filename, upload_id, file_next_byte, chunk_size):
+# source : FileSource déjà ouvert sur pathfilename (optionnel). S'il n'est pas fourni,
+#  le fichier est ouvert le temps de l'envoi de ce seul chunk.
+# Les codes de retour autres que 200/201/308 sont signalés par une exception (voir raiseForUploadStatus)
+# metadata : dictionnaire optionnel, complété à la fin de l'upload par les métadonnées du fichier renvoyées par Drive
+def resumeUpload(pathfilename, filename, upload_id, file_next_byte, chunk_size, source=None, metadata=None):
     """
     PUT https://www.googleapis.com/upload/drive/v3/files?uploadType=resumable&upload_id=<upload_id> HTTP/1.1
     Content-Length: 524288
     Content-Type: image/jpeg
     Content-Range: bytes 0-524287/2000000
     """
-    file_size = getFileSize(pathfilename)
-    data_buff = readIntoFile(pathfilename, file_next_byte, chunk_size)
-    data_size = len(data_buff)
+    if (source is None):
+        with FileSource(pathfilename) as _source:
+            return resumeUpload(pathfilename, filename, upload_id, file_next_byte, chunk_size, _source, metadata)
+    with source.chunk(file_next_byte, chunk_size) as data_buff:
+        return putChunk(upload_id, data_buff, file_next_byte, source.size, filenameToMimeType(pathfilename), metadata)
+
+# ______________________________________________________________________________________
+# Envoie un chunk de données d'une session d'upload
+# data : données du chunk (bytes ou memoryview), commençant à l'octet start_byte
+# total_size : taille totale de l'upload, None si elle n'est pas encore connue
+#  (Content-Range "bytes a-b/*") ; elle doit être précisée avec le dernier chunk
+# Renvoie le même résultat que resumeUpload()
+def putChunk(upload_id, data, start_byte, total_size, content_type, metadata=None):
+    data_size = len(data)
+    _total = "*" if (total_size is None) else str(total_size)
+    if (data_size > 0):
+        _range = "bytes " + str(start_byte) + "-" + str(start_byte + data_size - 1) + "/" + _total
+    else:   # dernier chunk vide : annonce seulement la taille totale
+        _range = "bytes */" + _total
     headers = {
         "Content-Length": str(data_size),
-        "Content-Type": filenameToMimeType(pathfilename),
-        "Content-Range": "bytes " + str(file_next_byte) + "-" + str(file_next_byte + data_size - 1) + "/" + str(file_size)
+        "Content-Type": content_type,
+        "Content-Range": _range
     }
-    print(headers)
-    r = requests.put(
-        "https://www.googleapis.com/upload/drive/v3/files?uploadType=resumable&upload_id=" + upload_id,
+    _client = getUploadClient()
+    r = _client.put(
+        _client.url("/upload/drive/v3/files?uploadType=resumable&upload_id=" + upload_id),
         headers=headers,
-        data=data_buff
+        data=getBandwidthLimiter().throttle(upload_id, data)
     )
-    log("Code de retour : " + str(r.status_code))
-    log(r.headers)
-    if (r.status_code == 200):
-        log ("La dernière session d'upload s'est terminée avec succès.")
-        return True, 0, file_size
-    elif (r.status_code == 308) : # Le dernier transfert ne s'est pas terminé jusqu'au bout
-        _start_byte, _end_byte = rangeToMinMaxValues(r.headers['Range'])
-        log("La dernière session d'upload ne s'est pas terminée complètement")
-        log ("Les octets reçues lors de la dernière session sont " + str(_start_byte) + "-" + str(_end_byte))
-        return False, _start_byte, _end_byte
-    return False, 0, 0 # Autre code d'erreur : ne peut pas conclure
+    raiseForUploadStatus(r)   # le détail de chaque chunk est publié par UploadMetrics
+    if (r.status_code in (200, 201)):
+        readUploadMetadata(r, metadata)
+        return True, 0, total_size
+    # 308 : Le dernier transfert ne s'est pas terminé jusqu'au bout
+    range = r.headers.get('Range')
+    _start_byte = 0
+    _end_byte = 0
+    if (range is not None):
+        _start_byte, _end_byte = rangeToMinMaxValues(range)
+    return False, _start_byte, _end_byte
 
 # ______________________________________________________________________________________
 # Vérifie si un téléchargement est terminé ou non
 # Renvoie True si le téléchargement s'est terminé
 # Renvoie False si le téléchargement n'est pas terminé
 #    Dans ce cas, renvoie également la plage des octets déjà téléchargés pour permettre une reprise
+# Lève SessionExpiredError si la session n'existe plus, TransientUploadError en cas d'erreur temporaire
+# metadata : dictionnaire optionnel, complété par les métadonnées du fichier si l'upload est terminé
 
-def checkUploadComplete(upload_id):
+def checkUploadComplete(upload_id, metadata=None):
     headers = {
         "Content-Length": "0",
         "Content-Range": "bytes */*"
     }
-    r = requests.put(
-        "https://www.googleapis.com/upload/drive/v3/files?uploadType=resumable&upload_id=" + upload_id,
+    _client = getUploadClient()
+    r = _client.put(
+        _client.url("/upload/drive/v3/files?uploadType=resumable&upload_id=" + upload_id),
         headers=headers
     )
     log("Code de retour : " + str(r.status_code))
     log(r.headers)
-    if (r.status_code == 200):
+    raiseForUploadStatus(r)
+    if (r.status_code in (200, 201)):
         log ("La dernière session d'upload s'est terminée avec succès.")
+        readUploadMetadata(r, metadata)
         return True, 0, 0
-    elif (r.status_code == 308) : # Le dernier transfert ne s'est pas terminé jusqu'au bout
-        range = r.headers.get('Range')
-        _start_byte = 0
-        _end_byte = 0
-        if (range is not None):
-            _start_byte, _end_byte = rangeToMinMaxValues(range)
-        log("La dernière session d'upload ne s'est pas terminée complètement")
-        log ("Les octets reçues lors de la dernière session sont " + str(_start_byte) + "-" + str(_end_byte))
-        return False, _start_byte, _end_byte
-    return False, 0, 0 # Autre code d'erreur : ne peut pas conclure
-
-# __________________________________________________________________
-# Sauvegarde les paramètres d'un transfert dans un fichier text
-def saveConfigToFile(pathfilename, filename, upload_id):
-    _local_datetime = time.strftime("%Y_%m_%d_%Hh%Mm%Ss", time.localtime())
-    cfg_filename = "upload_config_" + _local_datetime + ".ini"
-    f = open(cfg_filename, "w")
+    # 308 : Le dernier transfert ne s'est pas terminé jusqu'au bout
+    range = r.headers.get('Range')
+    _start_byte = 0
+    _end_byte = 0
+    if (range is not None):
+        _start_byte, _end_byte = rangeToMinMaxValues(range)
+    log("La dernière session d'upload ne s'est pas terminée complètement")
+    log ("Les octets reçues lors de la dernière session sont " + str(_start_byte) + "-" + str(_end_byte))
+    return False, _start_byte, _end_byte
+
+# Copie dans metadata les métadonnées du fichier (JSON) renvoyées par Drive à la fin d'un upload
+def readUploadMetadata(r, metadata):
+    if (metadata is None):
+        return
+    try:
+        metadata.update(r.json())
+    except ValueError:
+        pass
 
-    Config = configparser.ConfigParser()
-    Section = 'DEFAULT'
-    Config.set(Section, 'pathfilename', pathfilename)
-    Config.set(Section, 'filename', filename)
-    Config.set(Section, 'upload_id', upload_id)
-
-    Config.write(f)
-    f.close()
+# __________________________________________________________________
+# Journal des sessions d'upload
+# Chaque session est enregistrée avec le fichier source (chemin, taille, date de
+#  modification), son upload_id et le nombre d'octets acquittés par le serveur,
+#  mis à jour après chaque chunk. in_flight indique qu'un chunk était en cours
+#  d'envoi : après un arrêt brutal dans cet état, le serveur doit être interrogé
+#  pour connaître l'octet de reprise.
+class FileChangedError(Exception):
+    pass
+
+class UploadJournal:
+    def __init__(self, pathfilename=None):
+        self.pathfilename = JOURNAL_PATHFILENAME if (pathfilename is None) else pathfilename
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.pathfilename, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS sessions (
+            upload_id TEXT PRIMARY KEY,
+            pathfilename TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            committed INTEGER NOT NULL DEFAULT 0,
+            in_flight INTEGER NOT NULL DEFAULT 0,
+            complete INTEGER NOT NULL DEFAULT 0,
+            created REAL NOT NULL,
+            updated REAL NOT NULL)""")
+        _columns = [_row["name"] for _row in self._db.execute("PRAGMA table_info(sessions)")]
+        if ("md5" not in _columns):     # journal créé par une version précédente
+            self._db.execute("ALTER TABLE sessions ADD COLUMN md5 TEXT")
+        if ("encoding" not in _columns):
+            self._db.execute("ALTER TABLE sessions ADD COLUMN encoding TEXT")
+            self._db.execute("ALTER TABLE sessions ADD COLUMN checkpoint INTEGER NOT NULL DEFAULT 0")
+        if ("hash_state" not in _columns):
+            self._db.execute("ALTER TABLE sessions ADD COLUMN hash_offset INTEGER NOT NULL DEFAULT 0")
+            self._db.execute("ALTER TABLE sessions ADD COLUMN hash_state BLOB")
+        self._hashers = {}
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    # Enregistre une nouvelle session
+    # encoding : pour un fichier envoyé compressé, paramètres de la compression (voir GzipImageEncoder)
+    def begin(self, pathfilename, filename, upload_id, encoding=None):
+        _stat = os.stat(pathfilename)
+        _now = time.time()
+        self._execute("INSERT OR REPLACE INTO sessions (upload_id, pathfilename, filename, size, mtime, encoding, created, updated) "
+                      "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                      (upload_id, os.path.abspath(pathfilename), filename, _stat.st_size, _stat.st_mtime, encoding, _now, _now))
+
+    # Mémorise le nombre d'octets acquittés par le serveur
+    # Entre deux chunks (in_flight=False), l'état du calcul MD5 de la session (voir getHasher)
+    #  est enregistré en même temps
+    def update(self, upload_id, committed, in_flight=False):
+        with self._lock:
+            _hasher = None if in_flight else self._hashers.get(upload_id)
+        _checkpoint = None if (_hasher is None) else _hasher.checkpoint()
+        if (_checkpoint is None):
+            self._execute("UPDATE sessions SET committed=?, in_flight=?, updated=? WHERE upload_id=?",
+                          (committed, int(in_flight), time.time(), upload_id))
+        else:
+            self._execute("UPDATE sessions SET committed=?, in_flight=?, hash_offset=?, hash_state=?, updated=? WHERE upload_id=?",
+                          (committed, int(in_flight), _checkpoint[0], _checkpoint[1], time.time(), upload_id))
+
+    # Fichier envoyé compressé : mémorise le dernier point de reprise acquitté par le serveur,
+    #  committed étant l'octet du fichier et checkpoint l'octet correspondant du flux compressé
+    def checkpoint(self, upload_id, committed, checkpoint):
+        self._execute("UPDATE sessions SET committed=?, checkpoint=?, updated=? WHERE upload_id=?",
+                      (committed, checkpoint, time.time(), upload_id))
+
+    # md5 : empreinte MD5 du fichier uploadé, si elle a été calculée
+    def complete(self, upload_id, md5=None):
+        self._execute("UPDATE sessions SET committed=size, in_flight=0, complete=1, md5=?, updated=? WHERE upload_id=?",
+                      (md5, time.time(), upload_id))
+        with self._lock:
+            self._hashers.pop(upload_id, None)
+
+    def forget(self, upload_id):
+        self._execute("DELETE FROM sessions WHERE upload_id=?", (upload_id,))
+        with self._lock:
+            self._hashers.pop(upload_id, None)
+
+    # Renvoie le calcul MD5 en cours de la session
+    # Le calcul est conservé en mémoire tant que le processus tourne, si bien qu'une reprise
+    #  (après une erreur, une pause ou une annulation) le poursuit là où il s'était arrêté.
+    #  Après un redémarrage, il repart du dernier état enregistré par update() ; à défaut
+    #  (libcrypto absente, voir ResumableMd5), du début du fichier, la partie déjà envoyée
+    #  étant relue une fois en arrière-plan (voir StreamHasher.follow).
+    def getHasher(self, upload_id):
+        with self._lock:
+            if (upload_id not in self._hashers):
+                _rows = self._db.execute("SELECT hash_offset, hash_state FROM sessions WHERE upload_id=?", (upload_id,)).fetchall()
+                if ( _rows and (_rows[0]["hash_state"] is not None) ):
+                    self._hashers[upload_id] = StreamHasher(_rows[0]["hash_offset"], _rows[0]["hash_state"])
+                else:
+                    self._hashers[upload_id] = StreamHasher()
+            return self._hashers[upload_id]
+
+    # Renvoie la session (dict) ou None si elle est inconnue
+    def get(self, upload_id):
+        _rows = self._execute("SELECT * FROM sessions WHERE upload_id=?", (upload_id,))
+        return dict(_rows[0]) if _rows else None
+
+    def sessions(self):
+        return [dict(_row) for _row in self._execute("SELECT * FROM sessions ORDER BY created")]
+
+    def unfinished(self):
+        return [dict(_row) for _row in self._execute("SELECT * FROM sessions WHERE complete=0 ORDER BY created")]
+
+    # Indique si le fichier local a changé (ou disparu) depuis le début de la session
+    def fileChanged(self, entry):
+        try:
+            _stat = os.stat(entry["pathfilename"])
+        except OSError:
+            return True
+        return (_stat.st_size != entry["size"]) or (_stat.st_mtime != entry["mtime"])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+_upload_journal = None
+_upload_journal_lock = threading.Lock()
+
+# Renvoie le journal par défaut (ouvert au premier appel)
+def getUploadJournal():
+    global _upload_journal
+    with _upload_journal_lock:
+        if (_upload_journal is None):
+            _upload_journal = UploadJournal()
+        return _upload_journal
 
 # __________________________________________________________________
-# Sauvegarde les paramètres d'un transfert dans un fichier text
+# Lit les paramètres d'un transfert dans un ancien fichier de configuration ".ini"
 # Restitue les 3 paramètres du fichiers
 def readConfigFile(cfg_pathfilename):
     Config = configparser.ConfigParser()
@@ -403,25 +2446,90 @@ def readConfigFile(cfg_pathfilename):
 # Authorisation / Token ID
 # =================================================================
 # __________________________________________________________________
-# Crée un nouveau token ID
+# Fournit un access token valide à partir des identifiants mémorisés dans token.json
+# L'autorisation dans le navigateur (tools.run_flow) n'est lancée que s'il n'y a pas
+#  d'identifiants utilisables. Le token est renouvelé avec le refresh token peu avant
+#  son expiration (TOKEN_REFRESH_MARGIN), une seule fois pour tous les workers.
+class CredentialProvider:
+    def __init__(self, token_pathfilename=None, secrets_pathfilename=None, scopes=None, refresh_margin=None):
+        self.token_pathfilename = OAUTH_TOKEN_PATHFILENAME if (token_pathfilename is None) else token_pathfilename
+        self.secrets_pathfilename = OAUTH_SECRETS_PATHFILENAME if (secrets_pathfilename is None) else secrets_pathfilename
+        self.scopes = OAUTH_SCOPES if (scopes is None) else scopes
+        self.refresh_margin = TOKEN_REFRESH_MARGIN if (refresh_margin is None) else refresh_margin
+        from oauth2client import file
+        self._store = file.Storage(self.token_pathfilename)
+        self._creds = None
+        self._lock = threading.Lock()
+
+    # Renvoie un access token valide pendant au moins refresh_margin secondes
+    # force_refresh : renouvelle le token même s'il n'a pas expiré (ex : après un 401)
+    def accessToken(self, force_refresh=False):
+        with self._lock:
+            if (self._creds is None):
+                self._creds = self._store.get()   # les tokens renouvelés sont réécrits dans token.json
+            if ( (self._creds is None) or self._creds.invalid ):
+                self._authorize()
+            elif ( force_refresh or self._expiresSoon() ):
+                self._refresh()
+            return self._creds.access_token
+
+    def _expiresSoon(self):
+        if (self._creds.access_token is None):
+            return True
+        if (self._creds.token_expiry is None):
+            return False
+        _now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)   # token_expiry est en UTC
+        return (self._creds.token_expiry - _now).total_seconds() < self.refresh_margin
+
+    def _refresh(self):
+        import httplib2
+        from oauth2client import client
+        if (self._creds.refresh_token is None):
+            return self._authorize()
+        log ("Renouvellement du token id")
+        try:
+            self._creds.refresh(httplib2.Http())
+        except client.HttpAccessTokenRefreshError as e:   # refresh token révoqué ou expiré
+            log ("Renouvellement impossible (" + str(e) + "), nouvelle autorisation")
+            self._authorize()
+
+    # Les options de run_flow sont fixées ici : sans elles, oauth2client analyserait sys.argv
+    #  (ex : les arguments de la ligne de commande). Ses messages vont sur la sortie d'erreur.
+    def _authorize(self):
+        from oauth2client import client, tools
+        _flow = client.flow_from_clientsecrets(self.secrets_pathfilename, self.scopes)
+        _flags = tools.argparser.parse_args([] if OAUTH_LOCAL_WEBSERVER else ["--noauth_local_webserver"])
+        with contextlib.redirect_stdout(sys.stderr):
+            self._creds = tools.run_flow(_flow, self._store, _flags)
+
+_credential_provider = None
+_credential_provider_lock = threading.Lock()
+
+# Renvoie le fournisseur de tokens par défaut (créé au premier appel)
+# Une fois créé, il renseigne l'entête Authorization de toutes les requêtes du client HTTP par défaut
+def getCredentialProvider():
+    global _credential_provider
+    with _credential_provider_lock:
+        if (_credential_provider is None):
+            _credential_provider = CredentialProvider()
+        return _credential_provider
+
+# __________________________________________________________________
+# Renvoie un token ID valide, en réutilisant les identifiants mémorisés si possible
 def createTokenId():
-    SCOPES = 'https://www.googleapis.com/auth/drive'
-
-    store = file.Storage('token.json')
-    creds = store.get()
-    flow = client.flow_from_clientsecrets('credentials.json', SCOPES)
-    creds = tools.run_flow(flow, store)
-    token_id = creds.access_token
-    log ("Récupération d'un nouveau token id : " + str(token_id))
+    token_id = getCredentialProvider().accessToken()
+    log ("Récupération d'un token id")     # le token lui-même n'est jamais affiché
     return token_id
 
 # =================================================================
 # Toolbox
 # =================================================================
 # Affiche des message si autorisé
+# Les messages sont écrits sur la sortie d'erreur : la sortie standard est réservée aux
+#  résultats de la ligne de commande (métadonnées JSON, état des uploads)
 def log(str):
     if (verbose) :
-        print(str)
+        print(str, file=sys.stderr)
 
 # Extrait les valeurs min max du range
 # Entrée : une chaine au format : "bytes=456-524287"
@@ -446,9 +2554,379 @@ def rangeToMinMaxValues(_str):
 # start_byte indique la position de départ de la lecture dans le fichier (en octets)
 # size indique le nombre d'octets à lire dans le fichier
 def readIntoFile(pathfilename, start_byte, size):
-    f = open(pathfilename, "rb")
-    f.seek(start_byte)
-    return f.read(size)
+    with open(pathfilename, "rb") as f:
+        f.seek(start_byte)
+        return f.read(size)
+
+# __________________________________________________________________
+# Source de données d'un upload : le fichier est ouvert une seule fois et projeté
+#  en mémoire (mmap). Chaque chunk est une vue (memoryview) sur cette projection :
+#  aucune copie n'est faite, et le client HTTP envoie la vue directement sur la socket.
+# Les vues renvoyées par chunk() doivent être libérées (release() ou bloc "with")
+#  avant la fermeture de la source.
+# Les pages lues restent comptées dans la mémoire du processus (RSS) tant qu'elles sont
+#  projetées : discard() les retire une fois les octets envoyés (ou pris en compte dans
+#  l'empreinte MD5), pour que la mémoire ne croisse pas avec la taille du fichier.
+class FileSource:
+    def __init__(self, pathfilename):
+        self.pathfilename = pathfilename
+        self._file = open(pathfilename, "rb")
+        _stat = os.fstat(self._file.fileno())
+        self.size = _stat.st_size
+        self.mtime = _stat.st_mtime
+        if (self.size > 0):
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)
+        else:   # mmap ne sait pas projeter un fichier vide
+            self._map = None
+            self._view = memoryview(b"")
+
+    # Renvoie une vue sur les octets [start_byte, start_byte + size[ du fichier
+    def chunk(self, start_byte, size):
+        return self._view[start_byte:start_byte + size]
+
+    # Retire de la projection les pages entièrement comprises dans [start_byte, end_byte[
+    # Une lecture ultérieure de ces octets reste possible (relus depuis le cache du système)
+    def discard(self, start_byte, end_byte):
+        if ( (self._map is None) or (not hasattr(mmap, "MADV_DONTNEED")) ):
+            return
+        _start = (start_byte + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE
+        _end = min(end_byte, self.size) // mmap.PAGESIZE * mmap.PAGESIZE
+        if (_end > _start):
+            self._map.madvise(mmap.MADV_DONTNEED, _start, _end - _start)
+
+    def close(self):
+        self._view.release()
+        if (self._map is not None):
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# __________________________________________________________________
+# Lecture anticipée des chunks suivants
+# Pendant l'envoi d'un chunk, un thread lit sur le disque les depth chunks suivants
+#  (dans la limite de max_bytes) pour qu'ils soient déjà en cache lorsque le client
+#  HTTP les enverra : la lecture disque se fait en temps masqué.
+# La lecture se fait dans un petit tampon réutilisé : elle charge le cache du système
+#  sans augmenter la mémoire du processus.
+# on_read : fonction optionnelle appelée depuis le thread de lecture avec
+#  (octet de début, memoryview du chunk) une fois le chunk lu (ex : calcul d'une empreinte)
+class ChunkPrefetcher:
+    BUFFER_SIZE = (1024 * 1024)
+
+    def __init__(self, source, depth=None, max_bytes=None, on_read=None):
+        self.source = source
+        self.depth = PREFETCH_DEPTH if (depth is None) else depth
+        self.max_bytes = PREFETCH_MAX_BYTES if (max_bytes is None) else max_bytes
+        self.on_read = on_read
+        self.read_time = 0.0        # temps total (en secondes) passé à lire le fichier
+        self._scheduled_end = 0     # fin de la zone déjà lue ou en cours de lecture
+        self._executor = None
+        self._file = None
+        if (self.depth > 0):
+            import concurrent.futures
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            self._file = open(source.pathfilename, "rb", buffering=0)
+            self._buffer = bytearray(self.BUFFER_SIZE)
+
+    # Programme la lecture de la zone qui suit start_byte, découpée en chunks de chunk_size octets
+    def schedule(self, start_byte, chunk_size):
+        if ( (self._executor is None) or (chunk_size <= 0) ):
+            return
+        _end = min(self.source.size, start_byte + min(self.depth * chunk_size, max(chunk_size, self.max_bytes)))
+        _start = max(start_byte, self._scheduled_end)
+        while (_start < _end):
+            _size = min(chunk_size, _end - _start)
+            self._executor.submit(self._read, _start, _size)
+            _start = _start + _size
+        self._scheduled_end = max(self._scheduled_end, _end)
+
+    def _read(self, start_byte, size):
+        _time_start = time.monotonic()
+        self._file.seek(start_byte)
+        _remaining = size
+        while (_remaining > 0):
+            _read = self._file.readinto(memoryview(self._buffer)[:min(_remaining, self.BUFFER_SIZE)])
+            if (not _read):
+                break
+            _remaining = _remaining - _read
+        self.read_time = self.read_time + (time.monotonic() - _time_start)
+        if (self.on_read is not None):
+            with self.source.chunk(start_byte, size) as _view:
+                self.on_read(start_byte, _view)
+
+    def close(self):
+        if (self._executor is not None):
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._file.close()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# __________________________________________________________________
+# Calcul MD5 dont l'état peut être enregistré puis restauré (voir UploadJournal.getHasher)
+# L'état d'un calcul hashlib ne peut pas être lu : le calcul est confié aux fonctions MD5_*
+#  de libcrypto (OpenSSL), appelées par ctypes, dont l'état MD5_CTX est une structure connue.
+# state() renvoie cet état sous une forme indépendante d'OpenSSL : les mots A, B, C et D,
+#  le nombre de bits déjà traités et les octets en attente d'un bloc de 64 octets complet.
+# available() indique si libcrypto et ses fonctions MD5_* ont été trouvées.
+class _Md5Ctx(ctypes.Structure):
+    _fields_ = [("A", ctypes.c_uint32), ("B", ctypes.c_uint32), ("C", ctypes.c_uint32), ("D", ctypes.c_uint32),
+                ("Nl", ctypes.c_uint32), ("Nh", ctypes.c_uint32),
+                ("data", ctypes.c_uint8 * 64), ("num", ctypes.c_uint32)]
+
+class ResumableMd5:
+    STATE_FORMAT = "<4IQ"   # A, B, C, D, nombre de bits, suivis des octets en attente
+    _libcrypto = None
+    _libcrypto_lock = threading.Lock()
+
+    # Renvoie libcrypto, ou None si elle (ou ses fonctions MD5_*) n'est pas disponible
+    @classmethod
+    def libcrypto(cls):
+        with cls._libcrypto_lock:
+            if (cls._libcrypto is None):
+                cls._libcrypto = False
+                try:
+                    import ctypes.util
+                    _lib = ctypes.CDLL(ctypes.util.find_library("crypto") or "libcrypto.so")
+                    _lib.MD5_Init.argtypes = [ctypes.POINTER(_Md5Ctx)]
+                    _lib.MD5_Update.argtypes = [ctypes.POINTER(_Md5Ctx), ctypes.c_void_p, ctypes.c_size_t]
+                    _lib.MD5_Final.argtypes = [ctypes.c_void_p, ctypes.POINTER(_Md5Ctx)]
+                    cls._libcrypto = _lib
+                except (OSError, AttributeError):
+                    log ("libcrypto introuvable : l'état du calcul MD5 ne sera pas enregistré dans le journal")
+            return cls._libcrypto or None
+
+    @classmethod
+    def available(cls):
+        return cls.libcrypto() is not None
+
+    def __init__(self, state=None):
+        self._lib = self.libcrypto()
+        self._ctx = _Md5Ctx()
+        self._lib.MD5_Init(ctypes.byref(self._ctx))
+        if (state is not None):
+            self._ctx.A, self._ctx.B, self._ctx.C, self._ctx.D, _bits = struct.unpack_from(self.STATE_FORMAT, state)
+            _pending = state[struct.calcsize(self.STATE_FORMAT):]
+            self._ctx.Nl = _bits & 0xffffffff
+            self._ctx.Nh = _bits >> 32
+            ctypes.memmove(self._ctx.data, _pending, len(_pending))
+            self._ctx.num = len(_pending)
+
+    # data : bytes ou tampon ; un tampon en lecture seule (ex : vue sur un fichier projeté en mémoire) est copié
+    def update(self, data):
+        _view = memoryview(data)
+        if (_view.nbytes == 0):
+            return
+        if (_view.readonly):
+            _buffer = bytes(_view)
+        else:
+            _buffer = (ctypes.c_char * _view.nbytes).from_buffer(_view)
+        self._lib.MD5_Update(ctypes.byref(self._ctx), _buffer, _view.nbytes)
+
+    def state(self):
+        _bits = (self._ctx.Nh << 32) | self._ctx.Nl
+        return (struct.pack(self.STATE_FORMAT, self._ctx.A, self._ctx.B, self._ctx.C, self._ctx.D, _bits)
+                + bytes(self._ctx.data)[:self._ctx.num])
+
+    def hexdigest(self):
+        _ctx = _Md5Ctx.from_buffer_copy(self._ctx)     # MD5_Final modifie l'état
+        _digest = (ctypes.c_uint8 * 16)()
+        self._lib.MD5_Final(_digest, ctypes.byref(_ctx))
+        return bytes(_digest).hex()
+
+# __________________________________________________________________
+# Calcul MD5 au fil de l'eau d'un fichier, dans l'ordre des octets
+# advance() complète le calcul jusqu'à end_byte en lisant les octets manquants
+#  depuis la source ; les octets déjà pris en compte ne sont jamais relus.
+# follow() prend en compte les octets [start_byte, end_byte[ qui viennent d'être lus ou envoyés.
+#  S'ils ne suivent pas ceux déjà pris en compte, le retard est rattrapé par un thread dédié,
+#  par pas de STEP octets lus dans son propre descripteur de fichier : ni l'envoi ni la lecture
+#  anticipée n'attendent ce rattrapage, seule l'empreinte finale (hexdigest après advance
+#  jusqu'à la fin) l'attend.
+# offset, state : calcul repris à partir d'un état enregistré (voir checkpoint). Sans état
+#  (ou sans libcrypto, voir ResumableMd5), une reprise dans un nouveau processus repart de 0
+#  et la partie du fichier déjà envoyée est relue une fois par le thread de rattrapage.
+class StreamHasher:
+    STEP = (1024 * 1024 * 8)
+
+    def __init__(self, offset=0, state=None):
+        if (ResumableMd5.available()):
+            self.offset = offset    # nombre d'octets déjà pris en compte
+            self._md5 = ResumableMd5(state)
+        else:
+            self.offset = 0
+            self._md5 = hashlib.md5()
+        self._lock = threading.Lock()
+        self._target = 0    # fin de la zone à rattraper en arrière-plan
+        self._thread = None
+
+    def advance(self, source, end_byte):
+        while True:
+            with self._lock:
+                if (self.offset >= end_byte):
+                    return
+                _size = min(self.STEP, end_byte - self.offset)
+                with source.chunk(self.offset, _size) as _view:
+                    self._md5.update(_view)
+                source.discard(self.offset, self.offset + _size)
+                self.offset = self.offset + _size
+
+    def follow(self, source, start_byte, end_byte):
+        with self._lock:
+            _behind = (self.offset < start_byte)
+            if (_behind):
+                self._target = max(self._target, end_byte)
+                if (self._thread is None):
+                    self._thread = threading.Thread(target=self._catchUp, args=(source.pathfilename,), daemon=True)
+                    self._thread.start()
+        if (not _behind):
+            self.advance(source, end_byte)
+
+    # Callback de lecture anticipée (voir ChunkPrefetcher)
+    def onRead(self, source, start_byte, view):
+        self.follow(source, start_byte, start_byte + len(view))
+
+    # Rattrapage en arrière-plan jusqu'à _target ; la lecture se fait hors du verrou
+    def _catchUp(self, pathfilename):
+        _buffer = bytearray(self.STEP)
+        with open(pathfilename, "rb", buffering=0) as f:
+            while True:
+                with self._lock:
+                    if (self.offset >= self._target):
+                        self._thread = None
+                        return
+                    _start = self.offset
+                    _size = min(self.STEP, self._target - _start)
+                f.seek(_start)
+                _read = f.readinto(memoryview(_buffer)[:_size])
+                with self._lock:
+                    if (not _read):     # fichier tronqué : advance() signalera l'erreur
+                        self._thread = None
+                        return
+                    if (self.offset == _start):
+                        self._md5.update(memoryview(_buffer)[:_read])
+                        self.offset = self.offset + _read
+
+    # Renvoie (offset, état du calcul), ou None si l'état ne peut pas être enregistré
+    def checkpoint(self):
+        with self._lock:
+            if (not isinstance(self._md5, ResumableMd5)):
+                return None
+            return self.offset, self._md5.state()
+
+    def hexdigest(self):
+        with self._lock:
+            return self._md5.hexdigest()
+
+# __________________________________________________________________
+# Compression gzip d'une image disque, bloc par bloc
+# Chaque bloc de block_size octets devient un membre gzip indépendant : la concaténation
+#  des membres est un fichier gzip valide (gunzip restitue l'image). La compression d'un
+#  bloc est déterministe (même zlib, même niveau) : elle peut être refaite à l'identique
+#  lors d'une reprise. Les blocs vides, trous du fichier (SEEK_DATA / SEEK_HOLE) ou blocs
+#  de zéros, sont remplacés par un membre de zéros compressé une seule fois ; les trous ne
+#  sont même pas lus.
+class GzipImageEncoder:
+    _zero_members = {}      # taille de bloc -> membre gzip de zéros
+    _zero_members_lock = threading.Lock()
+
+    def __init__(self, pathfilename, block_size=None, level=None):
+        self.pathfilename = pathfilename
+        self.block_size = SPARSE_BLOCK_SIZE if (block_size is None) else block_size
+        self.level = SPARSE_COMPRESSION_LEVEL if (level is None) else level
+        # Paramètres dont dépend le flux compressé : mémorisés dans le journal pour la reprise
+        self.encoding = "gzip:" + str(self.level) + ":" + str(self.block_size) + ":" + zlib.ZLIB_RUNTIME_VERSION
+
+    # Renvoie les membres gzip [(octet de fin du bloc dans l'image, membre), ...] à partir de start_byte
+    # start_byte : début d'un bloc (multiple de block_size)
+    def members(self, start_byte=0):
+        with open(self.pathfilename, "rb", buffering=0) as f:
+            _size = os.fstat(f.fileno()).st_size
+            _buffer = bytearray(self.block_size)
+            _zeros = bytes(self.block_size)
+            for _offset in range(start_byte, _size, self.block_size):
+                _length = min(self.block_size, _size - _offset)
+                if (self._isHole(f, _offset, _length)):
+                    yield _offset + _length, self._zeroMember(_length)
+                    continue
+                f.seek(_offset)
+                with memoryview(_buffer)[:_length] as _view:
+                    _read = 0
+                    while (_read < _length):
+                        _block = f.readinto(_view[_read:])
+                        if (not _block):
+                            raise FileChangedError(self.pathfilename + " a été tronqué pendant l'upload")
+                        _read = _read + _block
+                    if ( (_length == self.block_size) and (_buffer == _zeros) ):
+                        yield _offset + _length, self._zeroMember(_length)
+                    else:
+                        yield _offset + _length, self._compress(_view)
+
+    # Indique si la zone est un trou du fichier (aucune donnée allouée)
+    def _isHole(self, f, offset, length):
+        if (not hasattr(os, "SEEK_DATA")):
+            return False
+        try:
+            return os.lseek(f.fileno(), offset, os.SEEK_DATA) >= offset + length
+        except OSError as e:
+            return (e.errno == errno.ENXIO)     # plus aucune donnée après offset
+
+    def _compress(self, data):
+        _compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)   # en-tête gzip, date à 0
+        return _compressor.compress(data) + _compressor.flush()
+
+    def _zeroMember(self, length):
+        _key = (length, self.level)
+        with self._zero_members_lock:
+            if (_key not in self._zero_members):
+                self._zero_members[_key] = self._compress(bytes(length))
+            return self._zero_members[_key]
+
+# Indique si le fichier est une image disque brute (voir filenameToMimeType)
+def isDiskImage(pathfilename):
+    return (filenameToMimeType(pathfilename) == 'application/x-raw-disk-image')
+
+# __________________________________________________________________
+# Lecture uniforme d'un flux : objet fichier (read) ou itérable de bytes
+# read(size) renvoie au plus size octets, et b"" à la fin du flux
+class StreamReader:
+    def __init__(self, stream):
+        self._read = getattr(stream, "read", None)
+        self._iterator = None if (self._read is not None) else iter(stream)
+        self._pending = b""
+
+    def read(self, size):
+        if (self._read is not None):
+            return self._read(size)
+        while (not self._pending):
+            try:
+                self._pending = memoryview(bytes(next(self._iterator)))
+            except StopIteration:
+                return b""
+        _data = bytes(self._pending[:size])
+        self._pending = self._pending[size:]
+        return _data
+
+# Calcule l'empreinte MD5 d'un fichier
+def computeFileMd5(pathfilename):
+    _hasher = StreamHasher()
+    with FileSource(pathfilename) as _source:
+        _hasher.advance(_source, _source.size)
+    return _hasher.hexdigest()
+
+# Arrondit une taille de chunk au multiple de CHUNK_GRANULARITY inférieur
+def roundChunkSize(size):
+    return int(size) // CHUNK_GRANULARITY * CHUNK_GRANULARITY
 
 def getFileSize(pathfilename):
     return os.stat(pathfilename).st_size
@@ -485,4 +2963,6 @@ def filenameToMimeType(filename):
 
 # ================================================================
 if __name__ == '__main__':
+    if (len(sys.argv) > 1):
+        sys.exit(cli())
     main()
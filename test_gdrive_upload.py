@@ -0,0 +1,804 @@
+#!/usr/bin/env python3
+
+import contextlib
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+import gdrive_upload_gui
+from fake_drive_server import FakeDriveServer
+
+# Tests de bout en bout contre le serveur local fake_drive_server.py
+#   python3 -m unittest test_gdrive_upload    (ou python3 -m pytest test_gdrive_upload.py)
+
+MB = 1024 * 1024
+
+# __________________________________________________________________
+# Client HTTP qui mémorise la plage (Content-Range) de chaque PUT contenant des données
+class RecordingUploadClient(gdrive_upload_gui.UploadClient):
+    def __init__(self, *args, **kwargs):
+        gdrive_upload_gui.UploadClient.__init__(self, *args, **kwargs)
+        self.ranges = []
+        self.probes = 0     # interrogations de l'état d'une session (PUT sans données)
+
+    def put(self, url, **kwargs):
+        if (kwargs.get("data") is not None):
+            self.ranges.append(kwargs["headers"]["Content-Range"])
+        else:
+            self.probes = self.probes + 1
+        return gdrive_upload_gui.UploadClient.put(self, url, **kwargs)
+
+    # Octet de début de chaque chunk envoyé
+    def starts(self):
+        return [int(_range.split(" ")[1].split("-")[0]) for _range in self.ranges]
+
+# Fichier qui mémorise l'octet de début de chaque zone lue
+class RecordingFileSource(gdrive_upload_gui.FileSource):
+    def __init__(self, pathfilename):
+        gdrive_upload_gui.FileSource.__init__(self, pathfilename)
+        self.starts = []
+
+    def chunk(self, start_byte, size):
+        self.starts.append(start_byte)
+        return gdrive_upload_gui.FileSource.chunk(self, start_byte, size)
+
+# __________________________________________________________________
+# Chaque test dispose d'un serveur local, d'un répertoire temporaire et d'un journal neuf
+class FakeDriveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self._saved = {}
+        self.configure(JOURNAL_PATHFILENAME=os.path.join(self.directory, "journal.sqlite"),
+                       HASH_CACHE_PATHFILENAME=os.path.join(self.directory, "hash_cache.sqlite"),
+                       SYNC_MANIFEST_PATHFILENAME=os.path.join(self.directory, "sync_manifest.sqlite"),
+                       verbose=False, RETRY_BASE_DELAY=0.01, ADAPTIVE_CHUNK_SIZE=False, CHUNK_SIZE=MB)
+        self.server = FakeDriveServer(seed=0).start()
+        self.client = RecordingUploadClient(base_url=self.server.base_url)
+        gdrive_upload_gui.setUploadClient(self.client)
+        self._devnull = open(os.devnull, "w")
+        self._stdout = contextlib.redirect_stdout(self._devnull)
+        self._stdout.__enter__()
+
+    def tearDown(self):
+        self._stdout.__exit__(None, None, None)
+        self._devnull.close()
+        gdrive_upload_gui.setUploadClient(gdrive_upload_gui.UploadClient())
+        self.server.stop()
+        for _name in ("_upload_journal", "_hash_cache"):
+            if (getattr(gdrive_upload_gui, _name) is not None):
+                getattr(gdrive_upload_gui, _name).close()
+                setattr(gdrive_upload_gui, _name, None)
+        gdrive_upload_gui._drive_content_indexes.clear()
+        gdrive_upload_gui._bandwidth_limiter = None
+        gdrive_upload_gui._credential_provider = None
+        for _name, _value in self._saved.items():
+            setattr(gdrive_upload_gui, _name, _value)
+        shutil.rmtree(self.directory)
+
+    # Modifie des constantes du module pour la durée du test
+    def configure(self, **values):
+        for _name, _value in values.items():
+            self._saved.setdefault(_name, getattr(gdrive_upload_gui, _name))
+            setattr(gdrive_upload_gui, _name, _value)
+
+    def createFile(self, name, size):
+        _pathfilename = os.path.join(self.directory, name)
+        with open(_pathfilename, "wb") as f:
+            f.write(os.urandom(size))
+        return _pathfilename
+
+    def newSession(self, pathfilename):
+        _upload_id = gdrive_upload_gui.initiateNewResumableUpload(pathfilename, os.path.basename(pathfilename), "token")
+        gdrive_upload_gui.getUploadJournal().begin(pathfilename, os.path.basename(pathfilename), _upload_id)
+        return _upload_id
+
+    def uploadedMd5(self, upload_id):
+        return self.server.sessions[upload_id].metadata()["md5Checksum"]
+
+# __________________________________________________________________
+# Nouvelles tentatives après une erreur temporaire
+class RetryTest(FakeDriveTestCase):
+    def resumeWithFaults(self, faults):
+        _pathfilename = self.createFile("file.bin", 3 * MB)
+        _upload_id = self.newSession(_pathfilename)
+        self.server.faults = list(faults)
+        _metadata = gdrive_upload_gui.resumeExistingUpload(_pathfilename, "file.bin", _upload_id)
+        self.assertEqual(_metadata["md5Checksum"], gdrive_upload_gui.computeFileMd5(_pathfilename))
+        return self.client.starts()
+
+    def test_503_costs_one_extra_chunk(self):
+        # PUT 0 : réussi, PUT 1 : 503, puis interrogation de l'état et renvoi du seul chunk 1
+        self.assertEqual(self.resumeWithFaults([None, 503]), [0, MB, MB, 2 * MB])
+
+    def test_500_is_transient(self):
+        self.assertEqual(self.resumeWithFaults([None, 500]), [0, MB, MB, 2 * MB])
+
+    def test_dropped_connection_resumes_from_received_bytes(self):
+        # la moitié du chunk coupé (arrondie à 256 Ko) est conservée par le serveur
+        self.assertEqual(self.resumeWithFaults([None, "drop"]), [0, MB, MB + MB // 2, 2 * MB + MB // 2])
+
+    def test_retry_after_is_honoured(self):
+        self.server.retry_after = 0.3
+        _time_start = time.monotonic()
+        self.assertEqual(self.resumeWithFaults([503]), [0, 0, MB, 2 * MB])
+        self.assertGreaterEqual(time.monotonic() - _time_start, 0.3)
+
+    def test_retry_budget_is_bounded(self):
+        _pathfilename = self.createFile("file.bin", 2 * MB)
+        _upload_id = self.newSession(_pathfilename)
+        self.server.faults = [503] * 20
+        with self.assertRaises(gdrive_upload_gui.TransientUploadError):
+            gdrive_upload_gui.resumeExistingUpload(_pathfilename, "file.bin", _upload_id,
+                                                   retry=gdrive_upload_gui.RetryPolicy(max_attempts=3))
+
+    def test_expired_session_404(self):
+        _pathfilename = self.createFile("file.bin", 2 * MB)
+        _upload_id = self.newSession(_pathfilename)
+        self.server.expire(_upload_id)
+        with self.assertRaises(gdrive_upload_gui.SessionExpiredError):
+            gdrive_upload_gui.resumeExistingUpload(_pathfilename, "file.bin", _upload_id)
+
+    def test_expired_session_410(self):
+        _pathfilename = self.createFile("file.bin", 2 * MB)
+        _upload_id = self.newSession(_pathfilename)
+        self.server.faults = [None, 410]
+        with self.assertRaises(gdrive_upload_gui.SessionExpiredError):
+            gdrive_upload_gui.resumeExistingUpload(_pathfilename, "file.bin", _upload_id)
+        self.assertEqual(self.client.starts(), [0, MB])
+
+    def test_session_initiation_is_retried(self):
+        _pathfilename = self.createFile("file.bin", 2 * MB)
+        self.server.faults = [503, "drop"]
+        _upload_id = gdrive_upload_gui.initiateNewResumableUpload(_pathfilename, "file.bin", "token")
+        self.assertIn(_upload_id, self.server.sessions)
+        self.assertEqual(self.server.faults, [])
+
+    def test_session_initiation_error_is_raised(self):
+        _pathfilename = self.createFile("file.bin", 2 * MB)
+        self.server.faults = [403]
+        with self.assertRaises(gdrive_upload_gui.UploadError):
+            gdrive_upload_gui.initiateNewResumableUpload(_pathfilename, "file.bin", "token")
+        self.assertEqual(self.server.sessions, {})
+
+# __________________________________________________________________
+# Vérification MD5 d'un upload repris dans un nouveau processus
+class ResumeChecksumTest(FakeDriveTestCase):
+    def test_hash_catches_up_in_background(self):
+        _pathfilename = self.createFile("file.bin", 4 * MB)
+        _hasher = gdrive_upload_gui.StreamHasher()
+        with RecordingFileSource(_pathfilename) as _source:
+            with _source.chunk(3 * MB, MB) as _view:
+                _hasher.onRead(_source, 3 * MB, _view)
+            self.assertEqual(_source.starts, [3 * MB])     # les 3 premiers Mo sont relus par un autre thread
+            _hasher.advance(_source, _source.size)
+            self.assertEqual(_hasher.hexdigest(), gdrive_upload_gui.computeFileMd5(_pathfilename))
+
+    def test_md5_state_round_trip(self):
+        _data = os.urandom(1000)
+        for _cut in (0, 1, 63, 64, 65, 999):
+            _md5 = gdrive_upload_gui.ResumableMd5()
+            _md5.update(_data[:_cut])
+            _restored = gdrive_upload_gui.ResumableMd5(_md5.state())
+            _restored.update(_data[_cut:])
+            self.assertEqual(_restored.hexdigest(), hashlib.md5(_data).hexdigest())
+
+    # Upload interrompu après 2 chunks, puis repris dans un nouveau processus
+    # keep_state=False : le journal ne contient pas l'état du calcul MD5, qui repart de 0
+    def resumeAfterRestart(self, prefetch_depth, keep_state=True):
+        self.configure(PREFETCH_DEPTH=prefetch_depth, VERIFY_MD5=True)
+        _pathfilename = self.createFile("file.bin", 6 * MB)
+        _upload_id = self.newSession(_pathfilename)
+        self.server.faults = [None, None, 503]
+        with self.assertRaises(gdrive_upload_gui.TransientUploadError):
+            gdrive_upload_gui.resumeExistingUpload(_pathfilename, "file.bin", _upload_id,
+                                                   retry=gdrive_upload_gui.RetryPolicy(max_attempts=0))
+        _journal = gdrive_upload_gui.getUploadJournal()
+        self.assertEqual(_journal.get(_upload_id)["committed"], 2 * MB)
+        self.assertGreaterEqual(_journal.get(_upload_id)["hash_offset"], 2 * MB)
+        if (not keep_state):
+            _journal._execute("UPDATE sessions SET hash_offset=0, hash_state=NULL")
+        _journal._hashers.clear()
+        self.assertEqual(_journal.getHasher(_upload_id).offset, _journal.get(_upload_id)["hash_offset"])
+        gdrive_upload_gui.resumeExistingUpload(_pathfilename, "file.bin", _upload_id)
+        self.assertEqual(_journal.get(_upload_id)["md5"], gdrive_upload_gui.computeFileMd5(_pathfilename))
+        self.assertEqual(self.client.starts()[3:], [2 * MB, 3 * MB, 4 * MB, 5 * MB])
+
+    def test_resume_after_restart_with_prefetch(self):
+        self.resumeAfterRestart(2)
+
+    def test_resume_after_restart_without_prefetch(self):
+        self.resumeAfterRestart(0)
+
+    def test_resume_after_restart_without_md5_state(self):
+        self.resumeAfterRestart(2, keep_state=False)
+
+# __________________________________________________________________
+# Mémoire du processus pendant l'upload d'un gros fichier
+@unittest.skipUnless(os.path.exists("/proc/self/statm"), "mémoire résidente lue dans /proc")
+class MemoryTest(FakeDriveTestCase):
+    def residentMemory(self):
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+    # Pic de mémoire résidente (au-delà de celle du début de l'upload) pendant l'upload de size octets
+    def peakGrowth(self, size):
+        _pathfilename = self.createFile("file" + str(size) + ".bin", size)
+        _samples = []
+        _baseline = self.residentMemory()
+        gdrive_upload_gui.uploadFile(_pathfilename, "file.bin", "token",
+                                     progress_callback=lambda done, total: _samples.append(self.residentMemory()))
+        return max(_samples) - _baseline
+
+    def test_resident_memory_does_not_grow_with_file_size(self):
+        self.configure(VERIFY_MD5=True, PREFETCH_DEPTH=2)
+        self.assertLess(self.peakGrowth(96 * MB), self.peakGrowth(8 * MB) + 16 * MB)
+
+# __________________________________________________________________
+# Upload d'un flux de taille inconnue
+class StreamingUploadTest(FakeDriveTestCase):
+    def upload(self, stream):
+        return gdrive_upload_gui.newStreamingUpload(stream, "stream.bin", "token", chunk_size=MB)
+
+    def test_empty_stream(self):
+        _upload_id = self.upload(io.BytesIO(b""))
+        self.assertEqual(self.client.ranges, ["bytes */0"])
+        self.assertEqual(self.server.sessions[_upload_id].metadata()["size"], "0")
+        self.assertEqual(self.uploadedMd5(_upload_id), hashlib.md5(b"").hexdigest())
+
+    # Le dernier chunk annonce la taille totale, sans chunk vide supplémentaire
+    def test_stream_ending_on_a_chunk_boundary(self):
+        _data = os.urandom(2 * MB)
+        _upload_id = self.upload(io.BytesIO(_data))
+        self.assertEqual(self.client.ranges, ["bytes 0-1048575/*", "bytes 1048576-2097151/2097152"])
+        self.assertEqual(self.uploadedMd5(_upload_id), hashlib.md5(_data).hexdigest())
+
+    def test_iterable_with_odd_piece_sizes(self):
+        _pieces = [os.urandom(_size) for _size in [1, 7, 300001, 65537, MB + 3, 0, 999999, 2 * MB + 5]]
+        _upload_id = self.upload(iter(_pieces))
+        _data = b"".join(_pieces)
+        self.assertEqual(self.client.starts(), list(range(0, len(_data), MB)))
+        self.assertEqual(self.uploadedMd5(_upload_id), hashlib.md5(_data).hexdigest())
+
+    def uploadWithFaults(self, faults):
+        _data = os.urandom(3 * MB)
+        self.server.faults = [None] + list(faults)     # ouverture de la session, puis chunks
+        _upload_id = self.upload(io.BytesIO(_data))
+        self.assertEqual(self.uploadedMd5(_upload_id), hashlib.md5(_data).hexdigest())
+        return self.client.starts()
+
+    def test_503_resends_the_buffered_chunk(self):
+        self.assertEqual(self.uploadWithFaults([None, 503]), [0, MB, MB, 2 * MB])
+
+    def test_dropped_connection_resumes_from_received_bytes(self):
+        self.assertEqual(self.uploadWithFaults([None, "drop"]), [0, MB, MB + MB // 2, 2 * MB + MB // 2])
+
+# __________________________________________________________________
+# Upload en une requête : une nouvelle tentative ne doit pas dupliquer le fichier
+class SimpleUploadTest(FakeDriveTestCase):
+    def uploadWithFaults(self, faults):
+        _pathfilename = self.createFile("small.bin", 1000)
+        self.server.faults = list(faults)
+        _metadata = gdrive_upload_gui.initiateSimpleUpload(_pathfilename, "small.bin", "token")
+        self.assertEqual(_metadata["md5Checksum"], gdrive_upload_gui.computeFileMd5(_pathfilename))
+        self.assertEqual([_file["id"] for _file in self.server.files.values()], [_metadata["id"]])
+
+    def test_503_is_retried(self):
+        self.uploadWithFaults([503])
+
+    def test_dropped_request_is_sent_again(self):
+        self.uploadWithFaults(["drop"])
+
+    def test_lost_reply_does_not_duplicate_the_file(self):
+        self.uploadWithFaults(["lost_reply"])
+
+# __________________________________________________________________
+# Reprise à partir du journal des sessions
+class JournalTest(FakeDriveTestCase):
+    # Upload interrompu par une erreur après 2 chunks
+    def interruptedSession(self, name):
+        _pathfilename = self.createFile(name, 4 * MB)
+        _upload_id = self.newSession(_pathfilename)
+        self.server.faults = [None, None, 503]
+        with self.assertRaises(gdrive_upload_gui.TransientUploadError):
+            gdrive_upload_gui.resumeExistingUpload(_pathfilename, name, _upload_id,
+                                                   retry=gdrive_upload_gui.RetryPolicy(max_attempts=0))
+        return _pathfilename, _upload_id
+
+    def test_committed_offset_skips_the_probe(self):
+        _pathfilename, _upload_id = self.interruptedSession("file.bin")
+        gdrive_upload_gui.getUploadJournal().update(_upload_id, 2 * MB, in_flight=False)
+        _probes = self.client.probes
+        gdrive_upload_gui.resumeExistingUpload(_pathfilename, "file.bin", _upload_id)
+        self.assertEqual(self.client.probes, _probes)
+        self.assertEqual(self.client.starts()[3:], [2 * MB, 3 * MB])
+
+    def test_chunk_in_flight_is_probed(self):
+        _pathfilename, _upload_id = self.interruptedSession("file.bin")
+        self.assertTrue(gdrive_upload_gui.getUploadJournal().get(_upload_id)["in_flight"])
+        _probes = self.client.probes
+        gdrive_upload_gui.resumeExistingUpload(_pathfilename, "file.bin", _upload_id)
+        self.assertEqual(self.client.probes, _probes + 1)
+        self.assertEqual(self.client.starts()[3:], [2 * MB, 3 * MB])
+
+    def test_changed_file_is_refused(self):
+        _pathfilename, _upload_id = self.interruptedSession("file.bin")
+        with open(_pathfilename, "ab") as f:
+            f.write(b"x")
+        with self.assertRaises(gdrive_upload_gui.FileChangedError):
+            gdrive_upload_gui.resumeExistingUpload(_pathfilename, "file.bin", _upload_id)
+
+    # Une session en échec, une expirée et une dont le fichier a changé n'empêchent pas la reprise des autres
+    def test_resume_all_continues_after_a_failure(self):
+        _sessions = [self.interruptedSession("file" + str(_index) + ".bin")[1] for _index in range(3)]
+        _expired_id = self.interruptedSession("expired.bin")[1]
+        self.server.expire(_expired_id)
+        _changed_pathfilename, _changed_id = self.interruptedSession("changed.bin")
+        os.utime(_changed_pathfilename, (0, 0))
+        self.server.faults = [400]
+        self.assertEqual(gdrive_upload_gui.resumeUnfinishedUploads(), _sessions[1:])
+        _journal = gdrive_upload_gui.getUploadJournal()
+        self.assertEqual(set(_entry["upload_id"] for _entry in _journal.unfinished()), {_sessions[0], _changed_id})
+        self.assertIsNone(_journal.get(_expired_id))
+        for _upload_id in _sessions[1:]:
+            self.assertTrue(_journal.get(_upload_id)["complete"])
+
+# __________________________________________________________________
+# File d'upload de plusieurs fichiers en parallèle
+class UploadQueueTest(FakeDriveTestCase):
+    def test_batch_upload(self):
+        _files = [self.createFile("file" + str(_index) + ".bin", _size)
+                  for _index, _size in enumerate([6 * MB, 8 * MB + 1, 6 * MB, 1000, 7 * MB])]
+        _queue = gdrive_upload_gui.UploadQueue("token", workers=3)
+        for _pathfilename in _files:
+            _queue.add(_pathfilename)
+        _jobs = _queue.run()
+        self.assertEqual([_job.status for _job in _jobs], ["done"] * 5)
+        for _job in _jobs:
+            self.assertEqual(_job.md5, gdrive_upload_gui.computeFileMd5(_job.pathfilename))
+        _upload_ids = [_job.upload_id for _job in _jobs if (_job.upload_id != "")]
+        self.assertEqual(len(set(_upload_ids)), 4)     # le petit fichier est envoyé en une requête
+        self.assertLessEqual(self.server.stats["connections"], 3)     # une connexion keep-alive par worker
+        _report = _queue.report()
+        self.assertEqual(_report["files_done"], 5)
+        self.assertEqual(_report["bytes_done"], sum(os.path.getsize(_pathfilename) for _pathfilename in _files))
+
+    def test_failed_job_does_not_stop_the_others(self):
+        _files = [self.createFile("file" + str(_index) + ".bin", 2 * MB) for _index in range(4)]
+        _queue = gdrive_upload_gui.UploadQueue("token", workers=2)
+        for _pathfilename in _files:
+            _queue.add(_pathfilename)
+        os.remove(_files[1])
+        _jobs = _queue.run()
+        self.assertEqual([_job.status for _job in _jobs], ["done", "failed", "done", "done"])
+        self.assertEqual(_queue.report()["files_failed"], 1)
+
+    # Plus de workers que de connexions dans le client par défaut : la file utilise son propre client
+    def test_default_client_is_not_replaced(self):
+        _files = [self.createFile("file" + str(_index) + ".bin", 6 * MB) for _index in range(6)]
+        _queue = gdrive_upload_gui.UploadQueue("token", workers=self.client.pool_size + 2)
+        for _pathfilename in _files:
+            _queue.add(_pathfilename)
+        self.assertEqual([_job.status for _job in _queue.run()], ["done"] * 6)
+        self.assertIs(gdrive_upload_gui.getUploadClient(), self.client)
+        self.assertEqual(self.client.ranges, [])
+        _upload_id = self.newSession(_files[0])     # le client par défaut n'a pas été fermé
+        gdrive_upload_gui.resumeExistingUpload(_files[0], "file0.bin", _upload_id)
+        self.assertEqual(self.client.starts(), [0, MB, 2 * MB, 3 * MB, 4 * MB, 5 * MB])
+
+    def test_given_client_is_used_by_the_workers(self):
+        _files = [self.createFile("file" + str(_index) + ".bin", 6 * MB) for _index in range(3)]
+        _client = RecordingUploadClient(pool_size=3, base_url=self.server.base_url)
+        _queue = gdrive_upload_gui.UploadQueue("token", workers=3, client=_client)
+        for _pathfilename in _files:
+            _queue.add(_pathfilename)
+        self.assertEqual([_job.status for _job in _queue.run()], ["done"] * 3)
+        self.assertEqual(len(_client.ranges), 3 * 6)
+        self.assertEqual(self.client.ranges, [])
+        _client.close()
+
+# __________________________________________________________________
+# Synchronisation d'un répertoire
+class SyncTest(FakeDriveTestCase):
+    def setUp(self):
+        FakeDriveTestCase.setUp(self)
+        self.source = os.path.join(self.directory, "source")
+        os.makedirs(os.path.join(self.source, "sub"))
+        self.manifest = gdrive_upload_gui.SyncManifest()
+
+    def tearDown(self):
+        self.manifest.close()
+        FakeDriveTestCase.tearDown(self)
+
+    def writeFile(self, relpath, size):
+        with open(os.path.join(self.source, relpath), "wb") as f:
+            f.write(os.urandom(size))
+
+    def sync(self):
+        return gdrive_upload_gui.syncDirectory(self.source, "token", workers=2, manifest=self.manifest)
+
+    def driveFiles(self):
+        return {_file["name"]: _file for _file in self.server.files.values()}
+
+    def test_changed_files_are_new_revisions(self):
+        self.writeFile("small.bin", 1000)
+        self.writeFile(os.path.join("sub", "large.bin"), 6 * MB)
+        self.assertEqual(self.sync()["files_done"], 2)
+        _ids = {_name: _file["id"] for _name, _file in self.driveFiles().items()}
+        self.writeFile("small.bin", 2000)
+        self.writeFile(os.path.join("sub", "large.bin"), 7 * MB)
+        self.writeFile("new.bin", 1000)
+        _report = self.sync()
+        self.assertEqual(_report["files_done"], 3)
+        _files = self.driveFiles()
+        self.assertEqual(len(self.server.files), 3)     # aucune copie des fichiers modifiés
+        for _name, _id in _ids.items():
+            self.assertEqual(_files[_name]["id"], _id)
+            self.assertEqual(_files[_name]["md5Checksum"],
+                             gdrive_upload_gui.computeFileMd5(os.path.join(self.source, *_name.split("/"))))
+        self.assertEqual(self.sync()["unchanged"], 3)
+
+    def test_file_removed_from_drive_is_created_again(self):
+        self.writeFile("small.bin", 1000)
+        self.writeFile("large.bin", 6 * MB)
+        self.sync()
+        self.server.files.clear()
+        self.writeFile("small.bin", 2000)
+        self.writeFile("large.bin", 7 * MB)
+        self.assertEqual(self.sync()["files_done"], 2)
+        self.assertEqual(sorted(self.driveFiles()), ["large.bin", "small.bin"])
+        _known = self.manifest.load(os.path.abspath(self.source))
+        self.assertEqual(sorted(_entry[3] for _entry in _known.values()),
+                         sorted(_file["id"] for _file in self.server.files.values()))
+
+    # Processus arrêté pendant le 3e upload : les 2 premiers sont déjà dans l'index
+    def test_finished_uploads_survive_an_interrupted_sync(self):
+        for _index in range(3):
+            self.writeFile("file" + str(_index) + ".bin", 1000)
+        _calls = []
+
+        def _progress(bytes_done, bytes_total):
+            _calls.append(bytes_done)
+            if (len(_calls) == 3):
+                raise KeyboardInterrupt()
+
+        with self.assertRaises(KeyboardInterrupt):
+            gdrive_upload_gui.syncDirectory(self.source, "token", workers=1, progress_callback=_progress, manifest=self.manifest)
+        self.assertEqual(len(self.manifest.load(os.path.abspath(self.source))), 2)
+        self.assertEqual(self.sync()["files_done"], 1)
+
+    def test_manifest_without_file_id_is_migrated(self):
+        _pathfilename = os.path.join(self.directory, "old_manifest.sqlite")
+        _db = sqlite3.connect(_pathfilename)
+        _db.execute("CREATE TABLE files (root TEXT NOT NULL, relpath TEXT NOT NULL, size INTEGER NOT NULL, "
+                    "mtime_ns INTEGER NOT NULL, md5 TEXT, uploaded REAL NOT NULL, PRIMARY KEY (root, relpath)) WITHOUT ROWID")
+        _db.execute("INSERT INTO files VALUES ('/root', 'a.bin', 1, 2, 'md5', 3)")
+        _db.commit()
+        _db.close()
+        _manifest = gdrive_upload_gui.SyncManifest(_pathfilename)
+        self.assertEqual(_manifest.load("/root"), {"a.bin": (1, 2, "md5", None)})
+        _manifest.close()
+
+# __________________________________________________________________
+# Fichiers dont le contenu est déjà sur Drive
+class DeduplicationTest(FakeDriveTestCase):
+    def setUp(self):
+        FakeDriveTestCase.setUp(self)
+        self.configure(DEDUP_ENABLED=True, DEDUP_ACTION="copy", DEDUP_FOLDER_ID="root")
+
+    def test_second_upload_sends_no_data(self):
+        _pathfilename = self.createFile("file.bin", 6 * MB)
+        _metadata = gdrive_upload_gui.uploadFile(_pathfilename, "file.bin", "token")
+        _requests = self.server.stats["requests"]
+        self.assertEqual(gdrive_upload_gui.uploadFile(_pathfilename, "file.bin", "token")["id"], _metadata["id"])
+        _copy = gdrive_upload_gui.uploadFile(_pathfilename, "copy.bin", "token")
+        self.assertNotEqual(_copy["id"], _metadata["id"])
+        self.assertEqual(self.server.files[_copy["id"]]["name"], "copy.bin")
+        self.assertEqual(self.server.files[_copy["id"]]["md5Checksum"], _metadata["md5Checksum"])
+        self.assertEqual(self.server.stats["requests"], _requests + 1)     # la copie seulement
+        self.assertEqual(len(self.server.sessions), 1)
+
+    def test_file_already_on_drive_becomes_a_shortcut(self):
+        _pathfilename = self.createFile("file.bin", 1000)
+        _existing = self.server.addFile({"name": "old.bin", "md5Checksum": gdrive_upload_gui.computeFileMd5(_pathfilename)})
+        self.configure(DEDUP_ACTION="shortcut")
+        _shortcut = gdrive_upload_gui.uploadFile(_pathfilename, "file.bin", "token")
+        self.assertEqual(self.server.files[_shortcut["id"]]["mimeType"], "application/vnd.google-apps.shortcut")
+        self.assertEqual(self.server.files[_shortcut["id"]]["shortcutDetails"]["targetId"], _existing["id"])
+        self.assertEqual(self.server.stats["bytes"], 0)
+
+    # Les fichiers créés (upload, copie, raccourci) sont placés dans le dossier indexé
+    def test_new_files_are_created_in_the_indexed_folder(self):
+        self.configure(DEDUP_FOLDER_ID="folder")
+        _large = gdrive_upload_gui.uploadFile(self.createFile("large.bin", 6 * MB), "large.bin", "token")
+        _small = gdrive_upload_gui.uploadFile(self.createFile("small.bin", 1000), "small.bin", "token")
+        _copy = gdrive_upload_gui.uploadFile(os.path.join(self.directory, "large.bin"), "copy.bin", "token")
+        self.configure(DEDUP_ACTION="shortcut")
+        _shortcut = gdrive_upload_gui.uploadFile(os.path.join(self.directory, "small.bin"), "shortcut.bin", "token")
+        for _metadata in (_large, _small, _copy, _shortcut):
+            self.assertEqual(self.server.files[_metadata["id"]]["parents"], ["folder"])
+        gdrive_upload_gui._drive_content_indexes.clear()    # nouveau processus : le dossier est listé
+        self.assertEqual(gdrive_upload_gui.findDuplicateUpload(os.path.join(self.directory, "large.bin"), "large.bin", "token")["id"],
+                         _large["id"])
+
+    def test_hash_cache_evicts_least_recently_used(self):
+        _cache = gdrive_upload_gui.HashCache(os.path.join(self.directory, "cache.sqlite"), max_entries=2)
+        _pathfilenames = [self.createFile("file" + str(_index) + ".bin", 1000) for _index in range(3)]
+        for _pathfilename in _pathfilenames:
+            self.assertEqual(_cache.md5(_pathfilename), gdrive_upload_gui.computeFileMd5(_pathfilename))
+        _cached = [_row[0] for _row in _cache._db.execute("SELECT pathfilename FROM hashes")]
+        self.assertEqual(sorted(_cached), sorted(_pathfilenames[1:]))
+        _cache.close()
+
+# __________________________________________________________________
+# Images disque envoyées compressées, blocs vides compris
+class SparseImageTest(FakeDriveTestCase):
+    def setUp(self):
+        FakeDriveTestCase.setUp(self)
+        self.configure(SPARSE_BLOCK_SIZE=MB, VERIFY_MD5=True)
+
+    # blocks : contenu de chaque bloc de 1 Mo, "data" (aléatoire), "zeros" (zéros écrits) ou "hole" (trou)
+    # tail : octets aléatoires ajoutés après le dernier bloc
+    def createImage(self, blocks, tail=0):
+        _pathfilename = os.path.join(self.directory, "disk.img")
+        with open(_pathfilename, "wb") as f:
+            for _block in blocks:
+                if (_block == "data"):
+                    f.write(os.urandom(MB))
+                elif (_block == "zeros"):
+                    f.write(bytes(MB))
+                else:
+                    f.seek(MB, os.SEEK_CUR)
+            f.write(os.urandom(tail))
+            f.truncate()
+        return _pathfilename
+
+    def newImageSession(self, pathfilename):
+        _upload_id = gdrive_upload_gui.initiateResumableSession("disk.img.gz", "token", "application/gzip")
+        gdrive_upload_gui.getUploadJournal().begin(pathfilename, "disk.img.gz", _upload_id,
+                                                   encoding=gdrive_upload_gui.GzipImageEncoder(pathfilename).encoding)
+        return _upload_id
+
+    # Vérifie que Drive a reçu le flux compressé de l'image, et que ce flux restitue l'image
+    def assertUploadedImage(self, pathfilename, metadata):
+        _stream = b"".join(_member for _end, _member in gdrive_upload_gui.GzipImageEncoder(pathfilename).members())
+        self.assertEqual(metadata["md5Checksum"], hashlib.md5(_stream).hexdigest())
+        with open(pathfilename, "rb") as f:
+            self.assertEqual(gzip.decompress(_stream), f.read())
+        return _stream
+
+    def test_holes_and_zero_blocks(self):
+        _pathfilename = self.createImage(["data", "hole", "zeros", "hole", "hole", "data", "hole"], tail=1000)
+        _metadata = gdrive_upload_gui.newSparseImageUpload(_pathfilename, "disk.img", "token")
+        self.assertEqual(_metadata["name"], "disk.img.gz")
+        _stream = self.assertUploadedImage(_pathfilename, _metadata)
+        self.assertLess(len(_stream), 2 * MB + 64 * 1024)     # blocs vides : quelques octets chacun
+        _encoder = gdrive_upload_gui.GzipImageEncoder(_pathfilename)
+        _members = [_member for _end, _member in _encoder.members()]
+        self.assertEqual([_member is _encoder._zeroMember(MB) for _member in _members],
+                         [False, True, True, True, True, False, True, False])
+
+    def test_interrupted_upload_resumes_from_the_checkpoint(self):
+        _pathfilename = self.createImage(["data", "data", "hole", "data", "data"])
+        _upload_id = self.newImageSession(_pathfilename)
+        self.server.faults = [None, None, None, 503]   # état de la session, 2 chunks, puis erreur
+        with self.assertRaises(gdrive_upload_gui.TransientUploadError):
+            gdrive_upload_gui.resumeSparseImageUpload(_pathfilename, "disk.img.gz", _upload_id,
+                                                      retry=gdrive_upload_gui.RetryPolicy(max_attempts=0))
+        _entry = gdrive_upload_gui.getUploadJournal().get(_upload_id)
+        self.assertEqual(_entry["committed"], MB)       # seul le premier bloc est entièrement acquitté
+        self.assertGreater(_entry["checkpoint"], MB)
+        _bytes = self.server.stats["bytes"]
+        _metadata = gdrive_upload_gui.resumeExistingUpload(_pathfilename, "disk.img.gz", _upload_id)
+        _stream = self.assertUploadedImage(_pathfilename, _metadata)
+        self.assertEqual(self.server.stats["bytes"] - _bytes, len(_stream) - 2 * MB)   # rien n'est renvoyé
+        self.assertTrue(gdrive_upload_gui.getUploadJournal().get(_upload_id)["complete"])
+
+    def test_resume_with_another_compression_is_refused(self):
+        _pathfilename = self.createImage(["data", "data", "data"])
+        _upload_id = self.newImageSession(_pathfilename)
+        self.server.faults = [None, None, 503]
+        with self.assertRaises(gdrive_upload_gui.TransientUploadError):
+            gdrive_upload_gui.resumeSparseImageUpload(_pathfilename, "disk.img.gz", _upload_id,
+                                                      retry=gdrive_upload_gui.RetryPolicy(max_attempts=0))
+        self.configure(SPARSE_COMPRESSION_LEVEL=6)
+        with self.assertRaisesRegex(gdrive_upload_gui.UploadError, "Compression différente"):
+            gdrive_upload_gui.resumeExistingUpload(_pathfilename, "disk.img.gz", _upload_id)
+        self.assertEqual(len(self.server.files), 0)
+
+# __________________________________________________________________
+# Limitation du débit
+class BandwidthLimiterTest(FakeDriveTestCase):
+    def test_upload_rate_is_limited(self):
+        gdrive_upload_gui._bandwidth_limiter = gdrive_upload_gui.BandwidthLimiter(rate=8 * MB)
+        _pathfilename = self.createFile("file.bin", 6 * MB)
+        _time_start = time.monotonic()
+        gdrive_upload_gui.uploadFile(_pathfilename, "file.bin", "token")
+        self.assertGreaterEqual(time.monotonic() - _time_start, 0.7)
+
+    def test_rate_is_shared_between_sessions(self):
+        gdrive_upload_gui._bandwidth_limiter = gdrive_upload_gui.BandwidthLimiter(rate=8 * MB)
+        _files = [(self.createFile("file" + str(_index) + ".bin", 6 * MB), "file" + str(_index) + ".bin") for _index in range(2)]
+        _time_start = time.monotonic()
+        _jobs = gdrive_upload_gui.batchUpload(_files, "token", 2)
+        self.assertEqual([_job.status for _job in _jobs], ["done", "done"])
+        self.assertGreaterEqual(time.monotonic() - _time_start, 1.4)
+
+    def test_profiles(self):
+        _limiter = gdrive_upload_gui.BandwidthLimiter(rate=MB, profiles=[("8:00", "19:00", 0), ("22:30", "06:00", None)])
+        self.assertEqual(_limiter.currentRate(datetime.datetime(2024, 1, 1, 8, 0)), 0)
+        self.assertEqual(_limiter.currentRate(datetime.datetime(2024, 1, 1, 19, 0)), MB)
+        self.assertIsNone(_limiter.currentRate(datetime.datetime(2024, 1, 1, 23, 0)))
+        self.assertIsNone(_limiter.currentRate(datetime.datetime(2024, 1, 1, 5, 59)))
+
+    # Un débit de 0 suspend l'envoi jusqu'à ce qu'il change, sans erreur
+    def assertPausedUntilChanged(self, limiter, resume):
+        limiter.PAUSE_PERIOD = 0.05
+        threading.Timer(0.3, resume).start()
+        _time_start = time.monotonic()
+        _body = gdrive_upload_gui.ThrottledBody(limiter, "key", bytes(1000))
+        self.assertEqual(sum(len(_slice) for _slice in _body), 1000)
+        self.assertGreaterEqual(time.monotonic() - _time_start, 0.3)
+        self.assertFalse(limiter.paused("key"))
+
+    def test_zero_rate_pauses(self):
+        _limiter = gdrive_upload_gui.BandwidthLimiter(rate=0)
+        self.assertTrue(_limiter.paused("key"))
+        self.assertPausedUntilChanged(_limiter, lambda: setattr(_limiter, "rate", MB))
+
+    def test_zero_session_cap_pauses(self):
+        _limiter = gdrive_upload_gui.BandwidthLimiter(session_cap=0)
+        self.assertPausedUntilChanged(_limiter, lambda: _limiter.setSessionCap("key", MB))
+
+# __________________________________________________________________
+# Identifiants OAuth : imitation de oauth2client.client.OAuth2Credentials
+class StubCredentials:
+    def __init__(self, access_token, expires_in):
+        self.access_token = access_token
+        self.token_expiry = self.utcNow() + datetime.timedelta(seconds=expires_in)
+        self.refresh_token = "REFRESH-TOKEN"
+        self.invalid = False
+        self.refreshes = 0
+        self._lock = threading.Lock()
+
+    def refresh(self, http):
+        time.sleep(0.05)    # laisse aux autres threads le temps de demander un token
+        with self._lock:
+            self.refreshes = self.refreshes + 1
+            self.access_token = "REFRESHED-" + str(self.refreshes)
+        self.token_expiry = self.utcNow() + datetime.timedelta(hours=1)
+
+    # token_expiry est une date UTC sans fuseau
+    def utcNow(self):
+        return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+# Renouvellement des tokens, sans autorisation dans le navigateur
+class CredentialProviderTest(FakeDriveTestCase):
+    def provider(self, credentials):
+        _provider = gdrive_upload_gui.CredentialProvider(token_pathfilename=os.path.join(self.directory, "token.json"),
+                                                         refresh_margin=300)
+        _provider._store = unittest.mock.Mock(get=unittest.mock.Mock(return_value=credentials))
+        _provider._authorize = unittest.mock.Mock(side_effect=AssertionError("autorisation inattendue"))
+        return _provider
+
+    def test_stored_credentials_are_reused(self):
+        _credentials = StubCredentials("STORED", expires_in=3600)
+        _provider = self.provider(_credentials)
+        self.assertEqual([_provider.accessToken() for _index in range(3)], ["STORED"] * 3)
+        self.assertEqual(_credentials.refreshes, 0)
+        self.assertEqual(_provider._store.get.call_count, 1)
+
+    def test_token_is_refreshed_before_it_expires(self):
+        _credentials = StubCredentials("STORED", expires_in=200)   # dans la marge de 300 s
+        _provider = self.provider(_credentials)
+        self.assertEqual(_provider.accessToken(), "REFRESHED-1")
+        self.assertEqual(_provider.accessToken(), "REFRESHED-1")
+        self.assertEqual(_credentials.refreshes, 1)
+
+    def test_concurrent_workers_share_one_refresh(self):
+        _credentials = StubCredentials("STORED", expires_in=-10)
+        _provider = self.provider(_credentials)
+        _tokens = []
+        _threads = [threading.Thread(target=lambda: _tokens.append(_provider.accessToken())) for _index in range(8)]
+        for _thread in _threads:
+            _thread.start()
+        for _thread in _threads:
+            _thread.join()
+        self.assertEqual(_tokens, ["REFRESHED-1"] * 8)
+        self.assertEqual(_credentials.refreshes, 1)
+
+    # Token refusé (401) : renouvelé une fois et la requête est renvoyée
+    def test_401_forces_a_refresh_and_resends_the_request(self):
+        _credentials = StubCredentials("STORED", expires_in=3600)
+        self.client.credentials = self.provider(_credentials)
+        _pathfilename = self.createFile("file.bin", 2 * MB)
+        _upload_id = self.newSession(_pathfilename)
+        _authorizations = []
+        _send = self.client._send
+
+        def _recordingSend(method, url, kwargs):
+            _authorizations.append(kwargs["headers"]["Authorization"])
+            return _send(method, url, kwargs)
+
+        self.client._send = _recordingSend
+        self.server.faults = [401]
+        _metadata = gdrive_upload_gui.resumeExistingUpload(_pathfilename, "file.bin", _upload_id)
+        self.assertEqual(_metadata["md5Checksum"], gdrive_upload_gui.computeFileMd5(_pathfilename))
+        self.assertEqual(_authorizations, ["Bearer STORED", "Bearer REFRESHED-1", "Bearer REFRESHED-1"])
+        self.assertEqual(_credentials.refreshes, 1)
+
+# __________________________________________________________________
+# Ligne de commande
+class CliTest(FakeDriveTestCase):
+    def setUp(self):
+        FakeDriveTestCase.setUp(self)
+        self.configure(BANDWIDTH_LIMIT=None, OAUTH_LOCAL_WEBSERVER=True,     # modifiées par cli()
+                       OAUTH_TOKEN_PATHFILENAME=os.path.join(self.directory, "token.json"))
+
+    # Renvoie (code de sortie, sortie standard, sortie d'erreur)
+    def runCli(self, argv):
+        _stdout = io.StringIO()
+        _stderr = io.StringIO()
+        with contextlib.redirect_stdout(_stdout), contextlib.redirect_stderr(_stderr):
+            _code = gdrive_upload_gui.cli(argv)
+        return _code, _stdout.getvalue(), _stderr.getvalue()
+
+    def test_stdout_is_json_and_token_is_never_printed(self):
+        _pathfilename = self.createFile("file.bin", 6 * MB)
+        for _argv in (["--quiet", "--token", "SECRET-TOKEN", "new", _pathfilename],
+                      ["new", _pathfilename, "--token", "SECRET-TOKEN", "--name", "other.bin"]):
+            gdrive_upload_gui.verbose = True
+            _code, _stdout, _stderr = self.runCli(_argv)
+            self.assertEqual(_code, 0)
+            self.assertEqual(json.loads(_stdout)["md5Checksum"], gdrive_upload_gui.computeFileMd5(_pathfilename))
+            self.assertNotIn("SECRET-TOKEN", _stdout + _stderr)
+        self.assertIn("Transfert terminé", _stderr)     # sans --quiet, les messages vont sur la sortie d'erreur
+
+    # Sans --token ni token.json, l'autorisation se fait dans la console, sans lire sys.argv
+    def test_first_authorization_without_token(self):
+        _credentials = unittest.mock.Mock(access_token="FIRST-TOKEN", invalid=False, token_expiry=None, refresh_token=None)
+        _pathfilename = self.createFile("file.bin", 1000)
+        with unittest.mock.patch("oauth2client.client.flow_from_clientsecrets"), \
+             unittest.mock.patch("oauth2client.tools.run_flow", return_value=_credentials) as _run_flow, \
+             unittest.mock.patch("sys.argv", ["gdrive_upload_gui.py", "new", _pathfilename]):
+            _code, _stdout, _stderr = self.runCli(["new", _pathfilename])
+        self.assertEqual(_code, 0)
+        self.assertEqual(json.loads(_stdout)["name"], "file.bin")
+        self.assertTrue(_run_flow.call_args[0][2].noauth_local_webserver)
+
+    def test_stdin_is_uploaded_as_a_stream(self):
+        _data = os.urandom(3 * MB + 1000)
+        with unittest.mock.patch("sys.stdin", io.TextIOWrapper(io.BytesIO(_data))):
+            _code, _stdout, _stderr = self.runCli(["new", "-", "--name", "backup.tar.zst", "--token", "token"])
+        self.assertEqual(_code, 0)
+        _metadata = json.loads(_stdout)
+        self.assertEqual((_metadata["name"], _metadata["md5Checksum"]), ("backup.tar.zst", hashlib.md5(_data).hexdigest()))
+        self.assertEqual(self.client.starts(), [0, MB, 2 * MB, 3 * MB])
+        _code, _stdout, _stderr = self.runCli(["new", "-", "--token", "token"])
+        self.assertEqual((_code, _stdout), (1, ""))
+        self.assertIn("--name", _stderr)
+
+    def test_common_options_after_the_command(self):
+        _journal = os.path.join(self.directory, "other_journal.sqlite")
+        _code, _stdout, _stderr = self.runCli(["status", "--journal", _journal, "--quiet", "--json"])
+        self.assertEqual((_code, _stdout), (0, ""))
+        self.assertEqual(gdrive_upload_gui.JOURNAL_PATHFILENAME, _journal)
+        self.assertFalse(gdrive_upload_gui.verbose)
+
+    def test_common_options_before_the_command_are_kept(self):
+        gdrive_upload_gui.verbose = True
+        self.runCli(["--quiet", "--limit", "1000", "status"])
+        self.assertFalse(gdrive_upload_gui.verbose)
+        self.assertEqual(gdrive_upload_gui.BANDWIDTH_LIMIT, 1000)
+
+if __name__ == '__main__':
+    unittest.main()